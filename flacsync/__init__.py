@@ -16,11 +16,15 @@
    * Mirror directory tree of FLAC files audio files to AAC/OGG/MP3 (re-encoded
      using NeroAacEnc, oggenc, or LAME).
    * Filter source tree using one or more sub-directory paths.
-   * By default, will only re-encode missing or out-of-date AAC/OGG/MP3 files.
-   * Optionally deletes orphaned output files.
+   * By default, will only re-encode missing or out-of-date AAC/OGG/MP3 files,
+     or files encoded with different encoder settings.
+   * Optionally deletes (or lists) orphaned output files.
    * Multi-threaded encoding ensures full CPU utilization.
    * Supports transfer of FLAC meta-data including *title*, *artist*, *album*.
    * Converts FLAC replaygain field to Apple iTunes Sound Check.
+   * Optionally computes missing ReplayGain values while encoding.
+   * Optionally down-converts hi-res audio to reduce encoding time.
+   * Optionally splits single file FLAC+CUE images into tracks.
    * Optionally resizes and embeds album cover art JPEG files to destination
      files.
    * Optionally copy cover art to destination directories.
@@ -73,17 +77,28 @@
 
    -t ENC_TYPE, --type=ENC_TYPE
                         select the output transcode format; supported values
-                        are 'aac','ogg','mp3' [default:aac]
+                        are 'aac','mp3','ogg', or the name of an encoder
+                        plugin [default:aac]
+
+   --orphans=POLICY     select the handling of files and directories in the
+                        dest dir that have no corresponding source file;
+                        supported values are 'delete' (remove all), 'keep',
+                        'prompt' (ask for each file) or 'list' (print only)
+                        [default:prompt]
 
    -o, --ignore-orphans
-                        prevent the removal of files and directories in the
-                        dest dir that have no corresponding source file
+                        same as --orphans=keep
+
+   --trash              move removed orphans to a trash directory in the dest
+                        dir (.flacsync/trash), instead of deleting them
 
    -d DEST_DIR, --destination=DEST_DIR
                         define alternate destination output directory to
                         override the default. The standard default destination
                         directory will be created in the same parent directory
-                        of BASE_DIR. See BASE_DIR above.
+                        of BASE_DIR. See BASE_DIR above. May be used multiple
+                        times; files are encoded once to the first directory,
+                        then linked or copied to the others.
 
    -r, --resize         enable resizing of cover art; by default the art that
                         is found will be saved to file without resizing.
@@ -92,6 +107,141 @@
                         in addition to embedding cover art, copy image file
                         directly to the desination sub-folder.
 
+   --scan-cache         cache the state of source directories in the
+                        destination, and skip directories that are unchanged
+                        since the previous run without reading their contents
+
+   --deep-scan=N        with --scan-cache, force a full scan of all source
+                        directories every N runs, which also re-creates the
+                        outputs deleted from unchanged directories; 0 to
+                        disable [default:10]
+
+   --analyze-gain       measure the loudness of the decoded audio during
+                        encoding, and add ReplayGain 2.0 track and album values
+                        to files without replaygain tags (requires numpy)
+
+   --max-rate=HZ        convert audio with a higher sample rate to a rate below
+                        HZ (i.e. 192000 -> 48000) before encoding (requires
+                        numpy)
+
+   --max-bits=BITS      dither audio with more bits per sample to BITS before
+                        encoding; supported values are 16, 24 (requires numpy)
+
+   --split-time=SECS    split files longer than SECS into segments that are
+                        encoded in parallel; only supported by the 'mp3'
+                        encoder, and not used with --analyze-gain, --max-rate
+                        or --max-bits; 0 to disable [default:0]
+
+   --cue                split single file FLAC images with a cue sheet (a
+                        sidecar .cue file, or an embedded CUESHEET block) into
+                        one output file per track; the tracks are encoded in
+                        parallel
+
+   --shard=I/N          only sync album directories of shard I of N (i.e. 1/3),
+                        selected by a stable hash of the directory path, to
+                        divide one sync between N hosts sharing the same source
+                        and destination dirs
+
+   --merge-shards       check that every shard of a previous --shard sync
+                        completed, then sync the whole source dir to pick up
+                        any remaining work
+
+   --cooperate          claim files through lease files in the dest dir, so
+                        that several instances (i.e. on different hosts) can
+                        sync the same source and destination dirs at once;
+                        files claimed by an instance that stops responding are
+                        reclaimed after 300 seconds
+
+   --prefetch=K         read the source files of the next K jobs into memory
+                        ahead of the encoders, to avoid disk seeks between
+                        parallel decoders on slow storage (i.e. USB disks,
+                        network mounts); not used with --cooperate; 0 to
+                        disable [default:0]
+
+   --prefetch-mem=MB    with --prefetch, max size of source files read ahead
+                        of the encoders [default:256]
+
+   --concurrent-steps   read the source tags and prepare the cover art of a
+                        file while it is encoded, and keep twice as many files
+                        in flight as --threads; the decode, encode and tag
+                        steps are each limited to --threads at a time
+
+   --time-budget=TIME   stop starting new files once the estimated encoding
+                        time of the next file does not fit in the remaining
+                        TIME (i.e. 3h, 1h30m, 90m); files in progress are
+                        completed, and the remaining files are encoded first
+                        by the next run (exit status 3)
+
+   --priority=PRIORITY  select the order of encoding; supported values are
+                        'path', 'newest' (newest source file first),
+                        'smallest' (smallest source file first), 'disk'
+                        (physical location of the source file on disk, for
+                        spinning disks) [default:path]
+
+   --background         run encoders at idle CPU and I/O priority, and pause
+                        encoding threads while the system is busy (see
+                        --max-load, --max-pressure, --min-free-mem)
+
+   --max-load=LOAD      with --background, max 1 minute load average, not
+                        counting the files being encoded [default:CORES]
+
+   --max-pressure=PCT   with --background, max CPU and I/O pressure (Linux
+                        PSI, percent of time tasks are stalled) [default:40.0]
+
+   --min-free-mem=MB    with --background, min available memory
+                        [default:512]
+
+   --retry-failed       retry files that failed in previous runs; by default a
+                        failed file is skipped until the source file changes,
+                        or its retry delay expires (starting at 12h, doubled
+                        after each failure)
+
+   --update-index       update the tag index of the source files (stored in
+                        BASE_DIR); only new or changed files are read
+
+   --query=EXPR         only sync source files with tags matching EXPR (i.e.
+                        'genre=Jazz', 'artist~davis|coltrane' or
+                        'rating>=4'), looked up in the tag index; may be used
+                        multiple times to match all expressions
+
+   --verify             check the structure and duration of existing output
+                        files (without decoding the audio), and re-encode the
+                        files that are truncated or damaged
+
+   --export=BUNDLE      after the sync, write the changes of the dest dir
+                        since the last export to the --device (new and changed
+                        files, and a list of deleted files) to the bundle file
+                        BUNDLE
+
+   --device=NAME        name of the device of --export [default:device]
+
+   --export-base=ID     write the --export bundle from the bundle ID last
+                        applied to the device (see the error of
+                        --apply-bundle), when later bundles were lost
+
+   --apply-bundle=BUNDLE
+                        apply the bundle file BUNDLE of --export to a device;
+                        BASE_DIR is the root dir of the device, and no files
+                        are encoded
+
+   --serve=SOCKET       run a sync service on the Unix socket SOCKET, that
+                        keeps the source directory index, cover thumbnails
+                        and encoding threads between syncs; syncs of SOURCE
+                        paths are requested with --submit, and orphans are
+                        not removed
+
+   --submit=SOCKET      request a sync of the SOURCE paths from the service
+                        of --serve on SOCKET, and print its progress; with
+                        --background, the request waits for the interactive
+                        requests
+
+   --metrics-port=PORT  serve the live metrics of the sync (or the service)
+                        on http://127.0.0.1:PORT/metrics, in the OpenMetrics
+                        format
+
+   --metrics-file=PATH  write the live metrics of the sync (or the service)
+                        to the file PATH every 15s, for the textfile
+                        collector of the Prometheus node exporter
 
    AAC Encoder Options:
    ---------------------
@@ -140,17 +290,87 @@
 
          flacsync -f /music/flac artist1/album artist2/album
          cd /music/flac; flacsync -f . artist1/album artist2/album
+
+   5. Divide the encode of a shared library between two hosts, then check
+      that both completed from either host.
+      ::
+
+         host1$ flacsync --shard=1/2 /nfs/music/flac
+         host2$ flacsync --shard=2/2 /nfs/music/flac
+         host1$ flacsync --merge-shards /nfs/music/flac
+
+   6. Sync all jazz albums rated 4 stars or better to a portable player,
+      after updating the tag index of new or changed files.
+      ::
+
+         flacsync -d /player --update-index --query=genre=jazz \\
+               --query='rating>=4' /music/flac
+
+   7. Keep two AAC mirrors of the library, on a NAS share and an SD card;
+      each file is encoded once.
+      ::
+
+         flacsync -d /nas/music/aac -d /media/sdcard/music /music/flac
+
+   8. Sync the library on a NAS, and write the changes for the car USB stick
+      to a bundle; later, apply the bundle to the USB stick.
+      ::
+
+         flacsync -t mp3 --export=/nas/car.tar --device=car /nas/music/flac
+         flacsync --apply-bundle=/nas/car.tar /media/usb/music
+
+   9. Run a sync service, and request the sync of a new album from a ripper
+      hook; the whole library is synced as background work.
+      ::
+
+         flacsync --serve=/run/user/1000/flacsync.sock /music/flac &
+         flacsync --submit=/run/user/1000/flacsync.sock /music/flac \\
+               artist/album
+         flacsync --submit=/run/user/1000/flacsync.sock --background \\
+               /music/flac
+
+   10. Sync the library, with its progress published for Prometheus.
+       ::
+
+         flacsync --metrics-port=9638 /music/flac
+         flacsync --metrics-file=/var/lib/node_exporter/flacsync.prom \\
+               /music/flac
 """
 
+import hashlib
 import multiprocessing.dummy as mp
 import optparse as op
 import os
+import signal
+import socket
 import sys
 import textwrap
+import threading
+import time
 
+from . import album
+from . import budget
+from . import bundle
+from . import cue
 from . import decoder
-from . import encoder
+from . import fingerprint
+from . import index
+from . import job
+from . import lease
+from . import ledger
+from . import loudness
+from . import metrics
+from . import orphan
+from . import prefetch
+from . import registry
+from . import resample
+from . import scan
+from . import service
+from . import shard
+from . import steps
+from . import throttle
 from . import util
+from . import verify
 
 __version__ = '0.3.2'
 __author__ = 'Patrick C. McGinty'
@@ -159,10 +379,11 @@ __email__ = 'flacsync@tuxcoder.com'
 DEFAULT_ENCODER = 'aac'
 
 # define a mapping of enocoder-types to implementation class name.
-ENCODERS = {'aac':encoder.AacEncoder,
-            'ogg':encoder.OggEncoder,
-            'mp3':encoder.Mp3Encoder,
-         }
+ENCODERS = registry.Registry( {
+            'aac':'flacsync.encoder:AacEncoder',
+            'ogg':'flacsync.encoder:OggEncoder',
+            'mp3':'flacsync.encoder:Mp3Encoder',
+         })
 CORES = mp.cpu_count()
 
 
@@ -174,19 +395,52 @@ class WorkUnit( object ):
    Multiple instances of this class are asynchronously executed in a
    multiprocessing worker pool queue.
    """
-   def __init__( self, opts, max_work ):
+   def __init__( self, opts, max_work, albums=None ):
       """
       :param opts:   Parsed command-line options.
       :type  opts:   :mod:`optparse`.Values
 
       :param max_work: Total number of workers in the pool.
       :type  max_work: int
+
+      :param albums: Mapping of album directory to track count, for albums
+                     that are completely (re)encoded. Used to compute album
+                     gain values.
+      :type  albums: dict
       """
       self.abort = False
       self._opts = opts
       self._max_work = max_work
       self._count = 0
       self._dirs = {}
+      self._albums = loudness.AlbumGain( albums or {} )
+      self._segments = {}
+      self._lock = threading.Lock()
+      #: Optional :class:`~flacsync.prefetch.Prefetcher` of source files.
+      self.prefetcher = None
+      #: Mapping of destination directory to :class:`~flacsync.album.Album`.
+      self.albums = {}
+      #: Optional :class:`~flacsync.budget.Budget` of the run.
+      self.budget = None
+      #: Optional :class:`~flacsync.throttle.Throttle` of worker slots.
+      self.throttle = None
+      #: Optional :class:`~flacsync.ledger.Ledger` of failed files.
+      self.ledger = None
+      #: Source bytes of the encoded files.
+      self.read_bytes = 0
+      #: Optional :class:`~flacsync.album.CoverCache` of cover thumbnails.
+      self.covers = None
+      #: Optional function of (encoder, ok), called once a file is finished.
+      self.listener = None
+      #: Optional :class:`~flacsync.metrics.Metrics` of the run.
+      self.metrics = None
+      #: Number of jobs taken by a worker thread.
+      self.started = 0
+      #: Optional :class:`~flacsync.lease.LeaseQueue` of the claimed jobs.
+      self.leases = None
+      #: Optional :class:`~flacsync.steps.Engine` of concurrent file steps.
+      self.steps = None
+      self._admitted = {}
 
    def _log( self, file_ ):
       """Output progress of encoding to terminal."""
@@ -202,36 +456,322 @@ class WorkUnit( object ):
       lines.append( '%15s %-60s' % (pos, os.path.basename(file_)[:60],) )
       return '\n'.join(lines)
 
-   def do_work( self, encoder ):
+   def do_work( self, job ):
       """
       Perform all process steps to convert FLAC file to the defined
       output format.
 
-      :param encoder: Encoder instance object used for conversion.
-      :type  encoder: :mod:`flacsync.encoder`._Encoder
+      :param job:    Job of the file to convert.
+      :type  job:    :class:`~flacsync.job.Job`
       """
+      self._started()
       if self.abort: return
+      if self.throttle:
+         self.throttle.acquire()
+      encoder = None
       try:
-         file_ = encoder.src
+         if self.abort: return
+         if self.budget and not self.budget.admit( job ): return
+         file_ = job.src
          self._count += 1
          print self._log( file_ )
          sys.stdout.flush()
-         if encoder.encode( self._opts.force ):
-            encoder.tag( decoder.FlacDecoder(file_).tags )
-            encoder.set_cover(True, self._opts.art_resize)  # force new cover
-         else: # update cover if newer
-            encoder.set_cover(False, self._opts.art_resize)
-         # copy cover art
-         if self._opts.art_copy:
-            encoder.copy_cover( self._opts.force )
+         if self.prefetcher:
+            self.prefetcher.acquire( job.flac )
+         encoder = job.encoder()
+         self._prepare( encoder )
+         if self._lost( job ): return
+         needed = self._opts.force or encoder.is_stale()
+         early = None
+         if self.steps and needed:
+            # source tags and cover, while the encoder runs
+            early = self.steps.prepare( encoder, self._opts.art_resize )
+         start = time.time()
+         self._stage( encoder, 'encode' )
+         with self._slot( 'encode' ):
+            encoded = encoder.encode( self._opts.force,
+                                      self._opts.analyze_gain,
+                                      self._opts.max_rate,
+                                      self._opts.max_bits )
+         if encoded:
+            self._read( encoder )
+         if self.budget and encoded:
+            self.budget.record( encoder, time.time() - start )
+         if self._lost( job ): return
+         self._finish( encoder, encoded, encoded or not needed, early )
+      except KeyboardInterrupt:
+         self.abort = True
+      except Exception as exc:
+         print "ERROR: '%s' !!" % (file_,)
+         print exc
+         if encoder and not self._lost( job ):
+            self._failed( encoder, exc )
+      finally:
+         job.release()
+         if self.throttle:
+            self.throttle.release()
+
+   def do_claimed( self, leases ):
+      """
+      Claim and convert files from a work queue shared with other flacsync
+      instances, until the queue is empty.
+
+      :param leases: Shared work queue of jobs.
+      :type  leases: :class:`~flacsync.lease.LeaseQueue`
+      """
+      self.leases = leases
+      while not self.abort:
+         job = leases.claim()
+         if job is None:
+            return
+         try:
+            self.do_work( job )
+         finally:
+            leases.release( job )
+
+   def do_segment( self, job, index, count ):
+      """
+      Encode a single segment of a split FLAC file. The segments are joined
+      by the last one to complete, followed by the remaining process steps
+      of :meth:`do_work`.
+
+      :param job:    Job of the file to convert, split with
+                     :meth:`~flacsync.encoder.Mp3Encoder.split`.
+      :type  job:    :class:`~flacsync.job.Job`
+
+      :param index:  Segment index.
+      :type  index:  int
+
+      :param count:  Total number of segments.
+      :type  count:  int
+      """
+      self._started()
+      if self.budget and not self.abort:
+         # all segments of a file are started, or deferred
+         with self._lock:
+            if job not in self._admitted:
+               self._admitted[job] = self.budget.admit( job )
+         if not self._admitted[job]: return
+      file_ = job.src
+      with self._lock:
+         # the segments share the encoder object of the job
+         encoder = job.encoder()
+      ok = False
+      throttled = self.throttle and not self.abort
+      if throttled:
+         self.throttle.acquire()
+      try:
+         if self.abort:
+            return   # counted as failed, the segments are discarded
+         if index == 0:
+            self._count += 1
+            print self._log( file_ )
+            sys.stdout.flush()
+         if self.prefetcher:
+            self.prefetcher.acquire( job.flac )
+         self._prepare( encoder )
+         ok = encoder.encode_segment( index )
       except KeyboardInterrupt:
          self.abort = True
       except Exception as exc:
          print "ERROR: '%s' !!" % (file_,)
          print exc
+      finally:
+         if throttled:
+            self.throttle.release()
+         self._segment_done( job, encoder, ok, count )
 
+   def _segment_done( self, job, encoder, ok, count ):
+      """
+      Count a finished segment. The last one joins the segments, or removes
+      them after a failure or an abort.
+      """
+      file_ = job.src
+      with self._lock:
+         done,failed = self._segments.get( job, (0,False) )
+         done,failed = done+1, failed or not ok
+         self._segments[job] = (done,failed)
+      if done == count and self.abort:
+         encoder.join_segments( discard=True )
+         job.release()
+      elif done == count:
+         try:
+            encoded = encoder.join_segments(discard=failed)
+            if encoded:
+               self._read( encoder )
+            self._finish( encoder, encoded, encoded )
+         except KeyboardInterrupt:
+            self.abort = True
+         except Exception as exc:
+            print "ERROR: '%s' !!" % (file_,)
+            print exc
+            self._failed( encoder, exc )
+         finally:
+            job.release()
+
+   def _lost( self, job ):
+      """
+      :returns: :data:`True` if the lease of a claimed job was reclaimed by
+                another instance. The job is stopped, and its output is left
+                to the new owner (which discarded the output of this
+                instance).
+      """
+      return self.leases is not None and not self.leases.owns( job )
+
+   def _started( self ):
+      """Count a job taken by a worker thread."""
+      with self._lock:
+         self.started += 1
+
+   def _stage( self, encoder, stage ):
+      """Start a processing step of a file."""
+      encoder.stage = stage
+      if self.metrics:
+         self.metrics.stage( encoder, stage )
+
+   def _slot( self, name ):
+      """Context of a step of a resource class, see :mod:`flacsync.steps`."""
+      return self.steps.slot( name ) if self.steps else steps.UNLIMITED
+
+   def _read( self, encoder ):
+      """Count the source bytes of an encoded file."""
+      size = budget.job_size( encoder )
+      with self._lock:
+         self.read_bytes += size
+
+   def _finish( self, encoder, encoded, ok, early=None ):
+      """
+      Tag and add cover art, after the audio encoding step.
 
-def get_dest_orphans( dest_dir, base_dir, sources ):
+      :param early: Result of the source tags, read by
+                    :meth:`flacsync.steps.Engine.prepare`.
+      """
+      analyze = self._opts.analyze_gain
+      failed = None if ok else 'encode'
+      held = False   # delivered to mirrors with the album gain
+      if encoded:
+         if early:
+            tags = early.get()
+         else:
+            tags = decoder.FlacDecoder(encoder.flac).tags
+         if encoder.track:
+            tags = encoder.track.merge_tags( tags )
+         if analyze:
+            self._set_track_gain( encoder, tags )
+         self._stage( encoder, 'tag' )
+         with self._slot( 'tag' ):
+            if encoder.tag( tags ) is False:
+               failed = failed or 'tag'
+         self._stage( encoder, 'cover' )
+         with self._slot( 'tag' ):
+            if encoder.set_cover(True, self._opts.art_resize) is False:
+               failed = failed or 'cover'
+         if encoder.fingerprints and not failed:
+            encoder.fingerprints.record( encoder )
+         if analyze and self._set_album_gain( encoder, tags ):
+            held = True
+      else: # update cover if newer
+         self._stage( encoder, 'cover' )
+         with self._slot( 'tag' ):
+            if encoder.set_cover(False, self._opts.art_resize) is False:
+               failed = failed or 'cover'
+      if not (failed or held):
+         self._deliver( [encoder] )
+      self._track_done( encoder, not failed )
+      self._record( encoder, failed, encoded or not ok )
+      if self.metrics:
+         self.metrics.finished( encoder, encoded, not failed )
+
+   def _failed( self, encoder, exc ):
+      """Handle an exception raised while processing a file."""
+      encoder.error = '%s: %s' % (exc.__class__.__name__, exc)
+      self._track_done( encoder, False )
+      self._record( encoder, encoder.stage or 'encode',
+                    encoder.stage in (None, 'encode', 'tag') )
+      if self.metrics:
+         self.metrics.finished( encoder, False, False )
+
+   def _record( self, encoder, stage, partial ):
+      """
+      Update the failure ledger. The output of a failed file is removed when
+      it may be partial or untagged, since an up-to-date output is skipped by
+      the next run.
+      """
+      if not stage:
+         if self.ledger:
+            self.ledger.clear( encoder )
+         return
+      if partial and os.path.exists( encoder.dst ):
+         os.remove( encoder.dst )
+      if self.ledger:
+         self.ledger.record( encoder, stage, encoder.error )
+
+   def _deliver( self, encoders ):
+      """Link or copy finished outputs to the mirror destinations."""
+      for e in encoders:
+         try:
+            e.deliver()
+         except (IOError, OSError) as exc:
+            print "ERROR: delivery of '%s' failed !!" % (e.dst,)
+            print exc
+
+   def _prepare( self, encoder ):
+      """Perform the shared work of the album, before the first track."""
+      album = self.albums.get( os.path.dirname(encoder.dst) )
+      if album:
+         album.prepare( self._opts.art_resize, self.covers )
+
+   def _track_done( self, encoder, ok ):
+      """Record track completion, and copy cover art once per album."""
+      if self.listener:
+         self.listener( encoder, ok )
+      album = self.albums.get( os.path.dirname(encoder.dst) )
+      if album is None:
+         if self._opts.art_copy:
+            encoder.copy_cover( self._opts.force )
+      elif album.finish( encoder, ok ):
+         if self._opts.art_copy:
+            album.copy_cover( self._opts.force )
+         # discard the encoder objects of the album jobs
+         for j in album.encoders:
+            j.release()
+
+   def _set_track_gain( self, encoder, tags ):
+      """Fill missing track replaygain tags from the measured loudness."""
+      if tags['rg_track_gain'] or not encoder.loudness:
+         return
+      gain = encoder.loudness.gain
+      if gain is not None:
+         tags['rg_track_gain'] = loudness.format_gain( gain )
+         tags['rg_track_peak'] = loudness.format_peak( encoder.loudness.peak )
+
+   def _set_album_gain( self, encoder, tags ):
+      """
+      Add the track loudness to its album. Once all tracks of the album are
+      complete, missing album replaygain tags are written to each track, and
+      the tracks are delivered to the mirror destinations.
+
+      :returns: :data:`True` if the track is delivered with its album.
+      """
+      if not encoder.loudness:
+         return False
+      track = None if tags['rg_album_gain'] else encoder
+      dir_ = os.path.dirname(encoder.src)
+      album = self._albums.add( dir_, track, encoder.loudness )
+      if album:
+         tracks,gain,peak = album
+         if gain is not None:
+            for e in tracks:
+               if e:
+                  e.set_album_gain( loudness.format_gain(gain),
+                                    loudness.format_peak(peak) )
+         self._deliver( e for e in tracks if e )
+         return track is not None
+      return track is not None and dir_ in self._albums
+
+
+def get_dest_orphans( dest_dir, base_dir, sources, images=False,
+                      shard=None ):
    """
    Return a list of destination files that have no matching source file.  Only
    consider files that match paths from source list (if any).
@@ -247,11 +787,20 @@ def get_dest_orphans( dest_dir, base_dir, sources ):
                      :data:`base_dir` for bulding a subset of all source files.
    :type  sources:   list
 
+   :param images:    When :data:`True`, files matching a track of a FLAC image
+                     are valid, see :func:`get_src_files`.
+   :type  images:    boolean
+
+   :param shard:     Only consider files in album directories of a shard.
+   :type  shard:     :class:`~flacsync.shard.Shard`
+
    :returns: List of orphan destination files.
    """
    orphans = []
    # walk all destination sub-directories
    for root, dirs, files in os.walk( dest_dir, followlinks=True ):
+      if root == dest_dir and util.STATE_DIR in dirs:
+         dirs.remove( util.STATE_DIR )
       orphans.extend( os.path.abspath(os.path.join(root,f)) for f in files )
 
    # remove files from destination not found under one (or more) paths from the
@@ -260,18 +809,37 @@ def get_dest_orphans( dest_dir, base_dir, sources ):
       # if absolute path, convert src filters to reference dest dir
       dests = (f.replace( base_dir, dest_dir, 1) for f in sources)
       orphans = (f for f in orphans for p in dests if f.startswith(p))
+   if shard:
+      orphans = shard.select( dest_dir, orphans )
 
    # remove all files with valid sources
-   orphans = (f for f in orphans if not
-         os.path.exists(
-            util.fname(f, base=dest_dir, new_base=base_dir, new_ext='.flac')) )
+   tracks = {}
+   def has_source( f ):
+      src = util.fname(f, base=dest_dir, new_base=base_dir, new_ext='.flac')
+      if os.path.exists(src):
+         return True
+      if images:
+         dir_ = os.path.dirname(src)
+         if dir_ not in tracks:
+            tracks[dir_] = cue.dir_tracks( dir_ )
+         return src in tracks[dir_]
+      return False
+   orphans = (f for f in orphans if not has_source(f))
    return orphans
 
 
-def del_dest_orphans( dest_dir, base_dir, sources ):
+def del_dest_orphans( dest_dir, base_dir, sources, images=False,
+                      shard=None, prune=True, policy='prompt', threads=1,
+                      trash=False ):
    """
-   Interactively prompt the user to remove all orphaned files located in the
-   destination file path(s).
+   Remove all orphaned files located in the destination file path(s), as
+   selected by an orphan policy:
+
+   * ``delete``: remove all orphans.
+   * ``prompt``: interactively prompt the user to select the orphans to
+     remove (or list them, if the input is not a terminal).
+   * ``list``: only print the orphans.
+   * ``keep``: ignore orphans.
 
    :param dest_dir:  Desintation root directory path, to find orpahned files.
    :type  dest_dir:  str
@@ -283,39 +851,76 @@ def del_dest_orphans( dest_dir, base_dir, sources ):
    :param sources:   List of 0 or more path strings, relative to
                      :data:`base_dir` for bulding a subset of all source files.
    :type  sources:   list
+
+   :param images:    When :data:`True`, files matching a track of a FLAC image
+                     are valid.
+   :type  images:    boolean
+
+   :param shard:     Only remove files in album directories of a shard.
+   :type  shard:     :class:`~flacsync.shard.Shard`
+
+   :param prune:     Remove empty directories. Disabled when other instances
+                     may be creating directories at the same time.
+   :type  prune:     boolean
+
+   :param policy:    Orphan policy, one of :data:`flacsync.orphan.POLICIES`.
+   :type  policy:    str
+
+   :param threads:   Number of threads removing files.
+   :type  threads:   int
+
+   :param trash:     Move orphans to a trash directory in the destination,
+                     see :func:`flacsync.orphan.trash_dir`.
+   :type  trash:     boolean
+
+   :returns: List of removed files.
    """
+   if policy == 'keep':
+      return []
+   if policy == 'prompt' and not sys.stdin.isatty():
+      print "WARN: can not prompt to remove orphans, see --orphans"
+      policy = 'list'
    # create list of orphans
-   orphans = get_dest_orphans( dest_dir, base_dir, sources )
-   yes_to_all = False
+   orphans = get_dest_orphans( dest_dir, base_dir, sources, images, shard )
+   if policy == 'list':
+      for o in orphans:
+         print "orphan: %s" % (o,)
+      return []
+   if policy == 'prompt':
+      orphans = _select_orphans( orphans )
+   removed = orphan.remove( orphans, threads, dest_dir,
+                            orphan.trash_dir(dest_dir) if trash else None )
+   if prune:
+      # remove empty directories from 'dest_dir'
+      orphan.prune( removed, dest_dir )
+   return removed
+
+
+def _select_orphans( orphans ):
+   orphans = iter(orphans)
+   selected = []
    for o in orphans:
-      rm = True
-      if not yes_to_all:
-         while True:
-            val = raw_input( "remove orphan `%s'? [YES,no,all,none]: " % (o,))
-            val = val.lower()
-            if val == 'none': return
-            elif val in ['a','all']:
-               yes_to_all = True
-               break
-            elif val in ['y','yes','']: break
-            elif val in ['n','no']:
-               rm = False
-               break
-      if rm:
-         os.remove(o)
-
-   # remove empty directories from 'dest_dir'
-   for root,dirs,files in os.walk(dest_dir, topdown=False):
-      if root != dest_dir:
-         try:
-            os.rmdir(root)   # remove dir
-         except OSError: pass
-
-
-def get_src_files( base_dir, sources ):
+      while True:
+         val = raw_input( "remove orphan `%s'? [YES,no,all,none]: " % (o,))
+         val = val.lower()
+         if val == 'none': return selected
+         elif val in ['a','all']:
+            return selected + [o] + list(orphans)
+         elif val in ['y','yes','']:
+            selected.append( o )
+            break
+         elif val in ['n','no']: break
+   return selected
+
+
+def get_src_files( base_dir, sources, cache=None, images=False ):
    """
    Return a list of source files for transcoding.
 
+   When :data:`images` is enabled, a FLAC image with a cue sheet is replaced by
+   one :class:`~flacsync.cue.TrackPath` per track, so that each track is
+   encoded as an independent job.
+
    :param base_dir:  Base directory of FLAC files.
    :type  base_dir:  str
 
@@ -323,14 +928,21 @@ def get_src_files( base_dir, sources ):
                      :data:`base_dir` for bulding a subset of all source files.
    :type  sources:   list
 
+   :param cache:     Optional scan cache; files located in directories that
+                     are unchanged since the previous run are not returned.
+   :type  cache:     :class:`~flacsync.scan.ScanCache`
+
+   :param images:    Split FLAC images into tracks.
+   :type  images:    boolean
+
    :returns: List of source files.
    """
+   if cache:
+      return _get_cached_src_files( base_dir, sources, cache, images )
    input_files = []
    # walk all sub-directories
    for root, dirs, files in os.walk( base_dir, followlinks=True ):
-      # filter flac files
-      flacs = (f for f in files if os.path.splitext(f)[1] == '.flac')
-      input_files.extend( os.path.abspath(os.path.join(root,f)) for f in flacs )
+      input_files.extend( _dir_src_files( root, files, images ) )
 
    # remove files not found under one (or more) paths from the source list
    if sources:
@@ -338,6 +950,162 @@ def get_src_files( base_dir, sources ):
    return input_files
 
 
+def get_query_files( tag_index, terms, sources, images=False ):
+   """
+   Return a list of source files for transcoding, selected by a tag query.
+   The source tree is not walked, and (unless :data:`images` is enabled) no
+   source file is read.
+
+   :param tag_index: Tag index of the base directory.
+   :type  tag_index: :class:`~flacsync.index.TagIndex`
+
+   :param terms:     List of query terms, see :func:`flacsync.index.parse_term`.
+   :type  terms:     list
+
+   :param sources:   List of 0 or more absolute paths, for bulding a subset of
+                     all source files.
+   :type  sources:   list
+
+   :param images:    Split FLAC images into tracks, see :func:`get_src_files`.
+   :type  images:    boolean
+
+   :returns: List of source files.
+   """
+   input_files = []
+   for f in tag_index.select( terms, sources ):
+      tracks = cue.find_tracks( f ) if images else []
+      if tracks:
+         input_files.extend( cue.TrackPath(t) for t in tracks )
+      else:
+         input_files.append( f )
+   return input_files
+
+
+def _get_cached_src_files( base_dir, sources, cache, images ):
+   input_files = []
+   for root, dirs, files, clean in cache.walk( base_dir ):
+      if clean:
+         continue
+      flacs = _dir_src_files( root, files, images )
+      if sources:
+         selected = [f for f in flacs for p in sources if f.startswith(p)]
+         # a partially selected dir can not be known to be up-to-date
+         if len(selected) != len(flacs):
+            cache.invalidate( root )
+         flacs = selected
+      input_files.extend( flacs )
+   return input_files
+
+
+def _dir_src_files( root, files, images ):
+   """Return the source files of a single directory listing."""
+   result = []
+   for f in files:
+      if os.path.splitext(f)[1] != '.flac':
+         continue
+      path = os.path.abspath(os.path.join(root,f))
+      tracks = cue.find_tracks( path, files ) if images else []
+      if tracks:
+         result.extend( cue.TrackPath(t) for t in tracks )
+      else:
+         result.append( path )
+   return result
+
+
+def get_jobs( work_obj, encoders, opts ):
+   """
+   Return the list of jobs for the worker pool. Long files are split into
+   segments when supported by the encoder, and are scheduled first so that
+   all workers stay busy until the end of the run.
+
+   :param work_obj: Processing unit of the jobs.
+   :type  work_obj: :class:`WorkUnit`
+
+   :param encoders: List of pending :class:`~flacsync.job.Job` objects.
+   :type  encoders: list
+
+   :param opts:   Parsed command-line options.
+   :type  opts:   :mod:`optparse`.Values
+
+   :returns: List of (function, args) tuples.
+   """
+   split,single = [],[]
+   # segments bypass the PCM pipe, so they are not used with pipe options
+   can_split = opts.split_time and not (opts.analyze_gain or opts.max_rate or
+                                        opts.max_bits)
+   for e in encoders:
+      count = 1
+      if can_split and e.SEGMENTS:
+         count = e.split( opts.split_time, opts.thread_count, opts.force )
+      if count > 1:
+         split.extend( (work_obj.do_segment, (e,i,count))
+                        for i in range(count) )
+      else:
+         single.append( (work_obj.do_work, (e,)) )
+   return split + single
+
+
+def get_full_albums( encoders, images=False ):
+   """
+   Return the album directories where all FLAC files will be encoded.
+
+   :param encoders: List of pending :class:`~flacsync.job.Job` objects.
+   :type  encoders: list
+
+   :param images:   Count each track of a FLAC image as a separate file.
+   :type  images:   boolean
+
+   :returns: Dictionary mapping album directory to track count.
+   """
+   pending = {}
+   for e in encoders:
+      dir_ = os.path.dirname(e.src)
+      pending[dir_] = pending.get(dir_,0) + 1
+   albums = {}
+   for dir_,count in pending.items():
+      flacs = _dir_src_files( dir_, os.listdir(dir_), images )
+      if count == len(flacs):
+         albums[dir_] = count
+   return albums
+
+
+def get_albums( encoders, opts ):
+   """
+   Group the pending jobs into albums, for the shared album work.
+
+   In a cooperative sync (``--cooperate``), the tracks of an album are
+   claimed by several instances, so that no instance completes the album.
+   The album work (i.e. the cover copy of ``-j``) is then done for each
+   track, and the jobs are not grouped.
+
+   :param encoders: List of pending :class:`~flacsync.job.Job` objects.
+   :type  encoders: list
+
+   :param opts:     Parsed command-line options.
+   :type  opts:     :mod:`optparse`.Values
+
+   :returns: Dictionary mapping destination directory to
+             :class:`~flacsync.album.Album`, see :func:`flacsync.album.group`.
+   """
+   if opts.cooperate:
+      return {}
+   return album.group( encoders )
+
+
+def get_partial_albums( albums ):
+   """
+   Return the albums where one or more tracks failed, or were not processed.
+
+   :param albums: List of album objects.
+   :type  albums: list
+
+   :returns: List of :class:`~flacsync.album.Album` objects, sorted by
+             directory.
+   """
+   partial = (a for a in albums if a.failed or not a.complete)
+   return sorted( partial, key=lambda a: a.dir )
+
+
 def normalize_sources( base_dir, sources ):
    """
    Convert all source paths to absolute path, and remove non-existent paths.
@@ -465,25 +1233,42 @@ def get_opts( argv ):
          action="store_true", help=_help_str(helpstr) )
 
    helpstr = """
-      select the output transcode format; supported values are 'aac','ogg'
-      [default:%s]""" % (DEFAULT_ENCODER,)
-   # note: the default encoder is enforced manually
-   parser.add_option( '-t', '--type', choices=ENCODERS.keys(),
-         action='callback', callback=store_once,
-         type='choice', dest='enc_type', help=_help_str(helpstr))
+      select the output transcode format; supported values are %s, or the
+      name of an encoder plugin [default:%s]""" % (
+            ','.join("'%s'" % (k,) for k in ENCODERS.keys()), DEFAULT_ENCODER,)
+   # note: the default encoder is enforced manually, and checked after
+   # parsing, since plugins are only looked up by name
+   parser.add_option( '-t', '--type', action='callback', callback=store_once,
+         type='string', dest='enc_type', help=_help_str(helpstr))
+
+   helpstr = """
+      select the handling of files and directories in the dest dir that have
+      no corresponding source file; supported values are 'delete' (remove
+      all), 'keep', 'prompt' (ask for each file) or 'list' (print only)
+      [default:%default]"""
+   parser.add_option( '--orphans', dest='orphans', default='prompt',
+         type='choice', choices=orphan.POLICIES, metavar='POLICY',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      same as --orphans=keep"""
+   parser.add_option( '-o', '--ignore-orphans', dest='orphans',
+         action="store_const", const='keep', help=_help_str(helpstr) )
 
    helpstr = """
-      prevent the removal of files and directories in the dest dir that have no
-      corresponding source file"""
-   parser.add_option( '-o', '--ignore-orphans', dest='del_orphans',
-         default=True, action="store_false", help=_help_str(helpstr) )
+      move removed orphans to a trash directory in the dest dir (%s/%s),
+      instead of deleting them""" % (util.STATE_DIR, orphan.TRASH_DIR)
+   parser.add_option( '--trash', dest='trash', default=False,
+         action="store_true", help=_help_str(helpstr) )
 
    helpstr = """
       define alternate destination output directory to override the default.
       The standard default destination directory will be created in the same
-      parent directory of BASE_DIR. See BASE_DIR above."""
-   parser.add_option( '-d', '--destination', dest='dest_dir',
-         help=_help_str(helpstr) )
+      parent directory of BASE_DIR. See BASE_DIR above. May be used multiple
+      times; files are encoded once to the first directory, then linked or
+      copied to the others."""
+   parser.add_option( '-d', '--destination', dest='dest_dir', default=[],
+         action='append', help=_help_str(helpstr) )
 
    helpstr = """
       enable resizing of cover art; by default the art that is found will be
@@ -497,6 +1282,217 @@ def get_opts( argv ):
    parser.add_option( '-j', '--copy-cover-art', dest='art_copy', default=False,
          action="store_true", help=_help_str(helpstr) )
 
+   helpstr = """
+      cache the state of source directories in the destination, and skip
+      directories that are unchanged since the previous run without reading
+      their contents"""
+   parser.add_option( '--scan-cache', dest='scan_cache', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      with --scan-cache, force a full scan of all source directories every N
+      runs, which also re-creates the outputs deleted from unchanged
+      directories; 0 to disable [default:%default]"""
+   parser.add_option( '--deep-scan', dest='deep_scan', default=10,
+         type='int', metavar='N', help=_help_str(helpstr) )
+
+   helpstr = """
+      measure the loudness of the decoded audio during encoding, and add
+      ReplayGain 2.0 track and album values to files without replaygain tags
+      (requires numpy)"""
+   parser.add_option( '--analyze-gain', dest='analyze_gain', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      convert audio with a higher sample rate to a rate below HZ (i.e.
+      192000 -> 48000) before encoding (requires numpy)"""
+   parser.add_option( '--max-rate', dest='max_rate', type='int',
+         metavar='HZ', help=_help_str(helpstr) )
+
+   helpstr = """
+      dither audio with more bits per sample to BITS before encoding; supported
+      values are 16, 24 (requires numpy)"""
+   parser.add_option( '--max-bits', dest='max_bits', type='choice',
+         choices=['16','24'], metavar='BITS', help=_help_str(helpstr) )
+
+   helpstr = """
+      split files longer than SECS into segments that are encoded in
+      parallel; only supported by the 'mp3' encoder, and not used with
+      --analyze-gain, --max-rate or --max-bits; 0 to disable
+      [default:%default]"""
+   parser.add_option( '--split-time', dest='split_time', default=0,
+         type='int', metavar='SECS', help=_help_str(helpstr) )
+
+   helpstr = """
+      split single file FLAC images with a cue sheet (a sidecar .cue file, or an
+      embedded CUESHEET block) into one output file per track; the tracks are
+      encoded in parallel"""
+   parser.add_option( '--cue', dest='cue_split', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      only sync album directories of shard I of N (i.e. 1/3), selected by a
+      stable hash of the directory path, to divide one sync between N hosts
+      sharing the same source and destination dirs"""
+   parser.add_option( '--shard', dest='shard', metavar='I/N',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      check that every shard of a previous --shard sync completed, then sync
+      the whole source dir to pick up any remaining work"""
+   parser.add_option( '--merge-shards', dest='merge_shards', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      claim files through lease files in the dest dir, so that several
+      instances (i.e. on different hosts) can sync the same source and
+      destination dirs at once; files claimed by an instance that stops
+      responding are reclaimed after %d seconds""" % (lease.EXPIRY,)
+   parser.add_option( '--cooperate', dest='cooperate', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      read the source files of the next K jobs into memory ahead of the
+      encoders, to avoid disk seeks between parallel decoders on slow storage
+      (i.e. USB disks, network mounts); not used with --cooperate; 0 to
+      disable [default:%default]"""
+   parser.add_option( '--prefetch', dest='prefetch', default=0,
+         type='int', metavar='K', help=_help_str(helpstr) )
+
+   helpstr = """
+      with --prefetch, max size of source files read ahead of the encoders
+      [default:%default]"""
+   parser.add_option( '--prefetch-mem', dest='prefetch_mem', default=256,
+         type='int', metavar='MB', help=_help_str(helpstr) )
+
+   helpstr = """
+      read the source tags and prepare the cover art of a file while it is
+      encoded, and keep twice as many files in flight as --threads; the
+      decode, encode and tag steps are each limited to --threads at a time"""
+   parser.add_option( '--concurrent-steps', dest='concurrent_steps',
+         default=False, action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      stop starting new files once the estimated encoding time of the next
+      file does not fit in the remaining TIME (i.e. 3h, 1h30m, 90m); files
+      in progress are completed, and the remaining files are encoded first
+      by the next run (exit status %d)""" % (budget.EXIT_DEFERRED,)
+   parser.add_option( '--time-budget', dest='time_budget', metavar='TIME',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      select the order of encoding; supported values are 'path', 'newest'
+      (newest source file first), 'smallest' (smallest source file first),
+      'disk' (physical location of the source file on disk, for spinning
+      disks) [default:%default]"""
+   parser.add_option( '--priority', dest='priority', default='path',
+         type='choice', choices=sorted(budget.POLICIES.keys()),
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      run encoders at idle CPU and I/O priority, and pause encoding threads
+      while the system is busy (see --max-load, --max-pressure,
+      --min-free-mem)"""
+   parser.add_option( '--background', dest='background', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      with --background, max 1 minute load average, not counting the files
+      being encoded [default:%default]"""
+   parser.add_option( '--max-load', dest='max_load', default=float(CORES),
+         type='float', metavar='LOAD', help=_help_str(helpstr) )
+
+   helpstr = """
+      with --background, max CPU and I/O pressure (Linux PSI, percent of time
+      tasks are stalled) [default:%default]"""
+   parser.add_option( '--max-pressure', dest='max_pressure', default=40.0,
+         type='float', metavar='PCT', help=_help_str(helpstr) )
+
+   helpstr = """
+      with --background, min available memory [default:%default]"""
+   parser.add_option( '--min-free-mem', dest='min_free_mem', default=512,
+         type='int', metavar='MB', help=_help_str(helpstr) )
+
+   helpstr = """
+      retry files that failed in previous runs; by default a failed file is
+      skipped until the source file changes, or its retry delay expires
+      (starting at %dh, doubled after each failure)""" % (
+            ledger.BACKOFF // 3600,)
+   parser.add_option( '--retry-failed', dest='retry_failed', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      update the tag index of the source files (stored in BASE_DIR); only new
+      or changed files are read"""
+   parser.add_option( '--update-index', dest='update_index', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      only sync source files with tags matching EXPR (i.e. 'genre=Jazz',
+      'artist~davis|coltrane' or 'rating>=4'), looked up in the tag index;
+      may be used multiple times to match all expressions"""
+   parser.add_option( '--query', dest='query', default=[], action='append',
+         metavar='EXPR', help=_help_str(helpstr) )
+
+   helpstr = """
+      check the structure and duration of existing output files (without
+      decoding the audio), and re-encode the files that are truncated or
+      damaged"""
+   parser.add_option( '--verify', dest='verify', default=False,
+         action="store_true", help=_help_str(helpstr) )
+
+   helpstr = """
+      after the sync, write the changes of the dest dir since the last export
+      to the --device (new and changed files, and a list of deleted files) to
+      the bundle file BUNDLE"""
+   parser.add_option( '--export', dest='export', metavar='BUNDLE',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      name of the device of --export [default:%default]"""
+   parser.add_option( '--device', dest='device', default='device',
+         metavar='NAME', help=_help_str(helpstr) )
+
+   helpstr = """
+      write the --export bundle from the bundle ID last applied to the device
+      (see the error of --apply-bundle), when later bundles were lost"""
+   parser.add_option( '--export-base', dest='export_base', metavar='ID',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      apply the bundle file BUNDLE of --export to a device; BASE_DIR is the
+      root dir of the device, and no files are encoded"""
+   parser.add_option( '--apply-bundle', dest='apply_bundle', metavar='BUNDLE',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      run a sync service on the Unix socket SOCKET, that keeps the source
+      directory index, cover thumbnails and encoding threads between syncs;
+      syncs of SOURCE paths are requested with --submit, and orphans are not
+      removed"""
+   parser.add_option( '--serve', dest='serve', metavar='SOCKET',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      request a sync of the SOURCE paths from the service of --serve on
+      SOCKET, and print its progress; with --background, the request waits
+      for the interactive requests"""
+   parser.add_option( '--submit', dest='submit', metavar='SOCKET',
+         help=_help_str(helpstr) )
+
+   helpstr = """
+      serve the live metrics of the sync (or the service) on
+      http://127.0.0.1:PORT/metrics, in the OpenMetrics format"""
+   parser.add_option( '--metrics-port', dest='metrics_port', type='int',
+         metavar='PORT', help=_help_str(helpstr) )
+
+   helpstr = """
+      write the live metrics of the sync (or the service) to the file PATH
+      every %ds, for the textfile collector of the Prometheus node
+      exporter""" % (metrics.INTERVAL,)
+   parser.add_option( '--metrics-file', dest='metrics_file', metavar='PATH',
+         help=_help_str(helpstr) )
+
    # AAC only options
    aac_group = op.OptionGroup( parser, "AAC Encoder Options" )
    helpstr = """
@@ -533,10 +1529,68 @@ def get_opts( argv ):
       print "ERROR: BASE_DIR not defined !!"
       sys.exit(-1)
 
+   if opts.analyze_gain and not loudness.available():
+      print "ERROR: --analyze-gain requires the numpy package !!"
+      sys.exit(-1)
+   if (opts.max_rate or opts.max_bits) and not resample.available():
+      print "ERROR: --max-rate/--max-bits requires the numpy package !!"
+      sys.exit(-1)
+   if opts.max_bits:
+      opts.max_bits = int(opts.max_bits)
+   if opts.time_budget:
+      try:
+         opts.time_budget = budget.parse_duration( opts.time_budget )
+      except ValueError as exc:
+         print "ERROR: %s !!" % (exc,)
+         sys.exit(-1)
+   for term in opts.query:
+      try:
+         index.parse_term( term )
+      except ValueError as exc:
+         print "ERROR: %s !!" % (exc,)
+         sys.exit(-1)
+   if opts.cooperate and opts.force:
+      print "ERROR: --cooperate can not be used with --force !!"
+      sys.exit(-1)
+   if opts.serve and (opts.submit or opts.cooperate or opts.shard or
+                      opts.merge_shards or opts.verify or opts.time_budget or
+                      opts.export or opts.apply_bundle or
+                      opts.concurrent_steps):
+      print "ERROR: --serve can not be used with --submit, --cooperate," \
+            " --shard, --merge-shards, --verify, --time-budget, --export," \
+            " --apply-bundle or --concurrent-steps !!"
+      sys.exit(-1)
+   if (opts.metrics_port or opts.metrics_file) and (opts.submit or
+                                                    opts.apply_bundle):
+      print "ERROR: --metrics-port and --metrics-file can not be used with" \
+            " --submit or --apply-bundle !!"
+      sys.exit(-1)
+   if opts.metrics_file:
+      opts.metrics_file = os.path.abspath( opts.metrics_file )
+   if not bundle.DEVICE.match( opts.device ):
+      print "ERROR: invalid device name '%s' !!" % (opts.device,)
+      sys.exit(-1)
+   if opts.export_base and not opts.export:
+      print "ERROR: --export-base requires --export !!"
+      sys.exit(-1)
+   if opts.shard:
+      if opts.merge_shards:
+         print "ERROR: --shard can not be used with --merge-shards !!"
+         sys.exit(-1)
+      try:
+         opts.shard = shard.parse( opts.shard )
+      except ValueError as exc:
+         print "ERROR: %s !!" % (exc,)
+         sys.exit(-1)
+
    # check/set encoder
    if not opts.enc_type:
       opts.enc_type = DEFAULT_ENCODER
-   opts.EncClass = ENCODERS[opts.enc_type]
+   try:
+      opts.EncClass = ENCODERS[opts.enc_type]
+   except KeyError as exc:
+      print "ERROR: unknown encoder type %s !!" % (exc,)
+      sys.exit(-1)
 
    # handle positional arguments
    opts.base_dir = os.path.abspath(args[0])
@@ -547,12 +1601,230 @@ def get_opts( argv ):
       sys.exit(-1)
 
    # set default destination directory, if not already defined
-   if not opts.dest_dir:
-      opts.dest_dir = os.path.join(os.path.dirname(opts.base_dir),opts.enc_type)
-   opts.dest_dir = os.path.abspath(opts.dest_dir)
+   dests = [os.path.abspath(d) for d in opts.dest_dir]
+   if not dests:
+      dests = [os.path.join(os.path.dirname(opts.base_dir),opts.enc_type)]
+   opts.dest_dir = dests[0]
+   # additional destinations, filled from the first one
+   opts.mirrors = []
+   for d in dests[1:]:
+      if d not in opts.mirrors + [opts.dest_dir]:
+         opts.mirrors.append( d )
    return opts
 
 
+def export_bundle( opts ):
+   """
+   Write the changes of the destination since the last export to the device
+   to a bundle file, see :func:`flacsync.bundle.export`.
+
+   :param opts:   Parsed command-line options.
+   :type  opts:   :mod:`optparse`.Values
+   """
+   try:
+      files,deleted,size = bundle.export( opts.export, opts.dest_dir,
+                                          opts.device, opts.export_base )
+   except (ValueError, IOError, OSError) as exc:
+      print "ERROR: bundle '%s' not written, %s !!" % (opts.export, exc)
+      sys.exit(-1)
+   print "bundle: %d files (%d MB) and %d deletions for device '%s'" % (
+         files, size >> 20, deleted, opts.device)
+
+
+def apply_bundle( opts ):
+   """
+   Apply a bundle file to the device in BASE_DIR, see
+   :func:`flacsync.bundle.apply`.
+
+   :param opts:   Parsed command-line options.
+   :type  opts:   :mod:`optparse`.Values
+   """
+   try:
+      files,deleted = bundle.apply( opts.apply_bundle, opts.base_dir,
+                                    opts.force, opts.thread_count )
+   except (ValueError, IOError, OSError) as exc:
+      print "ERROR: bundle '%s' not applied, %s !!" % (opts.apply_bundle, exc)
+      sys.exit(-1)
+   print "bundle: %d files written, %d deleted" % (files, deleted)
+
+
+def serve( opts ):
+   """
+   Run a sync service on the socket of ``--serve``, until interrupted, see
+   :mod:`flacsync.service`. Each request is synced like a run of
+   :func:`main` with the SOURCE paths of the request, but the source
+   directories are only scanned if they changed since the previous request,
+   and cover thumbnails are converted once.
+
+   :param opts:   Parsed command-line options.
+   :type  opts:   :mod:`optparse`.Values
+   """
+   enc_opts = _enc_opts( opts )
+   fingerprints = fingerprint.Fingerprints( opts.dest_dir,
+         fingerprint.fingerprint( opts.enc_type, enc_opts, opts.max_rate,
+                                  opts.max_bits ))
+   failures = ledger.Ledger( opts.base_dir, opts.dest_dir )
+   path = os.path.join( opts.dest_dir, util.STATE_DIR, service.SCAN_FILE )
+   if fingerprints.last != fingerprints.current and os.path.exists( path ):
+      # outputs in clean dirs must be checked against new encoder settings
+      os.remove( path )
+   cache = scan.ScanCache( path )
+   covers = album.CoverCache()
+   live = metrics.Metrics( opts.enc_type )
+   live.covers = covers
+   lock = threading.Lock()
+   active = set()   # files of the running requests
+   planned = {}
+
+   def plan( request ):
+      # the client sends each SOURCE path relative to the current dir and
+      # to BASE_DIR, see normalize_sources
+      sources = [os.path.abspath(s) for s in request.sources]
+      if sources:
+         sources = [s for s in sources if os.path.exists(s)]
+         if not sources:
+            raise ValueError( "'%s' is not a valid path" %
+                              ("', or '".join(request.sources),) )
+      for s in sources:
+         if not (s + os.sep).startswith( opts.base_dir + os.sep ):
+            raise ValueError( "'%s' is not in '%s'" % (s, opts.base_dir) )
+      # only scan the selected directories
+      cache.deep = request.deep
+      flacs = []
+      for s in sources or [opts.base_dir]:
+         top = s if os.path.isdir( s ) else os.path.dirname( s )
+         flacs.extend( get_src_files( top, [s], cache, opts.cue_split ) )
+      flacs = sorted( set(flacs) )
+      plan_ = job.Plan( opts.EncClass, base_dir=opts.base_dir,
+            dest_dir=opts.dest_dir, fingerprints=fingerprints,
+            mirrors=opts.mirrors, **enc_opts )
+      encoders = list( job.pending((plan_.add(f) for f in flacs),
+                                   opts.force) )
+      live.count( 'files', plan_.count - len(encoders), result='skipped' )
+      if not opts.retry_failed:
+         encoders = [e for e in encoders if not failures.skip(e)]
+      with lock:
+         # files of another running request are not encoded twice
+         encoders = [e for e in encoders if e.src not in active]
+         active.update( e.src for e in encoders )
+         planned[request.id] = [e.src for e in encoders]
+      for e in encoders:
+         cache.invalidate( os.path.dirname(e.src) )
+      cache.commit()
+      encoders = budget.order( encoders, opts.priority, [],
+            set(e.src for e in encoders if e.changed) )
+      albums = None
+      if opts.analyze_gain:
+         albums = get_full_albums( encoders, opts.cue_split )
+      work_obj = WorkUnit( opts, len(encoders), albums )
+      work_obj.albums = get_albums( encoders, opts )
+      work_obj.ledger = failures
+      work_obj.covers = covers
+      work_obj.listener = request.file_done
+      work_obj.metrics = live
+      request.files = len(encoders)
+      return work_obj, get_jobs( work_obj, encoders, opts )
+
+   def finish( request ):
+      with lock:
+         active.difference_update( planned.pop(request.id, []) )
+         failures.save()
+         fingerprints.save()
+
+   if opts.background:
+      throttle.set_idle_priority()
+   server = service.Service( opts.serve, opts.thread_count, plan, finish )
+   live.queue_depth = lambda: server.depth
+   exporter = _start_metrics( opts, live )
+   try:
+      server.start()
+   except (ValueError, socket.error) as exc:
+      print "ERROR: service not started, %s !!" % (exc,)
+      sys.exit(-1)
+   print "serving '%s' on '%s'" % (opts.base_dir, opts.serve)
+   # stop cleanly when the service is stopped by the system
+   signal.signal( signal.SIGTERM, lambda *args: sys.exit(0) )
+   try:
+      while True:
+         time.sleep( 1 )
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.stop()
+      if exporter:
+         exporter.stop()
+      cache.save()
+      failures.save()
+      fingerprints.save()
+      print "cover thumbnails: %d converted, %d cached" % (covers.misses,
+                                                           covers.hits)
+
+
+def submit_sync( opts ):
+   """
+   Request a sync of the SOURCE paths from the service on the socket of
+   ``--submit``, and print its progress, see :func:`serve`.
+
+   :param opts:   Parsed command-line options.
+   :type  opts:   :mod:`optparse`.Values
+   """
+   priority = 'background' if opts.background else 'interactive'
+   done = None
+   try:
+      for event in service.submit( opts.submit, opts.sources, priority ):
+         kind = event['event']
+         if kind == 'error':
+            print "ERROR: %s !!" % (event['message'],)
+            sys.exit(-1)
+         elif kind == 'queued':
+            print "request %d queued (%s)%s" % (event['id'],
+                  event['priority'], ", joined an identical request"
+                  if event['coalesced'] else '')
+         elif kind == 'start':
+            print "request %d: %d files to encode" % (event['id'],
+                                                      event['files'])
+         elif kind == 'file':
+            print "%-6s %s" % ('ok' if event['ok'] else 'FAILED',
+                               event['src'].encode('utf-8'))
+         elif kind == 'done':
+            done = event
+   except socket.error as exc:
+      print "ERROR: no service on '%s', %s !!" % (opts.submit, exc)
+      sys.exit(-1)
+   if done is None:
+      print "ERROR: request not finished, the service stopped !!"
+      sys.exit(-1)
+   print "request %d: %d files encoded, %d failed" % (done['id'],
+         done['encoded'], done['failed'])
+
+
+def _start_metrics( opts, live ):
+   # :returns: running Exporter of --metrics-port/--metrics-file, or None
+   if not (opts.metrics_port or opts.metrics_file):
+      return None
+   exporter = metrics.Exporter( live, opts.metrics_port, opts.metrics_file )
+   try:
+      exporter.start()
+   except socket.error as exc:
+      print "ERROR: metrics not served on port %d, %s !!" % (
+            opts.metrics_port, exc)
+      sys.exit(-1)
+   return exporter
+
+
+def _enc_opts( opts ):
+   # options of the selected encoder, i.e. 'aac_q'
+   return dict((k,v) for k,v in vars(opts).iteritems()
+               if k.startswith(opts.enc_type))
+
+
+def _discard( job ):
+   """Remove the output of a job, that may be partial."""
+   try:
+      os.remove( job.dst )
+   except OSError: pass  # ignore if file does not exist
+
+
 def _help_str( text ):
    return textwrap.dedent(text).strip()
 
@@ -563,35 +1835,226 @@ def main( argv=None ):
 
    :param argv: The command-line argument list
    :type  argv: list
+
+   :returns: :data:`~flacsync.budget.EXIT_DEFERRED` if files were deferred
+             to the next run by ``--time-budget``.
    """
+   start = time.time()
    opts = get_opts( argv )
+   if opts.apply_bundle:
+      apply_bundle( opts )
+      return
+   if opts.submit:
+      submit_sync( opts )
+      return
+   if opts.serve:
+      serve( opts )
+      return
+   enc_opts = _enc_opts( opts )
+   fingerprints = fingerprint.Fingerprints( opts.dest_dir,
+         fingerprint.fingerprint( opts.enc_type, enc_opts, opts.max_rate,
+                                  opts.max_bits ))
    # use base dir and input filter to locate all input files
-   flacs = get_src_files( opts.base_dir, opts.sources )
-
-   # convert files to encoder objects
-   enc_opts = dict((k,v) for k,v in vars(opts).iteritems()
-                  if k.startswith(opts.enc_type))
-   encoders = (opts.EncClass( src=f, base_dir=opts.base_dir,
-                  dest_dir=opts.dest_dir, **enc_opts) for f in flacs)
+   cache = None
+   if opts.scan_cache and not (opts.force or opts.query):
+      name = 'scan.json'
+      if opts.shard:
+         name = 'scan-%d-of-%d.json' % (opts.shard.index, opts.shard.count)
+      if opts.mirrors:
+         # a clean dir is only clean for the same set of mirrors
+         name = name.replace( '.json', '-%s.json' %
+               (hashlib.md5('\0'.join(opts.mirrors)).hexdigest()[:8],))
+      cache = scan.ScanCache( os.path.join(opts.dest_dir, util.STATE_DIR, name),
+            opts.deep_scan )
+      # outputs in clean dirs must be checked against new encoder settings,
+      # or verified
+      if fingerprints.last != fingerprints.current or opts.verify:
+         cache.deep = True
+   if opts.update_index or opts.query:
+      path = os.path.join( opts.base_dir, util.STATE_DIR, index.INDEX_FILE )
+      if not (opts.update_index or os.path.exists(path)):
+         print "ERROR: no tag index found, see --update-index !!"
+         sys.exit(-1)
+      tag_index = index.TagIndex( opts.base_dir )
+      if opts.update_index:
+         print "tag index: %d files updated, %d removed" % (
+               tag_index.update( opts.thread_count ))
+   if opts.query:
+      flacs = get_query_files( tag_index, opts.query, opts.sources,
+                               opts.cue_split )
+   else:
+      flacs = get_src_files( opts.base_dir, opts.sources, cache,
+                             opts.cue_split )
+   if opts.update_index or opts.query:
+      tag_index.close()
+   if opts.shard:
+      flacs = opts.shard.select( opts.base_dir, flacs )
+   if opts.merge_shards:
+      for s in shard.merge( opts.dest_dir ):
+         print "WARN: shard %s did not complete" % (s,)
+
+   # convert files to compact job records; an encoder object is only kept
+   # while a job is dispatched
+   plan = job.Plan( opts.EncClass, base_dir=opts.base_dir,
+         dest_dir=opts.dest_dir, fingerprints=fingerprints,
+         mirrors=opts.mirrors, **enc_opts )
+   encoders = (plan.add(f) for f in flacs)
+   # remove damaged outputs, so that they are re-encoded
+   if opts.verify and not opts.force:
+      encoders = list(encoders)
+      damaged = verify.verify( [e for e in encoders if not e.is_stale()],
+            opts.thread_count )
+      for e,problem in damaged:
+         print "WARN: '%s' is damaged, %s" % (e.dst, problem)
+         os.remove( e.dst )
+      print "verify: %d damaged files are re-encoded" % (len(damaged),)
    # filter out encoders that are unnecessary
-   if not opts.force:
-      encoders = (e for e in encoders if not e.skip_encode())
-   encoders = list(encoders)
+   encoders = list( job.pending(encoders, opts.force) )
+   live = metrics.Metrics( opts.enc_type )
+   live.count( 'files', plan.count - len(encoders), result='skipped' )
+   del flacs
+   exporter = _start_metrics( opts, live )
+
+   # only dirs without pending work are clean for the next run
+   if cache:
+      for e in encoders:
+         cache.invalidate( os.path.dirname(e.src) )
+      cache.save()
+
+   # skip files that failed in previous runs
+   failures = ledger.Ledger( opts.base_dir, opts.dest_dir )
+   if not opts.retry_failed:
+      count = len(encoders)
+      encoders = [e for e in encoders if not failures.skip(e)]
+      if count > len(encoders):
+         print "skipping %d files that failed before, see --retry-failed" % (
+               count - len(encoders),)
 
    # remove orphans, if defined
-   if opts.del_orphans:
-      del_dest_orphans( opts.dest_dir, opts.base_dir, opts.sources)
+   if opts.orphans != 'keep':
+      for dest in [opts.dest_dir] + opts.mirrors:
+         removed = del_dest_orphans( dest, opts.base_dir, opts.sources,
+               opts.cue_split, opts.shard, not (opts.shard or opts.cooperate),
+               opts.orphans, opts.thread_count, opts.trash )
+         if removed:
+            print "removed %d orphans from '%s'" % (len(removed), dest)
 
    # exit if no work
-   if not encoders: return
+   if not encoders:
+      if opts.shard:
+         opts.shard.write_manifest( opts.dest_dir, 0 )
+      budget.save_deferred( opts.base_dir, opts.dest_dir, [] )
+      fingerprints.save()
+      if opts.export:
+         export_bundle( opts )
+      if exporter:
+         exporter.stop()
+      return
+
+   # files deferred by the previous run are encoded first, and files only
+   # re-encoded for new encoder settings last
+   changed = set( e.src for e in encoders if e.changed )
+   if changed:
+      print "%d files are re-encoded for changed encoder settings" % (
+            len(changed),)
+   encoders = budget.order( encoders, opts.priority,
+         budget.load_deferred(opts.base_dir, opts.dest_dir), changed )
+
+   # find albums where every track is (re)encoded, for album gain
+   albums = None
+   if opts.analyze_gain:
+      albums = get_full_albums( encoders, opts.cue_split )
 
    # create work pool, and add jobs
-   queue = mp.Pool( processes=opts.thread_count )
-   work_obj = WorkUnit( opts, len(encoders) )
-   for e in encoders:
-      queue.apply_async( work_obj.do_work, (e,) )
+   if opts.background:
+      throttle.set_idle_priority()
+   workers = opts.thread_count
+   if opts.concurrent_steps:
+      workers *= steps.WORKERS
+   queue = mp.Pool( processes=workers )
+   run_start = time.time()
+   work_obj = WorkUnit( opts, len(encoders), albums )
+   if opts.concurrent_steps:
+      limit = opts.thread_count
+      work_obj.steps = steps.Engine( dict.fromkeys(steps.CLASSES, limit),
+                                     limit )
+   work_obj.albums = get_albums( encoders, opts )
+   work_obj.ledger = failures
+   if opts.time_budget:
+      # the budget starts with the run, including the source scan
+      work_obj.budget = budget.Budget( opts.time_budget - (time.time()-start) )
+   if opts.background:
+      work_obj.throttle = throttle.Throttle( workers, opts.max_load,
+            opts.max_pressure, opts.min_free_mem )
+      work_obj.throttle.start()
+   jobs = [] if opts.cooperate else get_jobs( work_obj, encoders, opts )
+   work_obj.metrics = live
+   live.queue_depth = lambda: max( len(jobs) - work_obj.started, 0 )
+   prefetcher = None
+   if opts.prefetch and jobs:
+      prefetcher = prefetch.Prefetcher( [args[0].flac for _,args in jobs],
+            opts.prefetch, opts.prefetch_mem << 20 )
+      prefetcher.start()
+      work_obj.prefetcher = prefetcher
+   leases = None
+   if opts.cooperate:
+      leases = lease.LeaseQueue(
+            os.path.join(opts.dest_dir, util.STATE_DIR, 'leases'), encoders,
+            key=lambda e: os.path.relpath(e.dst, opts.dest_dir),
+            is_done=lambda e: e.skip_encode(), discard=_discard )
+      leases.start()
+      for _ in range(workers):
+         queue.apply_async( work_obj.do_claimed, (leases,) )
+   else:
+      for func,args in jobs:
+         queue.apply_async( func, args )
    try:
       queue.close()
       queue.join()
    except KeyboardInterrupt:
       work_obj.abort = True
+   finally:
+      if leases:
+         leases.stop()
+      if prefetcher:
+         prefetcher.stop()
+         print prefetcher.report()
+      if work_obj.throttle:
+         work_obj.throttle.stop()
+         print work_obj.throttle.report()
+      if work_obj.steps:
+         work_obj.steps.close()
+      if exporter:
+         exporter.stop()
+      failures.save()
+      fingerprints.save()
+   elapsed = time.time() - run_start
+   if work_obj.read_bytes and elapsed > 0 and not work_obj.abort:
+      # compare the source read rate to runs with other job orders
+      rate = work_obj.read_bytes / elapsed
+      others = budget.save_throughput( opts.dest_dir, opts.priority, rate )
+      print "source read: %d MB in %ds, %.1f MB/s (%s order)" % (
+            work_obj.read_bytes >> 20, elapsed, rate / (1 << 20),
+            opts.priority)
+      for p,r in sorted( others.items() ):
+         print "   last run in %s order: %.1f MB/s" % (p, r / (1 << 20))
+   if failures.failed:
+      print "%d files failed, see '%s'" % (failures.failed, failures.path)
+   # other instances encode the remaining tracks of a cooperative sync
+   if not opts.cooperate:
+      for a in get_partial_albums( work_obj.albums.values() ):
+         print "WARN: album '%s' is incomplete, %d of %d tracks not encoded" % (
+               a.dir, len(a.encoders) - a.done + len(a.failed), len(a.encoders))
+   deferred = work_obj.budget.deferred if work_obj.budget else []
+   if not work_obj.abort:
+      budget.save_deferred( opts.base_dir, opts.dest_dir, deferred )
+   # record completion of the shard, for the merge run
+   if opts.shard and not (work_obj.abort or deferred):
+      opts.shard.write_manifest( opts.dest_dir, len(encoders) )
+   if opts.export and not work_obj.abort:
+      export_bundle( opts )
+   if deferred:
+      size = sum( budget.job_size(e) for e in deferred )
+      print "time budget exhausted, %d files (%d MB) deferred to next run" % (
+            len(deferred), size >> 20)
+      return budget.EXIT_DEFERRED
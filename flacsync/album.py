@@ -0,0 +1,154 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.album
+   ~~~~~~~~~~~~~~
+
+   Define album level processing, shared by the out-of-date tracks of a
+   single destination directory.
+
+   Work that is common to all tracks of an album (creating the destination
+   directory, converting the cover thumbnail and copying the cover file) is
+   done once, and the completion of each track is tracked to report albums
+   that are only partially encoded. A long-lived process also keeps the
+   cover thumbnails between syncs, see :class:`CoverCache`.
+"""
+
+import collections
+import os
+import threading
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#############################################################################
+class Album( object ):
+   """
+   Group of encoder objects, with the same destination directory.
+   """
+   def __init__( self, encoders ):
+      """
+      :param encoders: Pending encoder (or :class:`~flacsync.job.Job`)
+                       objects of the album.
+      :type  encoders: list
+      """
+      self.dir = os.path.dirname( encoders[0].dst )
+      self.encoders = encoders
+      #: Encoder objects of tracks that failed.
+      self.failed = []
+      self.done = 0
+      self._prepared = False
+      self._lock = threading.Lock()
+
+   @property
+   def complete( self ):
+      """:data:`True` if all tracks finished (with or without errors)."""
+      return self.done == len(self.encoders)
+
+   def prepare( self, resize=False, covers=None ):
+      """
+      Perform the shared album work, before the first track is encoded.
+      Later calls return immediately.
+
+      :param resize:  When :data:`True`, cover art will be resized to
+                      predefined size.
+      :type  resize:  boolean
+
+      :param covers:  Optional cache of cover thumbnails.
+      :type  covers:  :class:`CoverCache`
+      """
+      with self._lock:
+         if self._prepared:
+            return
+         self._prepared = True
+         try:
+            os.makedirs( self.dir )
+         except OSError: pass  # ignore if dir already exists
+         thumbnails = {}
+         for e in self.encoders:
+            if e.cover:
+               if e.cover not in thumbnails:
+                  thumbnails[e.cover] = (covers.thumbnail( e, resize )
+                        if covers else e.thumbnail_data( resize ))
+               e.cover_data = thumbnails[e.cover]
+
+   def finish( self, encoder, ok ):
+      """
+      Record the completion of a track.
+
+      :param encoder: Encoder object of the track.
+      :type  encoder: :mod:`flacsync.encoder`._Encoder
+
+      :param ok:     :data:`False` if the track failed.
+      :type  ok:     boolean
+
+      :returns: :data:`True` if this was the last track of the album.
+      """
+      with self._lock:
+         self.done += 1
+         if not ok:
+            self.failed.append( encoder )
+         return self.complete
+
+   def copy_cover( self, force=False ):
+      """Copy each cover art file of the album to the destination once."""
+      copied = set()
+      for e in self.encoders:
+         if e.cover and e.cover_dst not in copied:
+            copied.add( e.cover_dst )
+            e.copy_cover( force )
+
+
+#############################################################################
+class CoverCache( object ):
+   """
+   Cover thumbnails of the most recently encoded albums. A thumbnail is
+   converted again when its cover file is modified.
+   """
+   def __init__( self, size=64 ):
+      """
+      :param size:   Max number of thumbnails.
+      :type  size:   int
+      """
+      self.size = size
+      #: Number of thumbnails found in the cache.
+      self.hits = 0
+      #: Number of thumbnails converted.
+      self.misses = 0
+      self._data = collections.OrderedDict()
+      self._lock = threading.Lock()
+
+   def thumbnail( self, encoder, resize=False ):
+      """
+      :returns: Thumbnail data of the cover of an encoder object, see
+                :meth:`~flacsync.encoder._Encoder.thumbnail_data`.
+      """
+      key = (encoder.cover, os.path.getmtime(encoder.cover), resize)
+      with self._lock:
+         data = self._data.pop( key, None )
+         if data is not None:
+            self.hits += 1
+            self._data[key] = data   # most recently used
+            return data
+         self.misses += 1
+      data = encoder.thumbnail_data( resize )
+      with self._lock:
+         self._data[key] = data
+         while len(self._data) > self.size:
+            self._data.popitem( last=False )
+      return data
+
+
+def group( encoders ):
+   """
+   :returns: Dictionary mapping destination directory to :class:`Album`.
+   """
+   dirs = {}
+   for e in encoders:
+      dirs.setdefault( os.path.dirname(e.dst), [] ).append( e )
+   return dict( (d,Album(e)) for d,e in dirs.items() )
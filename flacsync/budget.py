@@ -0,0 +1,220 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.budget
+   ~~~~~~~~~~~~~~~
+
+   Define a time budget for a sync run, and the job order used to decide
+   which files are encoded first.
+
+   The ``disk`` order reads the source files by physical location, so that
+   the concurrent decoders of a spinning disk read from nearby regions.
+
+   The encoding time of each job is estimated from its source size, and the
+   average encoding rate of the jobs completed so far. Once a job does not
+   fit the remaining time, no more jobs are started, and the remaining files
+   are recorded in the destination to be encoded first by the next run.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+from . import decoder
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Exit status of a run that deferred files to the next run.
+EXIT_DEFERRED = 3
+#: Name of the deferred file list, in :data:`flacsync.util.STATE_DIR`.
+DEFERRED_FILE = 'deferred.json'
+#: Name of the source read rate record, in :data:`flacsync.util.STATE_DIR`.
+THROUGHPUT_FILE = 'throughput.json'
+
+_DURATION = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$')
+
+
+#############################################################################
+class Budget( object ):
+   """
+   Admission control of jobs, for a run limited in time.
+   """
+   def __init__( self, seconds, clock=time.time ):
+      """
+      :param seconds: Length of the time budget, from now.
+      :type  seconds: float
+
+      :param clock:  Time function, for testing.
+      :type  clock:  function
+      """
+      self.deadline = clock() + seconds
+      #: Encoder objects that were not started.
+      self.deferred = []
+      self._clock = clock
+      self._bytes = 0
+      self._secs = 0.0
+      self._exhausted = False
+      self._lock = threading.Lock()
+
+   def estimate( self, size ):
+      """
+      :returns: Estimated encoding time (seconds) of a source size, or
+                :data:`None` if no job has completed.
+      """
+      if not self._bytes:
+         return None
+      return size * self._secs / self._bytes
+
+   def admit( self, encoder ):
+      """
+      Decide if a job can be started, within the remaining time. Once a job
+      is deferred, all later jobs are deferred as well.
+
+      :param encoder: Encoder object of the job.
+      :type  encoder: :mod:`flacsync.encoder`._Encoder
+
+      :returns: :data:`True` if the job can be started.
+      """
+      with self._lock:
+         if not self._exhausted:
+            remaining = self.deadline - self._clock()
+            cost = self.estimate( job_size(encoder) )
+            self._exhausted = remaining <= 0 or (cost or 0) > remaining
+         if self._exhausted:
+            self.deferred.append( encoder )
+         return not self._exhausted
+
+   def record( self, encoder, seconds ):
+      """Add the encoding time of a completed job to the rate estimate."""
+      with self._lock:
+         self._bytes += job_size( encoder )
+         self._secs += seconds
+
+
+def job_size( encoder ):
+   """
+   :returns: Source size in bytes of an encoder job, the size of the sample
+             range for tracks of an image.
+   """
+   try:
+      size = os.path.getsize( encoder.flac )
+      track = encoder.track
+      if track:
+         total = decoder.FlacDecoder(encoder.flac).info.samples
+         end = track.end if track.end is not None else total
+         if total:
+            size = size * (end - track.start) // total
+      return size
+   except (OSError, IOError, ValueError):
+      return 0
+
+
+def parse_duration( text ):
+   """
+   Parse a duration such as ``3h``, ``1h30m``, ``90m`` or ``45`` (seconds).
+
+   :returns: Number of seconds.
+   :raises: :exc:`ValueError` if the duration is invalid.
+   """
+   match = _DURATION.match( text.strip() )
+   if not text.strip() or not match:
+      raise ValueError( "invalid duration '%s'" % (text,) )
+   h,m,s = (int(x or 0) for x in match.groups())
+   return h*3600 + m*60 + s
+
+
+#: Job order policies, mapping name to a sort key of an encoder.
+POLICIES = {
+   'path'     :lambda e: e.src,
+   'newest'   :lambda e: -os.path.getmtime(e.flac),
+   'smallest' :lambda e: job_size(e),
+   'disk'     :lambda e: util.disk_location(e.flac),
+}
+
+
+def order( encoders, policy, first=(), later=() ):
+   """
+   Sort encoder objects by a job order policy.
+
+   :param encoders: List of encoder objects.
+   :type  encoders: list
+
+   :param policy:   Name of a policy in :data:`POLICIES`.
+   :type  policy:   str
+
+   :param first:    Source paths to order before all others, i.e. the
+                    files deferred by the previous run.
+   :type  first:    set
+
+   :param later:    Source paths to order after all others, i.e. the files
+                    only re-encoded for changed encoder settings.
+   :type  later:    set
+
+   :returns: Sorted list of encoder objects.
+   """
+   key = POLICIES[policy]
+   return sorted( encoders,
+         key=lambda e: (e.src in later, e.src not in first, key(e)) )
+
+
+def load_deferred( base_dir, dest_dir ):
+   """
+   :returns: Set of source paths deferred by the previous run.
+   """
+   path = os.path.join( dest_dir, util.STATE_DIR, DEFERRED_FILE )
+   try:
+      with open(path) as fh:
+         names = json.load(fh)
+   except (IOError, ValueError):
+      return set()
+   return set( os.path.join(base_dir, n.encode('utf-8')) for n in names )
+
+
+def save_deferred( base_dir, dest_dir, encoders ):
+   """
+   Record the source paths of deferred encoder objects, or remove the
+   record if the list is empty.
+   """
+   path = os.path.join( dest_dir, util.STATE_DIR, DEFERRED_FILE )
+   if not encoders:
+      if os.path.exists(path):
+         os.remove( path )
+      return
+   names = sorted( os.path.relpath(e.src, base_dir) for e in encoders )
+   util.save_json( path, names )
+
+
+def save_throughput( dest_dir, policy, rate ):
+   """
+   Record the source read rate of a run, by job order policy.
+
+   :param dest_dir: Destination root directory.
+   :type  dest_dir: str
+
+   :param policy:   Name of the job order policy of the run.
+   :type  policy:   str
+
+   :param rate:     Source bytes read per second.
+   :type  rate:     float
+
+   :returns: Dictionary of the last rate of each other policy.
+   """
+   path = os.path.join( dest_dir, util.STATE_DIR, THROUGHPUT_FILE )
+   try:
+      with open(path) as fh:
+         rates = json.load(fh)
+   except (IOError, ValueError):
+      rates = {}
+   others = dict( (str(k),v) for k,v in rates.items() if k != policy )
+   rates[policy] = rate
+   util.save_json( path, rates )
+   return others
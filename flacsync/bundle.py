@@ -0,0 +1,251 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.bundle
+   ~~~~~~~~~~~~~~~
+
+   Define delta bundles, to sync a device (i.e. a USB stick) that is not
+   attached to the host of the destination directory.
+
+   The destination keeps a manifest of the files (size and mtime) last
+   exported to each device. A bundle is a tar archive of the new and changed
+   files since that export, and a header with the list of deleted files. It
+   is applied to the device with sequential writes, instead of a walk and
+   many small updates of the device file system.
+
+   Each bundle has an id, and records the id of the previous bundle of the
+   device. The id of the last applied bundle is stored on the device, so
+   that a missing bundle is detected.
+
+   The manifests of the last :data:`MAX_PENDING` exports to a device are
+   kept, as they may not have been applied. If a bundle is lost, the next
+   export is written from the id of the bundle the device is actually at
+   (see :func:`export`); that export also drops the manifests of the
+   bundles before it.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import StringIO
+import tarfile
+import time
+
+from . import mirror
+from . import orphan
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Name of the manifest directory, in :data:`flacsync.util.STATE_DIR`.
+EXPORT_DIR = 'exports'
+
+#: Name of the bundle header, the first member of a bundle.
+HEADER = '%s/bundle.json' % (util.STATE_DIR,)
+
+#: Valid device name.
+DEVICE = re.compile(r'^[\w.-]+$')
+
+#: Max number of exports to a device, that are kept as a base of the next
+#: export.
+MAX_PENDING = 8
+
+
+def manifest( dest_dir ):
+   """
+   :returns: Dictionary mapping the relative path of each file in a
+             destination to a list of (size, mtime).
+   """
+   files = {}
+   for root, dirs, names in os.walk( dest_dir, followlinks=True ):
+      if root == dest_dir and util.STATE_DIR in dirs:
+         dirs.remove( util.STATE_DIR )
+      for n in names:
+         path = os.path.join( root, n )
+         try:
+            st = os.stat( path )
+         except OSError:
+            continue
+         files[os.path.relpath(path, dest_dir)] = [st.st_size,
+                                                   int(st.st_mtime)]
+   return files
+
+
+def export( path, dest_dir, device, base=None ):
+   """
+   Write a bundle of the changes of a destination since an export to a
+   device. The manifest of the bundle is recorded, once it is complete.
+
+   :param path:      Bundle file path.
+   :type  path:      str
+
+   :param dest_dir:  Destination root directory.
+   :type  dest_dir:  str
+
+   :param device:    Device name, see :data:`DEVICE`.
+   :type  device:    str
+
+   :param base:      Id of the bundle last applied to the device, default is
+                     the last export. The exports before it are forgotten.
+   :type  base:      str
+
+   :returns: Tuple of the number of files, the number of deleted files and
+             the size of the files in bytes.
+   :raises: :exc:`ValueError` if the manifest of :data:`base` is unknown.
+   """
+   state = os.path.join( dest_dir, util.STATE_DIR, EXPORT_DIR,
+                         device + '.json' )
+   last = _load( state )
+   exports = last.get('exports', {})
+   if base is None:
+      base = last.get('id')
+   elif base not in exports:
+      raise ValueError( "no export '%s' to device '%s'" % (base, device) )
+   else:
+      # the device is at base, so the bundles before it are applied
+      for id_ in _before( exports, base ):
+         del exports[id_]
+   old = exports[base]['files'] if base else {}
+   new = manifest( dest_dir )
+   changed = sorted( f for f,v in new.items() if old.get(f) != v )
+   deleted = sorted( f for f in old if f not in new )
+   digest = hashlib.md5( json.dumps([base, sorted(new.items())]) )
+   header = {
+      'device':device,
+      'id':digest.hexdigest()[:12],
+      'base':base,
+      'time':int(time.time()),
+      'delete':deleted,
+      }
+   data = json.dumps( header )
+   tmp = '%s.%d.tmp' % (path, os.getpid())
+   size = 0
+   try:
+      with open(tmp, 'wb') as fh:
+         tar = tarfile.open( fileobj=fh, mode='w|', bufsize=mirror.BUFSIZE )
+         info = tarfile.TarInfo( HEADER )
+         info.size = len(data)
+         info.mtime = header['time']
+         tar.addfile( info, StringIO.StringIO(data) )
+         for f in changed:
+            tar.add( os.path.join(dest_dir, f), f, recursive=False )
+            size += new[f][0]
+         tar.close()
+      os.rename( tmp, path )
+   finally:
+      if os.path.exists( tmp ):
+         os.remove( tmp )
+   seq = max( [e['seq'] for e in exports.values()] or [0] ) + 1
+   exports[header['id']] = {'base':base, 'seq':seq, 'files':new}
+   oldest = sorted( exports, key=lambda i: exports[i]['seq'] )
+   for id_ in oldest[:-MAX_PENDING]:
+      del exports[id_]
+   util.save_json( state, {'id':header['id'], 'exports':exports} )
+   return len(changed), len(deleted), size
+
+
+def apply( path, device_dir, force=False, threads=1 ):
+   """
+   Apply a bundle to a device: remove the deleted files (and empty
+   directories), then write the new and changed files.
+
+   :param path:       Bundle file path.
+   :type  path:       str
+
+   :param device_dir: Root directory of the device.
+   :type  device_dir: str
+
+   :param force:      Apply a bundle that does not follow the last bundle
+                      applied to the device.
+   :type  force:      boolean
+
+   :param threads:    Number of threads removing files.
+   :type  threads:    int
+
+   :returns: Tuple of the number of written, and deleted files.
+   :raises: :exc:`ValueError` if the file is not a bundle, or does not
+            follow the last bundle applied to the device.
+   """
+   device_dir = os.path.abspath( device_dir )
+   state = os.path.join( device_dir, util.STATE_DIR, 'bundle.json' )
+   current = _load( state ).get('id')
+   written = 0
+   with open(path, 'rb') as fh:
+      tar = tarfile.open( fileobj=fh, mode='r|', bufsize=mirror.BUFSIZE )
+      members = iter(tar)
+      info = next( members, None )
+      if info is None or info.name != HEADER:
+         raise ValueError( "'%s' is not a flacsync bundle" % (path,) )
+      header = json.loads( tar.extractfile(info).read() )
+      if header['base'] != current and not force:
+         raise ValueError( "bundle follows '%s', but device is at '%s'" % (
+               header['base'], current) )
+      removed = orphan.remove( (_target(device_dir, f.encode('utf-8'))
+                                for f in header['delete']), threads )
+      orphan.prune( removed, device_dir )
+      for info in members:
+         if not info.isfile():
+            continue
+         dst = _target( device_dir, info.name )
+         _write( tar.extractfile(info), dst, info.mtime )
+         written += 1
+      tar.close()
+   util.save_json( state, {'id':header['id'], 'device':header['device']} )
+   return written, len(removed)
+
+
+def _target( root, name ):
+   # device path of a bundle member, rejecting paths outside of the device
+   path = os.path.normpath( os.path.join(root, name) )
+   if os.path.isabs( name ) or not path.startswith( root + os.sep ):
+      raise ValueError( "invalid bundle path '%s'" % (name,) )
+   return path
+
+
+def _write( src, dst, mtime ):
+   try:
+      os.makedirs( os.path.dirname(dst) )
+   except OSError: pass  # ignore if dir already exists
+   tmp = '%s.%d.tmp' % (dst, os.getpid())
+   try:
+      with open(tmp, 'wb') as fh:
+         shutil.copyfileobj( src, fh, mirror.BUFSIZE )
+      os.utime( tmp, (mtime, mtime) )
+      os.rename( tmp, dst )
+   finally:
+      if os.path.exists( tmp ):
+         os.remove( tmp )
+
+
+def _before( exports, id_ ):
+   # ids of the exports that the export id_ follows
+   found = set()
+   id_ = exports[id_]['base']
+   while id_ in exports and id_ not in found:
+      found.add( id_ )
+      id_ = exports[id_]['base']
+   return found
+
+
+def _load( path ):
+   try:
+      with open(path) as fh:
+         data = json.load(fh)
+      if 'files' in data:
+         # the manifest of the last export only (older versions)
+         data['exports'] = {data['id']:{'base':None, 'seq':0,
+                                        'files':data.pop('files')}}
+      for entry in data.get('exports', {}).values():
+         entry['files'] = dict( (k.encode('utf-8'),v)
+                                for k,v in entry['files'].items() )
+      return data
+   except (IOError, ValueError, AttributeError, KeyError):
+      return {}
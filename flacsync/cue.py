@@ -0,0 +1,326 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.cue
+   ~~~~~~~~~~~~
+
+   Define support for single file FLAC images, split into tracks by a cue
+   sheet. The cue sheet is either a sidecar ``.cue`` file, or an embedded
+   FLAC CUESHEET metadata block.
+
+   Each track of an image is represented by a virtual source path, named
+   after the track number and title, in the directory of the image.
+"""
+
+import os
+import re
+import struct
+
+from . import decoder
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: CD frames per second, used by cue sheet INDEX times.
+CD_FRAMES = 75
+#: FLAC metadata block type of a CUESHEET.
+CUESHEET_BLOCK = 5
+
+_UNSAFE = re.compile(r'[/\\:*?"<>|\x00-\x1f]')
+_QUOTED = re.compile(r'"([^"]*)"')
+
+
+#############################################################################
+class Track( object ):
+   """
+   A single track of a FLAC image.
+   """
+   def __init__( self, image, number, start, end=None, tags=None, cue=None ):
+      """
+      :param image:  Path of the FLAC image file.
+      :type  image:  str
+
+      :param number: Track number.
+      :type  number: int
+
+      :param start:  First sample of the track.
+      :type  start:  int
+
+      :param end:    Sample after the end of the track, or :data:`None` for
+                     the end of the image.
+      :type  end:    int
+
+      :param tags:   Tag values of the track, using the key names of
+                     :attr:`flacsync.decoder.FlacDecoder.tags`.
+      :type  tags:   dict
+
+      :param cue:    Path of the sidecar cue sheet, if any.
+      :type  cue:    str
+      """
+      self.image = image
+      self.number = number
+      self.start = start
+      self.end = end
+      self.tags = tags or {}
+      self.cue = cue
+
+   @property
+   def path( self ):
+      """Virtual source path of the track."""
+      title = self.tags.get('title') or 'Track %02d' % (self.number,)
+      name = '%02d - %s.flac' % (self.number, _UNSAFE.sub('_', title).strip())
+      return os.path.join( os.path.dirname(self.image), name )
+
+   def decode_opts( self ):
+      """:returns: List of ``flac`` options, to decode only this track."""
+      opts = ['--skip=%d' % (self.start,)]
+      if self.end is not None:
+         opts.append( '--until=%d' % (self.end,) )
+      return opts
+
+   def merge_tags( self, image_tags ):
+      """
+      Combine the tags of the image file with the tags of the track.
+
+      :param image_tags: Tags of the FLAC image file.
+      :type  image_tags: dict
+
+      :returns: Tags dictionary of the track.
+      """
+      tags = dict( image_tags )
+      # replaygain track values of an image apply to the whole album
+      tags['rg_album_gain'] = tags['rg_album_gain'] or tags['rg_track_gain']
+      tags['rg_album_peak'] = tags['rg_album_peak'] or tags['rg_track_peak']
+      tags['rg_track_gain'] = tags['rg_track_peak'] = None
+      tags['title'] = None
+      tags.update( (k,v) for k,v in self.tags.items() if v )
+      return tags
+
+
+class TrackPath( str ):
+   """
+   Virtual source path of an image track, with a reference to the
+   :class:`Track` object.
+   """
+   def __new__( cls, track ):
+      obj = super( TrackPath, cls).__new__( cls, track.path )
+      obj.track = track
+      return obj
+
+
+def find_tracks( path, files=None ):
+   """
+   Return the tracks of a FLAC image, if it has a sidecar cue sheet
+   (``image.cue`` or ``image.flac.cue``) or an embedded CUESHEET block.
+
+   :param path:   Path of a FLAC file.
+   :type  path:   str
+
+   :param files:  Optional list of the file names in the directory of
+                  :data:`path`, to avoid a lookup of the sidecar files.
+   :type  files:  list
+
+   :returns: List of :class:`Track` objects, empty if the file is not an
+             image.
+   """
+   dir_,name = os.path.split(path)
+   for cue in (os.path.splitext(name)[0] + '.cue', name + '.cue'):
+      if files is not None and cue not in files:
+         continue
+      cue = os.path.join(dir_,cue)
+      if os.path.isfile(cue):
+         try:
+            with open(cue) as fh:
+               return parse_cue( fh.read(), path, cue )
+         except (IOError, ValueError):
+            return []
+   try:
+      return read_cuesheet( path )
+   except (IOError, ValueError):
+      return []
+
+
+def dir_tracks( dir_ ):
+   """
+   :returns: Set of virtual source paths of all image tracks in a
+             directory.
+   """
+   paths = set()
+   try:
+      files = os.listdir(dir_)
+   except OSError:
+      return paths
+   for f in files:
+      if os.path.splitext(f)[1] == '.flac':
+         paths.update( t.path for t in find_tracks(os.path.join(dir_,f),files) )
+   return paths
+
+
+def parse_cue( text, image, cue=None ):
+   """
+   Parse a cue sheet describing a single FLAC image.
+
+   :param text:  Cue sheet contents.
+   :type  text:  str
+
+   :param image: Path of the FLAC image file.
+   :type  image: str
+
+   :param cue:   Path of the cue sheet file.
+   :type  cue:   str
+
+   :returns: List of :class:`Track` objects.
+   :raises: :exc:`ValueError` if the cue sheet does not describe a single
+            image file.
+   """
+   if text.startswith('\xef\xbb\xbf'):
+      text = text[3:]
+   rate = decoder.FlacDecoder(image).info.rate
+   album = {}
+   tracks = []
+   files = 0
+   for line in text.splitlines():
+      words = _split( line )
+      if not words:
+         continue
+      cmd = words[0].upper()
+      tags = tracks[-1][1] if tracks else album
+      if cmd == 'FILE':
+         files += 1
+      elif cmd == 'TRACK' and len(words) > 1:
+         tracks.append( [int(words[1]), {}, None] )
+      elif cmd == 'TITLE' and len(words) > 1:
+         tags['album' if tags is album else 'title'] = words[1]
+      elif cmd == 'PERFORMER' and len(words) > 1:
+         tags['album_artist' if tags is album else 'artist'] = words[1]
+      elif cmd == 'SONGWRITER' and len(words) > 1:
+         tags['composer'] = words[1]
+      elif cmd == 'REM' and len(words) > 2:
+         key = {'DATE':'year', 'GENRE':'genre', 'COMMENT':'comment',
+                'DISCNUMBER':'disc'}.get( words[1].upper() )
+         if key:
+            tags[key] = words[2]
+      elif cmd == 'INDEX' and len(words) > 2 and tracks and int(words[1]) == 1:
+         m,s,f = map(int, words[2].split(':'))
+         tracks[-1][2] = (m*60 + s)*rate + f*rate // CD_FRAMES
+   if files != 1 or not tracks or any( t[2] is None for t in tracks ):
+      raise ValueError( "cue sheet does not describe a single image" )
+   album.setdefault( 'artist', album.get('album_artist') )
+   result = []
+   for i,(num,tags,start) in enumerate(tracks):
+      end = tracks[i+1][2] if i+1 < len(tracks) else None
+      track_tags = dict( album )
+      track_tags.update( tags )
+      track_tags['track'] = str(num)
+      track_tags['totaltracks'] = str(len(tracks))
+      result.append( Track(image, num, start, end, track_tags, cue) )
+   return result
+
+
+def _split( line ):
+   # words of a cue sheet line; the value of a text command is a quoted
+   # string or the rest of the line, i.e. TITLE It's So Easy
+   words = line.split( None, 1 )
+   if len(words) < 2:
+      return words
+   cmd,rest = words
+   if cmd.upper() == 'REM':
+      # i.e. REM GENRE "Rock"
+      words = rest.split( None, 1 )
+      cmd,rest = [cmd, words[0]], words[1:] and words[1]
+   elif cmd.upper() in ('TITLE', 'PERFORMER', 'SONGWRITER', 'FILE'):
+      cmd = [cmd]
+   else:
+      return [cmd] + rest.split()
+   value = _value( rest or '' )
+   return cmd + [value] if value else cmd
+
+
+def _value( text ):
+   match = _QUOTED.match( text.strip() )
+   return match.group(1) if match else text.strip()
+
+
+def read_cuesheet( image ):
+   """
+   Read the embedded CUESHEET metadata block of a FLAC image. Track titles
+   are read from the Vorbis comments of the image: an embedded ``CUESHEET``
+   comment (the cue sheet text), or ``CUE_TRACKnn_TITLE`` comments.
+
+   :param image: Path of the FLAC image file.
+   :type  image: str
+
+   :returns: List of :class:`Track` objects, empty if there is no CUESHEET
+             block, or if it has a single track (i.e. the cue sheet of a
+             track rip).
+   :raises: :exc:`ValueError` if the file is not a FLAC file.
+   """
+   tracks = []
+   with open(image, 'rb') as fh:
+      if fh.read(4) != 'fLaC':
+         raise ValueError( "not a FLAC file" )
+      while True:
+         hdr = fh.read(4)
+         if len(hdr) != 4:
+            break
+         btype = ord(hdr[0]) & 0x7f
+         size, = struct.unpack('>I', '\x00' + hdr[1:])
+         if btype == CUESHEET_BLOCK:
+            tracks = _parse_cuesheet( fh.read(size), image )
+            break
+         if ord(hdr[0]) & 0x80:  # last block
+            break
+         fh.seek( size, os.SEEK_CUR )
+   if len(tracks) < 2:
+      return []
+   _add_comment_tags( tracks, decoder.FlacDecoder(image).comments )
+   return tracks
+
+
+def _add_comment_tags( tracks, comments ):
+   # tags of the embedded cue sheet text, then of the CUE_TRACKnn_* fields
+   text = comments.get('cuesheet')
+   if text:
+      try:
+         cued = dict( (t.number, t.tags) for t in
+                      parse_cue(text[0], tracks[0].image) )
+      except ValueError:
+         cued = {}
+      for t in tracks:
+         t.tags.update( (k,v) for k,v in cued.get(t.number, {}).items()
+                        if k not in ('track', 'totaltracks') )
+   for t in tracks:
+      for field,key in (('title','title'), ('performer','artist')):
+         value = comments.get( 'cue_track%02d_%s' % (t.number, field) )
+         if value:
+            t.tags[key] = value[0].strip()
+
+
+def _parse_cuesheet( data, image ):
+   pos = 128 + 8 + 259
+   count = ord(data[pos])
+   pos += 1
+   starts = []
+   for _ in range(count):
+      offset,number = struct.unpack('>QB', data[pos:pos+9])
+      nindex = ord(data[pos+35])
+      pos += 36
+      index = {}
+      for _ in range(nindex):
+         ioffset,inum = struct.unpack('>QB', data[pos:pos+9])
+         index[inum] = ioffset
+         pos += 12
+      if number in (170,255):  # lead-out track
+         continue
+      starts.append( (number, offset + index.get(1, index.get(0, 0))) )
+   tracks = []
+   for i,(num,start) in enumerate(starts):
+      end = starts[i+1][1] if i+1 < len(starts) else None
+      tags = {'track':str(num), 'totaltracks':str(len(starts))}
+      tracks.append( Track(image, num, start, end, tags) )
+   return tracks
@@ -11,12 +11,18 @@
    Define interfaces for processing compressed audio files.
 """
 
-import subprocess as sp
+import struct
 
 __author__ = 'Patrick C. McGinty'
 __email__ = 'flacsync@tuxcoder.com'
 
 
+#: Metadata block type of Vorbis comments.
+VORBIS_COMMENT = 4
+#: Metadata block type of embedded pictures.
+PICTURE = 6
+
+
 #############################################################################
 class FlacDecoder( object ):
    """
@@ -50,6 +56,90 @@ class FlacDecoder( object ):
    def __init__(self, name):
       self.name = name
 
+   @property
+   def info(self):
+      """
+      :class:`StreamInfo` of the FLAC file, read directly from the file
+      header.
+
+      :raises: :exc:`ValueError` if the file is not a FLAC file.
+      """
+      with open(self.name, 'rb') as fh:
+         _skip_id3(fh)
+         data = fh.read(42)
+      return StreamInfo(data)
+
+   @property
+   def comments(self):
+      """
+      Dictionary of all Vorbis comments, read directly from the file header
+      (without running ``metaflac``). Keys are lower case field names, and
+      values are lists of strings.
+
+      :raises: :exc:`ValueError` if the file is not a FLAC file.
+      """
+      comments = {}
+      data = self.read_block(VORBIS_COMMENT)
+      if data is None:
+         return comments
+      try:
+         for field in _vorbis_comments(data):
+            key_val = field.split('=',1)
+            if len(key_val) == 2:
+               comments.setdefault(key_val[0].lower(),[]).append(key_val[1])
+      except struct.error:
+         raise ValueError("invalid VORBIS_COMMENT block")
+      return comments
+
+   @property
+   def picture(self):
+      """
+      Image data of the first embedded picture, or :data:`None` if the file
+      has no PICTURE block.
+
+      :raises: :exc:`ValueError` if the file is not a FLAC file.
+      """
+      data = self.read_block(PICTURE)
+      if data is None:
+         return None
+      try:
+         pos = 4
+         for _ in range(2):   # skip MIME type and description
+            size, = struct.unpack('>I', data[pos:pos+4])
+            pos += 4 + size
+         pos += 16            # skip width, height, depth and colors
+         size, = struct.unpack('>I', data[pos:pos+4])
+      except struct.error:
+         raise ValueError("invalid PICTURE block")
+      return data[pos+4:pos+4+size] or None
+
+   def read_block(self, block_type):
+      """
+      Read a metadata block from the file header.
+
+      :param block_type: Metadata block type (i.e. :data:`PICTURE`).
+      :type  block_type: int
+
+      :returns: Data of the first block of the type, or :data:`None` if the
+                file has no block of the type.
+      :raises: :exc:`ValueError` if the file is not a FLAC file.
+      """
+      with open(self.name, 'rb') as fh:
+         _skip_id3(fh)
+         if fh.read(4) != 'fLaC':
+            raise ValueError("not a FLAC file")
+         last = False
+         while not last:
+            header = fh.read(4)
+            if len(header) < 4:
+               break
+            last = ord(header[0]) & 0x80
+            size, = struct.unpack('>I', '\0' + header[1:])
+            if ord(header[0]) & 0x7f == block_type:
+               return fh.read(size)
+            fh.seek(size, 1)
+      return None
+
    @property
    def tags(self):
       """
@@ -80,16 +170,75 @@ class FlacDecoder( object ):
       ``track``            Track number
       ``year``             Year (20XX)
       ===================  =====================
+
+      Multiple values of a tag are joined with ``' - '``. Missing tags (or
+      all tags of an unreadable file) are :data:`None`.
+      """
+      try:
+         comments = self.comments
+      except (IOError, ValueError):
+         comments = {}
+      return dict((k,self._join(comments.get(v)))
+                  for k,v in self.FLAC_TAGS.items())
+
+   @staticmethod
+   def _join(values):
+      values = [v.strip() for v in values or []]
+      return ' - '.join(values) if values else None
+
+
+def _skip_id3(fh):
+   # move a file to the start of the FLAC stream, after an optional ID3v2 tag
+   data = fh.read(10)
+   if data[:3] == 'ID3':
+      size = 0
+      for c in data[6:10]:
+         size = (size << 7) | (ord(c) & 0x7f)
+      fh.seek(10 + size)
+   else:
+      fh.seek(0)
+
+
+def _vorbis_comments(data):
+   # list of 'NAME=value' strings of a VORBIS_COMMENT block (little endian)
+   vendor, = struct.unpack('<I', data[:4])
+   pos = 4 + vendor
+   count, = struct.unpack('<I', data[pos:pos+4])
+   pos += 4
+   fields = []
+   for _ in range(count):
+      size, = struct.unpack('<I', data[pos:pos+4])
+      fields.append(data[pos+4:pos+4+size])
+      pos += 4 + size
+   return fields
+
+
+#############################################################################
+class StreamInfo( object ):
+   """
+   FLAC STREAMINFO metadata block values.
+   """
+   def __init__(self, data):
       """
-      return dict((k,self._read_tag(v)) for k,v in self.FLAC_TAGS.items())
-
-   def _read_tag(self,field):
-      lines = sp.Popen( 'metaflac --show-tag="%s" "%s"' % (field,self.name),
-            shell=True, stdout=sp.PIPE).communicate()[0]
-      tags = []
-      for l in lines.splitlines():
-         key_val = l.split('=',1)
-         if len(key_val) == 2:
-            tags.append(key_val[1].strip())
-      return ' - '.join(tags) if tags else None
+      :param data: First 42 bytes of a FLAC file.
+      :type  data: str
+      """
+      if len(data) < 42 or data[:4] != 'fLaC' or ord(data[4]) & 0x7f != 0:
+         raise ValueError("not a FLAC file")
+      min_block,max_block = struct.unpack('>HH', data[8:12])
+      #: Number of samples per FLAC frame, or :data:`None` if variable.
+      self.block_size = max_block if min_block == max_block else None
+      bits, = struct.unpack('>Q', data[18:26])
+      #: Sample rate in Hz.
+      self.rate = bits >> 44
+      #: Number of channels.
+      self.channels = ((bits >> 41) & 0x7) + 1
+      #: Bits per sample.
+      self.bits = ((bits >> 36) & 0x1f) + 1
+      #: Total samples per channel, 0 if unknown.
+      self.samples = bits & 0xfffffffff
 
+   @property
+   def duration(self):
+      """Length of the audio in seconds."""
+      return float(self.samples) / self.rate if self.rate else 0.0
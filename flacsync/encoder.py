@@ -13,27 +13,73 @@
 
 import os
 import shutil
+import StringIO
 import subprocess as sp
 import tempfile
+import threading
 import hashlib
-try:
-  import Image
-except ImportError:
-  import PIL.Image as Image
 
+from . import decoder
+from . import loudness
+from . import mirror
+from . import mp3
+from . import pcm
+from . import resample
 from . import util
 
 __author__ = 'Patrick C. McGinty'
 __email__ = 'flacsync@tuxcoder.com'
 
 
-#: File handle to ``/dev/null``
-NULL = file('/dev/null')
+# heavy dependencies are only imported when used, see flacsync.registry
+Image = util.LazyModule('Image', 'PIL.Image')
+easyid3 = util.LazyModule('mutagen.easyid3')
+id3 = util.LazyModule('mutagen.id3')
+mp3file = util.LazyModule('mutagen.mp3')
+
+_null = []
+_spawns = [0]
+_spawn_lock = threading.Lock()
+_parts_lock = threading.Lock()
 
 #: List of album covers, in preferential order.
 COVERS = ['cover.jpg', 'folder.jpg', 'front.jpg', 'album.jpg']
 #: Resolution of re-sized album covers.
 THUMBSIZE = 250,250
+#: Minimum length of a track segment, in seconds.
+MIN_SEGMENT = 30
+
+
+def null():
+   """Return a file handle to ``/dev/null``, opened on first use."""
+   if not _null:
+      _null.append( open(os.devnull, 'w') )
+   return _null[0]
+
+
+def spawns():
+   """
+   :returns: Number of processes started by the encoders (a shell pipeline
+             counts once), see :mod:`flacsync.metrics`.
+   """
+   return _spawns[0]
+
+
+def _call( *args, **kwargs ):
+   # subprocess.call, counted by spawns()
+   _spawned()
+   return sp.call( *args, **kwargs )
+
+
+def _popen( *args, **kwargs ):
+   # subprocess.Popen, counted by spawns()
+   _spawned()
+   return sp.Popen( *args, **kwargs )
+
+
+def _spawned():
+   with _spawn_lock:
+      _spawns[0] += 1
 
 
 #############################################################################
@@ -42,33 +88,100 @@ class _Encoder(object):
    Base encoder class provides common methods. This should not be used
    directly.
    """
+   #: Encoder supports parallel encoding of track segments, see
+   #: :meth:`Mp3Encoder.split`.
+   SEGMENTS = False
+
    # dimensions of cover thumbnails in pixels
-   def __init__( self, src, ext, base_dir, dest_dir ):
+   def __init__( self, src, ext, base_dir, dest_dir, fingerprints=None,
+                 mirrors=() ):
       super( _Encoder, self).__init__()
       self.src = src
+      #: :class:`~flacsync.cue.Track` of a FLAC image, or :data:`None`
+      self.track = getattr(src, 'track', None)
+      #: path of the FLAC file to decode
+      self.flac = self.track.image if self.track else src
       self.dst = util.fname(src, base_dir, dest_dir, ext)
+      #: :class:`~flacsync.fingerprint.Fingerprints` of the outputs, or
+      #: :data:`None` to ignore encoder settings
+      self.fingerprints = fingerprints
+      #: Additional destination root directories, see :meth:`deliver`
+      self.mirrors = list(mirrors)
+      self._dest_dir = dest_dir
+      self.loudness = None
+      #: Name of the current processing step, see :mod:`flacsync.ledger`
+      self.stage = None
+      #: Message and output of the last failed step
+      self.error = None
+      self._stderr = None
+      #: JPEG data of the cover thumbnail, shared by the tracks of an album
+      self.cover_data = None
       self.cover = self._get_cover() or self._get_embedded_cover() or None
       if self.cover:
          self.cover_dst = util.fname(self.cover, base_dir, dest_dir)
 
    def skip_encode( self ):
       """Return 'True' if entire encode step can be skipped."""
-      encode = util.newer(self.src, self.dst)
+      encode = self.is_stale()
       cover  = self.cover and util.newer(self.cover, self.dst)
-      return not (encode or cover)
+      return not (encode or cover or self.stale_mirrors())
+
+   def is_stale( self ):
+      """
+      Return 'True' if the source file (or cue sheet) is newer, or the output
+      was encoded with other encoder settings.
+      """
+      cue = self.track and self.track.cue
+      return util.newer(self.flac, self.dst) or bool(
+            cue and util.newer(cue, self.dst)) or self.settings_changed()
+
+   def settings_changed( self ):
+      """Return 'True' if the output was encoded with other settings."""
+      return bool(self.fingerprints and self.fingerprints.changed(self))
+
+   def stale_mirrors( self ):
+      """
+      Return the paths of the output in the :attr:`mirrors` directories,
+      that are missing or older than the output.
+      """
+      return [m for m in self._mirror_paths(self.dst) if util.newer(self.dst,m)]
+
+   def deliver( self ):
+      """
+      Link or copy the output to each :attr:`mirrors` directory where it is
+      missing or out-of-date, see :func:`flacsync.mirror.link_or_copy`.
+
+      :return: Number of delivered files.
+      """
+      if not (self.mirrors and os.path.exists(self.dst)):
+         return 0
+      stale = self.stale_mirrors()
+      for m in stale:
+         mirror.link_or_copy(self.dst, m)
+      return len(stale)
 
    def copy_cover( self, force=False ):
-      """Copies cover art to destination folder."""
-      if self.cover and (force or util.newer(self.cover,self.cover_dst)):
-         shutil.copyfile(self.cover, self.cover_dst)
+      """Copies cover art to destination folder(s)."""
+      if not self.cover:
+         return
+      for dst in [self.cover_dst] + self._mirror_paths(self.cover_dst):
+         if force or util.newer(self.cover,dst):
+            mirror.link_or_copy(self.cover, dst)
+
+   def _mirror_paths( self, path ):
+      return [util.fname(path, self._dest_dir, m) for m in self.mirrors]
 
    def _get_cover( self ):
-      root,_,files = os.walk( os.path.dirname(self.src)).next()
+      # list the dir, and only stat a matching file (os.walk stats every
+      # entry of the dir, for each track)
+      root = os.path.dirname(self.src)
       try:
-         match = (f for f in files for c in COVERS if f==c).next()
-         return os.path.join(root,match)
-      except StopIteration:
-         pass
+         files = os.listdir(root)
+      except OSError:
+         return None
+      for f in files:
+         if f in COVERS and os.path.isfile(os.path.join(root,f)):
+            return os.path.join(root,f)
 
    def _get_tempdir( self ):
       tempdir = os.path.join(tempfile.gettempdir(),'flacsync-tmp')
@@ -85,11 +198,12 @@ class _Encoder(object):
       return tempdir
 
    def _get_embedded_cover( self ):
-      picture = None
       try:
-         # get the default embedded picture with metaflac
-         picture = sp.Popen( 'metaflac --export-picture-to=- "%s"' % (self.src), shell=True, stdout=sp.PIPE).communicate()[0]
-      except:
+         # get the first embedded picture, from the FLAC header
+         picture = decoder.FlacDecoder(self.flac).picture
+      except (IOError, ValueError):
+         return None
+      if not picture:
          return None
       # write the cover to a deterministic filename based on hash
       h = hashlib.md5()
@@ -106,10 +220,64 @@ class _Encoder(object):
          fh.close()
       return fn
 
+   def _pipe_encode( self, enc_cmd, analyze=False, max_rate=None,
+                     max_bits=None ):
+      """
+      Decode the source file and pipe the WAV output into an encoder
+      command.
+
+      :param enc_cmd: Shell command of the encoder, reading WAV from stdin.
+      :type  enc_cmd: str
+
+      :param analyze: When :data:`True`, the decoded samples are also passed
+                      to a loudness analyzer, stored as :attr:`loudness`.
+      :type  analyze: boolean
+
+      :param max_rate: Maximum sample rate (Hz) passed to the encoder.
+      :type  max_rate: int
+
+      :param max_bits: Maximum bits per sample passed to the encoder.
+      :type  max_bits: int
+
+      :return: Exit status of the encoder.
+      """
+      # decode only the sample range of an image track
+      dec_opts = self.track.decode_opts() if self.track else []
+      # keep the error output, for the failure ledger
+      self._stderr = tempfile.TemporaryFile()
+      if not (analyze or max_rate or max_bits):
+         return _call( 'flac -d "%s" -c -s %s | %s' %
+               (self.flac, ' '.join(dec_opts), enc_cmd), shell=True,
+               stderr=self._stderr)
+      taps = []
+      if analyze:
+         self.loudness = loudness.Loudness()
+         taps.append( self.loudness )
+      convert = None
+      if max_rate or max_bits:
+         convert = resample.Converter( max_rate, max_bits )
+      dec = _popen( ['flac', '-d', self.flac, '-c', '-s'] + dec_opts,
+            stdout=sp.PIPE, stderr=self._stderr)
+      enc = _popen( enc_cmd, shell=True, stdin=sp.PIPE, stderr=self._stderr)
+      try:
+         pcm.pipe( dec.stdout, enc.stdin, taps, convert )
+      except (IOError, ValueError):
+         self.loudness = None  # failure is reported by the exit status
+      finally:
+         enc.stdin.close()
+         dec.stdout.close()
+      err = enc.wait()
+      return dec.wait() or err
+
    def _pre_encode( self ):
       try:
          os.makedirs( os.path.dirname(self.dst) )
       except OSError: pass  # ignore if dir already exists
+      # do not overwrite the mirror files hard linked to the output
+      try:
+         if os.stat(self.dst).st_nlink > 1:
+            os.remove(self.dst)
+      except OSError: pass  # ignore if file does not exist
 
    def _rg_to_soundcheck( self, replay_gain ):
       """
@@ -122,19 +290,31 @@ class _Encoder(object):
       sc = 1000 * pow(10,(-rg_f/10.0))
       return ' '.join(["%08X" % (sc,)]*10)
 
-   def _cover_thumbnail( self, resize=False ):
+   def thumbnail_data( self, resize=False ):
+      """Return the cover image, converted to JPEG data."""
       assert self.cover    # cover must be valid
       im = Image.open( self.cover )
       if resize:
          im.thumbnail( THUMBSIZE)
+      data = StringIO.StringIO()
+      im.save( data, "JPEG")
+      return data.getvalue()
+
+   def _cover_thumbnail( self, resize=False ):
       ofile = tempfile.NamedTemporaryFile()
-      im.save( ofile.name, "JPEG")
+      ofile.write( self.cover_data or self.thumbnail_data(resize) )
+      ofile.flush()
+      ofile.seek( 0 )
       return ofile
 
-   @staticmethod
-   def _check_err( err, msg ):
+   def _check_err( self, err, msg ):
+      output, self._stderr = self._stderr, None
       if err:
          print msg, err
+         self.error = '%s %s' % (msg, err)
+         if output:
+            output.seek( 0 )
+            self.error += '\n' + output.read()
          return False
       else:
          return True
@@ -154,7 +334,8 @@ class AacEncoder( _Encoder ):
       assert type(aac_q) == str, "q value is: %s" % (aac_q,)
       self.q = aac_q
 
-   def encode( self, force=False ):
+   def encode( self, force=False, analyze=False, max_rate=None,
+               max_bits=None ):
       """
       Performs audio encoding process.
 
@@ -162,14 +343,26 @@ class AacEncoder( _Encoder ):
                      destination file exists.
       :type  force:  boolean
 
+      :param analyze: When :data:`True`, loudness of the decoded audio is
+                      measured during encoding.
+      :type  analyze: boolean
+
+      :param max_rate: Convert audio with a higher sample rate (Hz) before
+                       encoding.
+      :type  max_rate: int
+
+      :param max_bits: Convert audio with more bits per sample before
+                       encoding.
+      :type  max_bits: int
+
       :return: :data:`True` if (re)encoding occurred and no errors,
                :data:`False` otherwise
       """
-      if force or util.newer( self.src, self.dst):
+      if force or self.is_stale():
          self._pre_encode()
          # encode to AAC
-         err = sp.call( 'flac -d "%s" -c -s | neroAacEnc -q %s -if - -of "%s"' %
-               (self.src, self.q, self.dst), shell=True, stderr=NULL)
+         err = self._pipe_encode( 'neroAacEnc -q %s -if - -of "%s"' %
+               (self.q, self.dst), analyze, max_rate, max_bits)
          if err == -2:  # keyboard interrupt
             os.remove(self.dst) # clean-up partial file
             raise KeyboardInterrupt
@@ -214,10 +407,26 @@ class AacEncoder( _Encoder ):
       # tag AAC file
       cmd = ['-meta:"%s"="%s"'%(x,y) for x,y in aac_fields.items()]
       cmd += ['-meta-user:"%s"="%s"'%(x,y) for x,y in user_fields.items()]
-      err = sp.call( 'neroAacTag "%s" %s' % (self.dst,' '.join(cmd)),
-            shell=True, stderr=NULL)
+      err = _call( 'neroAacTag "%s" %s' % (self.dst,' '.join(cmd)),
+            shell=True, stderr=null())
       return self._check_err( err, "AAC tag failed:" )
 
+   def set_album_gain( self, gain, peak ):
+      """
+      Add album ReplayGain values to AAC file.
+
+      :param gain: Album gain tag value.
+      :type  gain: str
+
+      :param peak: Album peak tag value.
+      :type  peak: str
+      """
+      fields = {'replaygain_album_gain':gain, 'replaygain_album_peak':peak}
+      cmd = ['-meta-user:"%s"="%s"'%(x,y) for x,y in fields.items()]
+      err = _call( 'neroAacTag "%s" %s' % (self.dst,' '.join(cmd)),
+            shell=True, stderr=null())
+      return self._check_err( err, "AAC album gain failed:" )
+
    def set_cover( self, force=False, resize=False ):
       """
       Attach album cover image to AAC file.
@@ -232,8 +441,8 @@ class AacEncoder( _Encoder ):
       """
       if self.cover and (force or util.newer(self.cover,self.dst)):
          tmp_cover = self._cover_thumbnail(resize)
-         err = sp.call( 'neroAacTag "%s" -remove-cover:all -add-cover:front:"%s"' %
-                  (self.dst, tmp_cover.name,), shell=True, stderr=NULL)
+         err = _call( 'neroAacTag "%s" -remove-cover:all -add-cover:front:"%s"' %
+                  (self.dst, tmp_cover.name,), shell=True, stderr=null())
          return self._check_err( err, "AAC add-cover failed:" )
 
 
@@ -251,8 +460,10 @@ class OggEncoder( _Encoder ):
       super( OggEncoder, self).__init__( ext='.ogg', **kwargs)
       assert type(ogg_q) == str, "q value is: %s" % (ogg_q,)
       self.q = ogg_q
+      self._pcm_input = False
 
-   def encode( self, force=False ):
+   def encode( self, force=False, analyze=False, max_rate=None,
+               max_bits=None ):
       """
       Performs audio encoding process.
 
@@ -260,14 +471,31 @@ class OggEncoder( _Encoder ):
                      destination file exists.
       :type  force:  boolean
 
+      :param analyze: When :data:`True`, loudness of the decoded audio is
+                      measured during encoding.
+      :type  analyze: boolean
+
+      :param max_rate: Convert audio with a higher sample rate (Hz) before
+                       encoding.
+      :type  max_rate: int
+
+      :param max_bits: Convert audio with more bits per sample before
+                       encoding.
+      :type  max_bits: int
+
       :return: :data:`True` if (re)encoding occurred and no errors,
                :data:`False` otherwise
       """
-      if force or util.newer( self.src, self.dst):
+      if force or self.is_stale():
          self._pre_encode()
-         # encode to OGG
-         err = sp.call( 'oggenc -q %s -o "%s" "%s"' %
-               (self.q, self.dst, self.src), shell=True, stderr=NULL)
+         # encode to OGG, tags are lost when encoding from a WAV stream
+         self._pcm_input = bool(self.track or analyze or max_rate or max_bits)
+         if self._pcm_input:
+            err = self._pipe_encode( 'oggenc -q %s -o "%s" -' %
+                  (self.q, self.dst), analyze, max_rate, max_bits)
+         else:
+            err = _call( 'oggenc -q %s -o "%s" "%s"' %
+                  (self.q, self.dst, self.src), shell=True, stderr=null())
          if err == -2:  # keyboard interrupt
             os.remove(self.dst) # clean-up partial file
             raise KeyboardInterrupt
@@ -277,11 +505,38 @@ class OggEncoder( _Encoder ):
 
    def tag( self, tags):
       """
-      No-op, since tags are automatically updated during encoding.
+      Copies FLAC tags into destination OGG file. This is a no-op, unless the
+      file was encoded from a WAV stream, since tags are automatically
+      updated during encoding.
+
+      :param tags: Source tag values from FLAC file.
+      :type  tags: dict
+      """
+      if not self._pcm_input:
+         return True
+      fields = dict( (decoder.FlacDecoder.FLAC_TAGS[k],v)
+                     for k,v in tags.items() if v)
+      return self._add_comments( fields, "OGG tag failed:" )
+
+   def set_album_gain( self, gain, peak ):
+      """
+      Add album ReplayGain values to OGG file.
+
+      :param gain: Album gain tag value.
+      :type  gain: str
 
-      :return: :data:`True`
+      :param peak: Album peak tag value.
+      :type  peak: str
       """
-      return True
+      fields = {'replaygain_album_gain':gain, 'replaygain_album_peak':peak}
+      return self._add_comments( fields, "OGG album gain failed:" )
+
+   def _add_comments( self, fields, msg ):
+      cmd = ['vorbiscomment', '-a']
+      for x,y in fields.items():
+         cmd += ['-t', '%s=%s' % (x,y)]
+      err = _call( cmd + [self.dst], stderr=null())
+      return self._check_err( err, msg )
 
    def set_cover( self, force=False, resize=False ):
       """
@@ -331,18 +586,23 @@ class OggEncoder( _Encoder ):
                len(bin_cover),
                bin_cover)
          meta_block = base64.b64encode(meta_block)
-         err = sp.call( 'vorbiscomment -a -t "META_BLOCK_PICTURE=%s" "%s"' %
-                 (meta_block, self.dst), shell=True, stderr=NULL)
+         err = _call( 'vorbiscomment -a -t "META_BLOCK_PICTURE=%s" "%s"' %
+                 (meta_block, self.dst), shell=True, stderr=null())
          return self._check_err( err, "OGG add-cover failed:" )
 
 
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
-from mutagen.id3 import APIC
+#: Number of samples per MPEG-1 Layer III frame.
+MP3_FRAME = 1152
+#: Overlap of adjacent MP3 segments, in samples.
+SEGMENT_OVERLAP = 4 * MP3_FRAME
+
+import fractions
 class Mp3Encoder( _Encoder ):
    """
    FLAC to MP3 encoder.
    """
+   SEGMENTS = True
+
    def __init__( self, mp3_q, **kwargs  ):
       """
       :param mp3_q:  MP3 VBR encoder quality value [0 - 9]
@@ -351,8 +611,11 @@ class Mp3Encoder( _Encoder ):
       super( Mp3Encoder, self).__init__( ext='.mp3', **kwargs)
       assert type(mp3_q) == str, "q value is: %s" % (mp3_q,)
       self.q = mp3_q
+      self._segments = []
+      self._parts = None
 
-   def encode( self, force=False ):
+   def encode( self, force=False, analyze=False, max_rate=None,
+               max_bits=None ):
       """
       Performs audio encoding process.
 
@@ -360,15 +623,27 @@ class Mp3Encoder( _Encoder ):
                      destination file exists.
       :type  force:  boolean
 
+      :param analyze: When :data:`True`, loudness of the decoded audio is
+                      measured during encoding.
+      :type  analyze: boolean
+
+      :param max_rate: Convert audio with a higher sample rate (Hz) before
+                       encoding.
+      :type  max_rate: int
+
+      :param max_bits: Convert audio with more bits per sample before
+                       encoding.
+      :type  max_bits: int
+
       :return: :data:`True` if (re)encoding occurred and no errors,
                :data:`False` otherwise
       """
-      if force or util.newer( self.src, self.dst):
+      if force or self.is_stale():
          self._pre_encode()
          # encode to MP3
          #   --add-id3v2 forces creation of an empty tag
-         err = sp.call( 'flac -d "%s" -c -s | lame --add-id3v2 -V %s - "%s"' %
-               (self.src, self.q, self.dst), shell=True, stderr=NULL)
+         err = self._pipe_encode( 'lame --add-id3v2 -V %s - "%s"' %
+               (self.q, self.dst), analyze, max_rate, max_bits)
          if err == -2:  # keyboard interrupt
             os.remove(self.dst) # clean-up partial file
             raise KeyboardInterrupt
@@ -376,6 +651,141 @@ class Mp3Encoder( _Encoder ):
       else:
          return False
 
+   def split( self, min_length, count, force=False ):
+      """
+      Divide a long source file into segments, that can be encoded in
+      parallel with :meth:`encode_segment` and joined with
+      :meth:`join_segments`.
+
+      Segment boundaries are aligned to both FLAC and MP3 frames. Segments
+      are encoded with an overlap and without the bit reservoir, so that MP3
+      frames of different segments can be joined without gaps.
+
+      :param min_length: Minimum track length to split, in seconds.
+      :type  min_length: int
+
+      :param count:  Maximum number of segments.
+      :type  count:  int
+
+      :param force:  When :data:`True`, encoding will be done, even if
+                     destination file exists.
+      :type  force:  boolean
+
+      :return: Number of segments; 0 if no encoding is needed, or 1 if the
+               file is not split.
+      """
+      if not (force or self.is_stale()):
+         return 0
+      if self.track:
+         return 1
+      try:
+         info = decoder.FlacDecoder(self.src).info
+      except (IOError, ValueError):
+         return 1
+      if info.rate not in mp3.RATES[1] or info.duration < min_length:
+         return 1
+      count = min( count, int(info.duration // MIN_SEGMENT) )
+      if count < 2:
+         return 1
+      block = info.block_size or 1
+      align = MP3_FRAME * block // fractions.gcd( MP3_FRAME, block )
+      bounds = [0]
+      for i in range(1,count):
+         b = align * int(round( info.samples * i / float(count*align) ))
+         if bounds[-1] < b < info.samples:
+            bounds.append( b )
+      bounds.append( info.samples )
+      self._samples = info.samples
+      self._rate = info.rate
+      self._segments = zip( bounds[:-1], bounds[1:] )
+      return len(self._segments)
+
+   def _get_segments( self ):
+      return self._samples, self._rate, self._segments
+
+   def _set_segments( self, segments ):
+      self._samples, self._rate, self._segments = segments
+
+   #: Segments of :meth:`split`, as a tuple of the source samples, the sample
+   #: rate and the (start, end) sample of each segment; used to encode the
+   #: segments with another encoder object of the file.
+   segments = property( _get_segments, _set_segments )
+
+   def encode_segment( self, index ):
+      """
+      Encode a single segment of the source file to a temporary file, in a
+      temporary directory (not in the destination, where an aborted run would
+      leave it behind).
+
+      :param index: Segment index.
+      :type  index: int
+
+      :return: :data:`True` if encoding succeeded.
+      """
+      self._pre_encode()
+      start,end = self._segments[index]
+      skip = max( 0, start - SEGMENT_OVERLAP )
+      until = end + SEGMENT_OVERLAP
+      until = '--until=%d' % (until,) if until < self._samples else ''
+      # only the first segment keeps the LAME info frame
+      opts = '-t' if index else ''
+      err = _call( 'flac -d "%s" -c -s --skip=%d %s | '
+            'lame %s --nores --resample %g -V %s - "%s"' %
+            (self.src, skip, until, opts, self._rate/1000.0, self.q,
+             self._part(index)), shell=True, stderr=null())
+      if err == -2:  # keyboard interrupt
+         self._remove_parts()
+         raise KeyboardInterrupt
+      return self._check_err( err, "MP3 encoder failed:" )
+
+   def join_segments( self, discard=False ):
+      """
+      Join all encoded segments into the destination file, and remove the
+      temporary segment files.
+
+      :param discard: When :data:`True`, segments are only removed, i.e.
+                      after one of the segments failed to encode.
+      :type  discard: boolean
+
+      :return: :data:`True` if the segments were joined and no errors.
+      """
+      if discard:
+         self._remove_parts()
+         return False
+      try:
+         segments = []
+         for i,(start,end) in enumerate(self._segments):
+            with open(self._part(i), 'rb') as fh:
+               data = fh.read()
+            first = (start - max(0, start - SEGMENT_OVERLAP)) // MP3_FRAME
+            count = None
+            if end < self._samples:
+               count = (end - start) // MP3_FRAME
+            segments.append( (data, first, count) )
+         with open(self.dst, 'wb') as fh:
+            fh.write( mp3.empty_id3v2() )
+            mp3.join( fh, segments, self._samples )
+         return True
+      except (IOError, ValueError) as exc:
+         if os.path.exists(self.dst):
+            os.remove(self.dst)
+         return self._check_err( exc, "MP3 join failed:" )
+      finally:
+         self._remove_parts()
+
+   def _part( self, index ):
+      with _parts_lock:
+         # shared by the segments, encoded in several threads
+         if self._parts is None:
+            self._parts = tempfile.mkdtemp( prefix='flacsync-' )
+      return os.path.join( self._parts, 'part%d.mp3' % (index,) )
+
+   def _remove_parts( self ):
+      with _parts_lock:
+         if self._parts is not None:
+            shutil.rmtree( self._parts, ignore_errors=True )
+            self._parts = None
+
    # uses mutagen tagging library
    def tag( self, tags):
       """
@@ -396,12 +806,28 @@ class Mp3Encoder( _Encoder ):
       }
       mp3_fields = dict((k,v) for k,v in mp3_fields.items() if v)
       # tag MP3 file
-      audio = EasyID3(self.dst)
+      audio = easyid3.EasyID3(self.dst)
       for x,y in mp3_fields.items():
         audio[x] = y
       err = audio.save()
       return self._check_err( err, "MP3 tag failed:" )
 
+   def set_album_gain( self, gain, peak ):
+      """
+      Add album ReplayGain values to MP3 file.
+
+      :param gain: Album gain tag value.
+      :type  gain: str
+
+      :param peak: Album peak tag value.
+      :type  peak: str
+      """
+      audio = easyid3.EasyID3(self.dst)
+      audio['replaygain_album_gain'] = gain
+      audio['replaygain_album_peak'] = peak
+      err = audio.save()
+      return self._check_err( err, "MP3 album gain failed:" )
+
    # See section 4.14 at http://www.id3.org/id3v2.4.0-frames
    # for more details regarding embedded ID3 pictures
    def set_cover( self, force=False, resize=False ):
@@ -419,9 +845,9 @@ class Mp3Encoder( _Encoder ):
       if self.cover and (force or util.newer(self.cover,self.dst)):
          tmp_cover = self._cover_thumbnail(resize)
          imagedata = open(tmp_cover.name, 'rb').read()
-         pic = APIC(encoding=3, mime="image/jpeg", type=3, desc=u"Front Cover",
-                    data=imagedata)
-         audio = MP3(self.dst)
+         pic = id3.APIC(encoding=3, mime="image/jpeg", type=3,
+                        desc=u"Front Cover", data=imagedata)
+         audio = mp3file.MP3(self.dst)
          audio.tags.add(pic)
          err = audio.save()
-      return self._check_err( err, "MP3 add-cover failed:" )
+         return self._check_err( err, "MP3 add-cover failed:" )
@@ -0,0 +1,160 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.fingerprint
+   ~~~~~~~~~~~~~~~~~~~~
+
+   Define a record of the encoder settings used for each output file, so
+   that a change of settings only re-encodes the outputs that do not match.
+
+   A fingerprint is a short hash of the encoder type, the encoder program
+   version and the options that change the encoded audio (quality, max rate
+   and bits). The fingerprint of each output file is stored in the
+   destination directory.
+
+   Output files without a recorded fingerprint (i.e. encoded by an older
+   version of flacsync) are assumed to match the current settings.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess as sp
+import threading
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Name of the fingerprint file, in :data:`flacsync.util.STATE_DIR`.
+FINGERPRINT_FILE = 'settings.json'
+
+#: Command printing the version of each encoder program, by encoder type.
+VERSION_CMDS = {
+   'aac'    :['neroAacEnc', '-help'],
+   'ogg'    :['oggenc', '--version'],
+   'mp3'    :['lame', '--version'],
+   }
+
+_VERSION = re.compile(r'\d+(?:\.\d+)+')
+
+
+def encoder_version( enc_type ):
+   """
+   :returns: Version string of the program of an encoder type, or
+             :data:`None` if it is unknown.
+   """
+   cmd = VERSION_CMDS.get( enc_type )
+   if not cmd:
+      return None
+   try:
+      out = sp.Popen( cmd, stdout=sp.PIPE, stderr=sp.STDOUT ).communicate()[0]
+   except OSError:
+      return None
+   match = _VERSION.search( out )
+   return match.group(0) if match else None
+
+
+def fingerprint( enc_type, enc_opts, max_rate=None, max_bits=None ):
+   """
+   :param enc_type: Encoder type (i.e. ``aac``).
+   :type  enc_type: str
+
+   :param enc_opts: Options of the encoder class (i.e. ``{'aac_q':'0.3'}``).
+   :type  enc_opts: dict
+
+   :param max_rate: Maximum sample rate (Hz) passed to the encoder.
+   :type  max_rate: int
+
+   :param max_bits: Maximum bits per sample passed to the encoder.
+   :type  max_bits: int
+
+   :returns: Fingerprint string of the encoder settings.
+   """
+   settings = sorted( enc_opts.items() ) + [
+         ('encoder', enc_type), ('version', encoder_version(enc_type)),
+         ('max_rate', max_rate), ('max_bits', max_bits)]
+   return hashlib.md5( repr(settings) ).hexdigest()[:12]
+
+
+#############################################################################
+class Fingerprints( object ):
+   """
+   Record of the fingerprint of each output file, stored in the destination
+   directory.
+   """
+   def __init__( self, dest_dir, current ):
+      """
+      :param dest_dir: Destination root directory.
+      :type  dest_dir: str
+
+      :param current: Fingerprint of the current settings, see
+                      :func:`fingerprint`.
+      :type  current: str
+      """
+      self.dest_dir = dest_dir
+      self.current = current
+      self.path = os.path.join( dest_dir, util.STATE_DIR, FINGERPRINT_FILE )
+      self._lock = threading.Lock()
+      self._changes = {}
+      data = self._load()
+      #: Fingerprint of the settings of the previous run.
+      self.last = data.get('last')
+      self.entries = data.get('files', {})
+
+   def changed( self, encoder ):
+      """
+      :returns: :data:`True` if the output of an encoder object was encoded
+                with other settings. An existing output without a
+                fingerprint is recorded with the current settings.
+      """
+      key = self._key( encoder )
+      with self._lock:
+         fp = self.entries.get( key )
+         if fp is None:
+            if os.path.exists( encoder.dst ):
+               self.entries[key] = self._changes[key] = self.current
+            return False
+         return fp != self.current
+
+   def record( self, encoder ):
+      """Record an output file, encoded with the current settings."""
+      key = self._key( encoder )
+      with self._lock:
+         self.entries[key] = self._changes[key] = self.current
+
+   def save( self ):
+      """
+      Write the fingerprints of the outputs of this run, and the current
+      settings as the last used, to disk.
+      """
+      with self._lock:
+         changes,self._changes = self._changes,{}
+      if not changes and (self.last == self.current or not self.entries):
+         return
+      entries = util.merge( self._load().get('files', {}), changes )
+      util.save_json( self.path, {'last':self.current, 'files':entries} )
+      with self._lock:
+         # keep the changes recorded while saving
+         self.entries = util.merge( entries, self._changes )
+      self.last = self.current
+
+   def _key( self, encoder ):
+      return os.path.relpath( encoder.dst, self.dest_dir )
+
+   def _load( self ):
+      try:
+         with open(self.path) as fh:
+            data = json.load(fh)
+         data['files'] = dict( (k.encode('utf-8'),v.encode('utf-8'))
+                               for k,v in data['files'].items() )
+         return data
+      except (IOError, ValueError, KeyError, AttributeError):
+         return {}
@@ -0,0 +1,218 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.index
+   ~~~~~~~~~~~~~~
+
+   Define a persistent index of the tags of all source files, used to select
+   source files by a tag query.
+
+   The index is a SQLite database stored in the base directory. Each file is
+   recorded with its size and mtime, and an update only reads the tags of
+   new or changed files (in parallel). A query is answered from the
+   database alone, without walking the source tree or reading any FLAC
+   file.
+
+   A query term has the form ``NAME OP VALUE``, where ``NAME`` is a Vorbis
+   comment field (or flacsync tag name, e.g. ``album_artist``) and ``OP`` is
+   one of:
+
+   ======  ================================================================
+   ``=``   Equal to one of the values separated by ``|`` (ignoring case)
+   ``!=``  Not equal to any of the values, or the tag is missing
+   ``~``   Contains one of the values separated by ``|`` (ignoring case)
+   ``<``   Less than a number (also ``<=``, ``>``, ``>=``)
+   ======  ================================================================
+"""
+
+import multiprocessing.dummy as mp
+import os
+import re
+import sqlite3
+
+from . import decoder
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Name of the index file, in :data:`flacsync.util.STATE_DIR`.
+INDEX_FILE = 'tags.db'
+
+_TERM = re.compile(r'^\s*([\w-]+)\s*(!=|<=|>=|=|~|<|>)\s*(.*?)\s*$')
+
+_SCHEMA = """
+   CREATE TABLE IF NOT EXISTS files (
+      path TEXT PRIMARY KEY, size INTEGER, mtime REAL );
+   CREATE TABLE IF NOT EXISTS tags (
+      path TEXT, name TEXT, value TEXT );
+   CREATE INDEX IF NOT EXISTS tags_path ON tags (path);
+   CREATE INDEX IF NOT EXISTS tags_name ON tags (name, value);
+"""
+
+
+#############################################################################
+class TagIndex( object ):
+   """
+   SQLite index of the tags of the FLAC files in a base directory.
+   """
+   def __init__( self, base_dir, path=None ):
+      """
+      :param base_dir: Base directory of FLAC files.
+      :type  base_dir: str
+
+      :param path:   File path of the database, defaults to
+                     :data:`INDEX_FILE` in the base directory.
+      :type  path:   str
+      """
+      self.base_dir = base_dir
+      self.path = path or os.path.join( base_dir, util.STATE_DIR, INDEX_FILE )
+      try:
+         os.makedirs( os.path.dirname(self.path) )
+      except OSError: pass  # ignore if dir already exists
+      self._db = sqlite3.connect( self.path )
+      self._db.text_factory = str   # paths are byte strings
+      self._db.executescript( _SCHEMA )
+
+   def close( self ):
+      self._db.close()
+
+   def update( self, threads=1 ):
+      """
+      Walk the base directory, and read the tags of all new or changed
+      files. Files that no longer exist are removed from the index.
+
+      :param threads: Number of threads reading tags.
+      :type  threads: int
+
+      :returns: Tuple of the number of updated and removed files.
+      """
+      known = dict( (p,(s,m)) for p,s,m in
+                     self._db.execute('SELECT path, size, mtime FROM files') )
+      found = set()
+      changed = []
+      for root, dirs, files in os.walk( self.base_dir, followlinks=True ):
+         if root == self.base_dir and util.STATE_DIR in dirs:
+            dirs.remove( util.STATE_DIR )
+         for f in files:
+            if os.path.splitext(f)[1] != '.flac':
+               continue
+            path = os.path.join(root,f)
+            rel = os.path.relpath( path, self.base_dir )
+            try:
+               st = os.stat( path )
+            except OSError:
+               continue
+            found.add( rel )
+            if known.get(rel) != (st.st_size, st.st_mtime):
+               changed.append( (path, rel, st.st_size, st.st_mtime) )
+      removed = [p for p in known if p not in found]
+
+      pool = mp.Pool( processes=threads )
+      try:
+         with self._db:
+            for p in removed:
+               self._delete( p )
+            for rel,size,mtime,tags in pool.imap_unordered( _read_entry,
+                                                            changed, 16 ):
+               self._delete( rel )
+               self._db.execute( 'INSERT INTO files VALUES (?,?,?)',
+                                 (rel, size, mtime) )
+               self._db.executemany( 'INSERT INTO tags VALUES (?,?,?)',
+                     ((rel,k,_fold(v)) for k,vals in tags.items()
+                                       for v in vals) )
+      finally:
+         pool.close()
+         pool.join()
+      return len(changed), len(removed)
+
+   def select( self, terms, sources=None ):
+      """
+      Return the source files matching all query terms.
+
+      :param terms:  List of query terms, see :func:`parse_term`.
+      :type  terms:  list
+
+      :param sources: List of 0 or more absolute paths, to restrict the
+                      result to files found under one (or more) path.
+      :type  sources: list
+
+      :returns: Sorted list of source files with absolute path names.
+      """
+      where = []
+      args = []
+      for term in terms:
+         sql,term_args = _term_sql( *parse_term(term) )
+         where.append( sql )
+         args.extend( term_args )
+      query = 'SELECT path FROM files'
+      if where:
+         query += ' WHERE ' + ' AND '.join(where)
+      files = [os.path.join(self.base_dir, p)
+                  for p, in self._db.execute( query, args )]
+      if sources:
+         # match whole path components, i.e. 'a' does not select 'ab/1.flac'
+         dirs = [p.rstrip(os.sep) + os.sep for p in sources]
+         files = [f for f in files if f in sources or
+                  any(f.startswith(d) for d in dirs)]
+      return sorted( files )
+
+   def _delete( self, rel ):
+      self._db.execute( 'DELETE FROM files WHERE path=?', (rel,) )
+      self._db.execute( 'DELETE FROM tags WHERE path=?', (rel,) )
+
+
+def parse_term( text ):
+   """
+   Parse a query term, such as ``genre=Jazz|Blues`` or ``rating>=4``.
+
+   :returns: Tuple of (field name, operator, value).
+   :raises: :exc:`ValueError` if the term is invalid.
+   """
+   match = _TERM.match( text )
+   if not match or not match.group(3):
+      raise ValueError( "invalid query '%s'" % (text,) )
+   name,op,value = match.groups()
+   name = name.lower()
+   name = decoder.FlacDecoder.FLAC_TAGS.get( name, name )
+   if op in ('<','<=','>','>='):
+      value = float( value )   # raises ValueError
+   return name, op, value
+
+
+def _term_sql( name, op, value ):
+   # SQL condition and arguments of a parsed query term
+   match = 'EXISTS (SELECT 1 FROM tags t WHERE t.path=files.path AND t.name=?'
+   if op in ('=','!='):
+      values = [_fold(v) for v in value.split('|')]
+      sql = '%s AND t.value IN (%s))' % (match, ','.join('?'*len(values)))
+      if op == '!=':
+         sql = 'NOT ' + sql
+      return sql, [name] + values
+   if op == '~':
+      values = [_fold(v) for v in value.split('|')]
+      like = ' OR '.join(["t.value LIKE ? ESCAPE '\\'"] * len(values))
+      return ('%s AND (%s))' % (match, like),
+              [name] + ['%' + re.sub(r'([%_\\])', r'\\\1', v) + '%'
+                        for v in values])
+   return ('%s AND CAST(t.value AS REAL) %s ?)' % (match, op), [name, value])
+
+
+def _fold( value ):
+   # tag values are matched ignoring case
+   return value.decode('utf-8', 'replace').lower().encode('utf-8')
+
+
+def _read_entry( args ):
+   # read the tags of a file, for a thread pool
+   path,rel,size,mtime = args
+   try:
+      tags = decoder.FlacDecoder( path ).comments
+   except (IOError, ValueError):
+      tags = {}   # indexed without tags, to not read it again
+   return rel, size, mtime, tags
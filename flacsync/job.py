@@ -0,0 +1,215 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.job
+   ~~~~~~~~~~~~
+
+   Define a compact record of each source file to sync, so that the plan of
+   a large library does not keep an encoder object for every file.
+
+   A :class:`Job` stores its source and destination paths as an index into
+   a directory table shared by all jobs of a :class:`Plan`, and a file name.
+   An encoder object is created when it is needed, i.e. to check if the
+   output is up to date (then discarded), and again when the job is
+   dispatched to a worker (kept until the job is finished, see
+   :meth:`Job.release`).
+"""
+
+import os
+
+from . import cue
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#############################################################################
+class Plan( object ):
+   """
+   Factory of the jobs of one encoder class, and their directory table.
+   """
+   def __init__( self, enc_class, **kwargs ):
+      """
+      :param enc_class: Encoder class of the jobs.
+      :type  enc_class: :class:`~flacsync.encoder._Encoder`
+
+      :param kwargs:    Keyword arguments of the encoder objects, other than
+                        ``src``.
+      """
+      self.enc_class = enc_class
+      self.kwargs = kwargs
+      #: Table of directory paths, indexed by :attr:`Job.dir`.
+      self.dirs = []
+      #: Extension of the destination files, learned from the first encoder.
+      self.ext = None
+      #: Number of jobs added.
+      self.count = 0
+      self._index = {}
+
+   def add( self, src ):
+      """
+      :param src:  Source file path, or :class:`~flacsync.cue.TrackPath`.
+      :type  src:  str
+
+      :returns: New :class:`Job` of a source file.
+      """
+      dir_,name = self.split( src )
+      self.count += 1
+      return Job( self, dir_, name, getattr(src, 'track', None) )
+
+   def split( self, path ):
+      """:returns: Tuple of the directory index and file name of a path."""
+      dir_,name = os.path.split( path )
+      index = self._index.get( dir_ )
+      if index is None:
+         index = self._index[dir_] = len(self.dirs)
+         self.dirs.append( dir_ )
+      return index, name
+
+
+#############################################################################
+class Job( object ):
+   """
+   Source file of a :class:`Plan`, and the encoder object while the job is
+   dispatched.
+
+   The attributes used to plan the sync (:attr:`src`, :attr:`flac`,
+   :attr:`track`, :attr:`dst`) are read without an encoder object. The
+   cover art attributes used by :class:`~flacsync.album.Album` are read
+   from the encoder object, which is kept until :meth:`release`.
+   """
+   __slots__ = ('plan', 'dir', 'name', 'track', 'changed', '_dst_dir',
+                '_dst_name', '_encoder', '_segments')
+
+   def __init__( self, plan, dir_, name, track=None ):
+      self.plan = plan
+      self.dir = dir_
+      self.name = name
+      #: :class:`~flacsync.cue.Track` of a FLAC image, or :data:`None`
+      self.track = track
+      #: :data:`True` if the output was encoded with other settings, see
+      #: :func:`pending`.
+      self.changed = False
+      self._dst_dir = None
+      self._dst_name = None
+      self._encoder = None
+      self._segments = None
+
+   @property
+   def src( self ):
+      """Source file path."""
+      if self.track:
+         return cue.TrackPath( self.track )
+      return os.path.join( self.plan.dirs[self.dir], self.name )
+
+   @property
+   def flac( self ):
+      """Path of the FLAC file to decode."""
+      return self.track.image if self.track else self.src
+
+   @property
+   def dst( self ):
+      """Destination file path."""
+      if self._dst_dir is None:
+         self._create()   # learn the destination from an encoder object
+      name = self._dst_name
+      if name is None:
+         name = os.path.splitext( self.name )[0] + self.plan.ext
+      return os.path.join( self.plan.dirs[self._dst_dir], name )
+
+   @property
+   def SEGMENTS( self ):
+      """Encoder supports parallel encoding of track segments."""
+      return getattr( self.plan.enc_class, 'SEGMENTS', False )
+
+   def encoder( self ):
+      """:returns: Encoder object of the job, kept until :meth:`release`."""
+      if self._encoder is None:
+         self._encoder = self._create()
+         if self._segments:
+            self._encoder.segments = self._segments
+      return self._encoder
+
+   def release( self ):
+      """Discard the encoder object, once the job is finished."""
+      self._encoder = None
+
+   def skip_encode( self ):
+      """See :meth:`flacsync.encoder._Encoder.skip_encode`."""
+      return self._current().skip_encode()
+
+   def is_stale( self ):
+      """See :meth:`flacsync.encoder._Encoder.is_stale`."""
+      return self._current().is_stale()
+
+   def split( self, min_length, count, force=False ):
+      """
+      See :meth:`flacsync.encoder.Mp3Encoder.split`. Only the segments are
+      kept, for the encoder object of :meth:`encoder`.
+      """
+      enc = self._current()
+      count = enc.split( min_length, count, force )
+      self._segments = enc.segments if count > 1 else None
+      return count
+
+   # cover art of an album, see flacsync.album.Album
+   @property
+   def cover( self ):
+      return self.encoder().cover
+
+   @property
+   def cover_dst( self ):
+      return self.encoder().cover_dst
+
+   def _get_cover_data( self ):
+      return self.encoder().cover_data
+
+   def _set_cover_data( self, data ):
+      self.encoder().cover_data = data
+
+   cover_data = property( _get_cover_data, _set_cover_data )
+
+   def thumbnail_data( self, resize=False ):
+      return self.encoder().thumbnail_data( resize )
+
+   def copy_cover( self, force=False ):
+      return self.encoder().copy_cover( force )
+
+   def _current( self ):
+      # the kept encoder object, or a temporary one
+      return self._encoder or self._create()
+
+   def _create( self ):
+      plan = self.plan
+      enc = plan.enc_class( src=self.src, **plan.kwargs )
+      if self._dst_dir is None:
+         self._dst_dir,name = plan.split( enc.dst )
+         if plan.ext is None:
+            plan.ext = os.path.splitext( name )[1]
+         if name != os.path.splitext( self.name )[0] + plan.ext:
+            self._dst_name = name
+      return enc
+
+
+def pending( jobs, force=False ):
+   """
+   Select the jobs with an output that is not up to date. An encoder object
+   is created for each job, and discarded.
+
+   :param jobs:   Job objects.
+   :type  jobs:   list
+
+   :param force:  Select all jobs.
+   :type  force:  boolean
+
+   :returns: Generator of the selected :class:`Job` objects.
+   """
+   for j in jobs:
+      enc = j._current()
+      if force or not enc.skip_encode():
+         j.changed = bool( enc.settings_changed() )
+         yield j
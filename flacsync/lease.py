@@ -0,0 +1,287 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.lease
+   ~~~~~~~~~~~~~~
+
+   Define a work queue shared by multiple flacsync instances (i.e. on
+   different hosts), that sync the same source and destination directories.
+
+   Each job is claimed by atomically creating a lease file in a shared
+   directory. Leases of running jobs are refreshed by a heartbeat, and a
+   lease that has not been refreshed within the expiry time is reclaimed by
+   another instance, so that the jobs of a dead instance are not lost.
+
+   An expired lease is replaced in place (by a rename over the lease file),
+   so that the job always has a lease, while one instance at a time holds
+   the reclaim lock of the lease. The output of a reclaimed job may be
+   partial, so it is discarded, and the job is done again. An instance that
+   finds its lease replaced (i.e. after a stall longer than the expiry
+   time) has lost the job; it stops the job (see :meth:`LeaseQueue.owns`),
+   and leaves the new lease alone.
+
+   The lease files are only accessed outside of the queue lock, so a slow
+   shared file system does not block the heartbeat of the held leases.
+
+   .. note::
+
+      Lease times are compared with the local clock, so the clocks of all
+      hosts must be synchronized to well below the expiry time.
+"""
+
+import errno
+import hashlib
+import os
+import socket
+import threading
+import time
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Time (in seconds) after which a lease without heartbeat is expired.
+EXPIRY = 300
+#: Delay (in seconds) between claim attempts, while all remaining jobs are
+#: leased by other instances.
+POLL = 5
+
+
+#############################################################################
+class LeaseQueue( object ):
+   """
+   Thread-safe queue of jobs, claimed through lease files.
+   """
+   def __init__( self, path, jobs, key, is_done, discard=None, expiry=EXPIRY,
+                 poll=POLL ):
+      """
+      :param path:   Directory of the lease files, shared by all instances.
+      :type  path:   str
+
+      :param jobs:   List of job objects.
+      :type  jobs:   list
+
+      :param key:    Function returning a string that identifies a job, the
+                     same on all instances (i.e. a relative path).
+      :type  key:    function
+
+      :param is_done: Function returning :data:`True` if a job has been
+                      completed, i.e. by another instance. Called while the
+                      lease is held.
+      :type  is_done: function
+
+      :param discard: Function removing the output of a job, that may be
+                      partial since the lease was reclaimed from an instance
+                      that died (or stalled).
+      :type  discard: function
+
+      :param expiry: Lease expiry time, in seconds.
+      :type  expiry: float
+
+      :param poll:   Delay between claim attempts, in seconds.
+      :type  poll:   float
+      """
+      self.path = path
+      self.expiry = expiry
+      self.poll = poll
+      self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+      self._key = key
+      self._is_done = is_done
+      self._discard = discard
+      self._pending = list(jobs)
+      self._claiming = set()
+      self._held = {}
+      #: Jobs of leases that were reclaimed by another instance, while held.
+      self.lost = []
+      self._lock = threading.Lock()
+      self._stop = threading.Event()
+      self._thread = None
+      try:
+         os.makedirs( path )
+      except OSError: pass  # ignore if dir already exists
+
+   def start( self ):
+      """Start the heartbeat thread."""
+      self._thread = threading.Thread( target=self._heartbeat )
+      self._thread.daemon = True
+      self._thread.start()
+
+   def stop( self ):
+      """Stop the heartbeat thread, and release all held leases."""
+      self._stop.set()
+      if self._thread:
+         self._thread.join()
+      with self._lock:
+         held = self._held.keys()
+      for job in held:
+         self.release( job )
+
+   def claim( self ):
+      """
+      Claim the next job. Blocks while all remaining jobs are leased by other
+      instances.
+
+      :returns: Job object, or :data:`None` if no jobs remain.
+      """
+      while True:
+         with self._lock:
+            jobs = [j for j in self._pending if j not in self._claiming]
+            if not self._pending:
+               return None
+         for job in jobs:
+            with self._lock:
+               if job not in self._pending or job in self._claiming:
+                  continue   # claimed by another thread
+               self._claiming.add( job )
+            try:
+               held = self._acquire( job )
+               if held:
+                  with self._lock:
+                     self._pending.remove( job )
+                     self._held[job] = held[:2]
+            finally:
+               with self._lock:
+                  self._claiming.discard( job )
+            if not held:
+               continue
+            if held[2]:
+               # the output of the dead instance may be partial
+               if self._discard:
+                  self._discard( job )
+            elif self._is_done( job ):
+               self.release( job )
+               continue
+            return job
+         with self._lock:
+            if not self._pending:
+               return None
+         time.sleep( self.poll )
+
+   def release( self, job ):
+      """Release the lease of a completed job."""
+      with self._lock:
+         held = self._held.pop( job, None )
+      if held and self._owns( *held ):
+         try:
+            os.remove( held[0] )
+         except OSError: pass
+
+   def owns( self, job ):
+      """
+      :returns: :data:`True` if the lease of a claimed job is still held,
+                i.e. it was not reclaimed by another instance. A lost job
+                must be stopped, without changing its output.
+      """
+      with self._lock:
+         held = self._held.get( job )
+      if held and self._owns( *held ):
+         return True
+      self._lose( job, held )
+      return False
+
+   def _lease( self, job ):
+      name = hashlib.md5( self._key(job) ).hexdigest()
+      return os.path.join( self.path, name + '.lease' )
+
+   def _acquire( self, job ):
+      """
+      Create the lease of a job, or reclaim an expired lease.
+
+      :returns: Tuple of the lease path, the inode of the lease (which
+                identifies this lease, once replaced by another instance)
+                and :data:`True` if the lease was reclaimed; or :data:`None`
+                if the job is leased by another instance.
+      """
+      lease = self._lease( job )
+      data = '%s %s\n' % (self.owner, self._key(job))
+      try:
+         fd = os.open( lease, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644 )
+      except OSError as exc:
+         if exc.errno != errno.EEXIST:
+            return None
+         inode = self._reclaim( lease, data )
+         if inode is None:
+            return None
+         return lease, inode, True
+      os.write( fd, data )
+      inode = os.fstat( fd ).st_ino
+      os.close( fd )
+      return lease, inode, False
+
+   def _reclaim( self, lease, data ):
+      """
+      Replace an expired lease with a lease of this instance.
+
+      :returns: Inode of the new lease, or :data:`None` if the lease is live,
+                or is reclaimed by another instance.
+      """
+      try:
+         if time.time() - os.stat(lease).st_mtime < self.expiry:
+            return None
+      except OSError:
+         return None   # released, created again by the next claim
+      lock = lease + '.reclaim'
+      try:
+         os.close( os.open(lock, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644) )
+      except OSError:
+         self._break( lock )
+         return None
+      tmp = '%s.%s.tmp' % (lease, self.owner)
+      try:
+         # check again, since another instance may have reclaimed the lease
+         # between the first check and the lock
+         if time.time() - os.stat(lease).st_mtime < self.expiry:
+            return None
+         with open(tmp, 'w') as fh:
+            fh.write( data )
+            inode = os.fstat( fh.fileno() ).st_ino
+         # rename is atomic, so the lease file is never missing
+         os.rename( tmp, lease )
+         return inode
+      except (IOError, OSError):
+         return None
+      finally:
+         if os.path.exists( tmp ):
+            os.remove( tmp )
+         try:
+            os.remove( lock )
+         except OSError: pass  # ignore if broken by another instance
+
+   def _break( self, lock ):
+      # remove the reclaim lock of an instance that died while holding it
+      try:
+         if time.time() - os.stat(lock).st_mtime >= self.expiry:
+            os.remove( lock )
+      except OSError: pass
+
+   def _owns( self, lease, inode ):
+      try:
+         return os.stat( lease ).st_ino == inode
+      except OSError:
+         return False
+
+   def _lose( self, job, held ):
+      # record a job of a lease that was replaced by another instance
+      with self._lock:
+         if held is None or self._held.get( job ) != held:
+            return   # already lost, or released
+         del self._held[job]
+         self.lost.append( job )
+      print "WARN: lease of '%s' was reclaimed by another instance" % (
+            self._key(job),)
+
+   def _heartbeat( self ):
+      while not self._stop.wait( self.expiry / 4.0 ):
+         with self._lock:
+            held = self._held.items()
+         for job,(lease,inode) in held:
+            if not self._owns( lease, inode ):
+               self._lose( job, (lease, inode) )
+               continue
+            try:
+               os.utime( lease, None )
+            except OSError: pass
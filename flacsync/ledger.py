@@ -0,0 +1,148 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.ledger
+   ~~~~~~~~~~~~~~~
+
+   Define a persistent record of files that failed to encode, so that broken
+   source files are not retried on every run.
+
+   Each failure is keyed by the source path (relative to the base
+   directory), and the size and mtime of the source file. A failed file is
+   skipped until its backoff time expires, where the backoff doubles after
+   each failure. A file is retried at once if the source file changes.
+"""
+
+import json
+import os
+import threading
+import time
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Delay (in seconds) before the first retry of a failed file.
+BACKOFF = 12*3600
+#: Max delay (in seconds) between retries.
+MAX_BACKOFF = 32*24*3600
+#: Max length of the recorded error output.
+MAX_ERROR = 2000
+
+
+#############################################################################
+class Ledger( object ):
+   """
+   Record of failed files, stored in the destination directory.
+   """
+   def __init__( self, base_dir, dest_dir, clock=time.time ):
+      """
+      :param base_dir: Base directory of FLAC files.
+      :type  base_dir: str
+
+      :param dest_dir: Destination root directory.
+      :type  dest_dir: str
+
+      :param clock:  Time function, for testing.
+      :type  clock:  function
+      """
+      self.base_dir = base_dir
+      self.path = os.path.join( dest_dir, util.STATE_DIR, 'failures.json' )
+      self._clock = clock
+      self._lock = threading.Lock()
+      self._changes = {}
+      #: Number of files that failed in this run.
+      self.failed = 0
+      self.entries = self._load()
+
+   def skip( self, encoder ):
+      """
+      :returns: :data:`True` if the file failed before, the source has not
+                changed, and the backoff time has not expired.
+      """
+      if not self.entries:
+         return False
+      entry = self.entries.get( self._key(encoder) )
+      return bool( entry and entry['source'] == _identity(encoder) and
+                   self._clock() < entry['retry'] )
+
+   def record( self, encoder, stage, error=None ):
+      """
+      Record a failed file.
+
+      :param encoder: Encoder object of the file.
+      :type  encoder: :mod:`flacsync.encoder`._Encoder
+
+      :param stage:  Name of the processing step that failed.
+      :type  stage:  str
+
+      :param error:  Error message or output.
+      :type  error:  str
+      """
+      key = self._key( encoder )
+      source = _identity( encoder )
+      with self._lock:
+         old = self.entries.get( key )
+         count = 1
+         if old and old['source'] == source:
+            count = old['count'] + 1
+         now = self._clock()
+         delay = min( BACKOFF * 2**(count-1), MAX_BACKOFF )
+         error = (error or '').decode('utf-8', 'replace')[-MAX_ERROR:]
+         entry = {'source':source, 'stage':stage, 'count':count,
+                  'error':error, 'time':now, 'retry':now + delay}
+         self.entries[key] = self._changes[key] = entry
+         self.failed += 1
+
+   def clear( self, encoder ):
+      """Remove the record of a file that was encoded successfully."""
+      key = self._key( encoder )
+      with self._lock:
+         if key in self.entries:
+            del self.entries[key]
+            self._changes[key] = None
+
+   def save( self ):
+      """
+      Write the failures recorded (and cleared) by this run to disk. Other
+      instances may share the ledger, so only the changed entries replace
+      those of the file.
+      """
+      with self._lock:
+         changes,self._changes = self._changes,{}
+      if not changes:
+         return
+      entries = util.merge( self._load(), changes )
+      util.save_json( self.path, entries, indent=1, sort_keys=True )
+      with self._lock:
+         # keep the changes recorded while saving
+         self.entries = util.merge( entries, self._changes )
+
+   def _key( self, encoder ):
+      return os.path.relpath( encoder.src, self.base_dir )
+
+   def _load( self ):
+      try:
+         with open(self.path) as fh:
+            entries = json.load(fh)
+         return dict( (k.encode('utf-8'),v) for k,v in entries.items() )
+      except (IOError, ValueError, AttributeError):
+         return {}
+
+
+def _identity( encoder ):
+   # size and mtime of the source, and the cue sheet of an image track
+   try:
+      st = os.stat( encoder.flac )
+      source = [st.st_size, int(st.st_mtime)]
+      if encoder.track and encoder.track.cue:
+         source.append( int(os.path.getmtime(encoder.track.cue)) )
+      return source
+   except OSError:
+      return None
@@ -0,0 +1,237 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.loudness
+   ~~~~~~~~~~~~~~~~~
+
+   Define a streaming loudness analyzer, used to compute ReplayGain 2.0
+   track and album values from the PCM samples passed to an encoder.
+
+   Loudness is measured according to ITU-R BS.1770 / EBU R128, and the gain
+   is relative to the ReplayGain 2.0 reference level of -18 LUFS.
+
+   .. note::
+
+      The analyzer requires the :mod:`numpy` package.
+"""
+
+import math
+import threading
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: ReplayGain 2.0 reference loudness, in LUFS.
+REFERENCE = -18.0
+#: Absolute gating threshold, in LUFS.
+ABS_GATE = -70.0
+#: Relative gating threshold, in LU.
+REL_GATE = -10.0
+#: Length of the K-weighting FIR approximation, in seconds.
+FILTER_LEN = 0.2
+
+# numpy is only imported by a run that analyzes loudness
+np = util.LazyModule( 'numpy' )
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+def available():
+   """:returns: :data:`True` if loudness analysis is supported."""
+   return util.importable( np )
+
+
+#############################################################################
+class Loudness( object ):
+   """
+   Streaming loudness analyzer for a single track. Instances are used as a
+   :func:`flacsync.pcm.pipe` tap.
+   """
+   def __init__( self ):
+      self.peak = 0.0
+      self._fmt = None
+
+   def start( self, fmt ):
+      """
+      :param fmt: Sample format of the stream.
+      :type  fmt: :class:`~flacsync.pcm.WavFormat`
+      """
+      self._fmt = fmt
+      self._h = _k_filter( fmt.rate )
+      self._hist = np.zeros( (len(self._h)-1, fmt.channels) )
+      self._weights = _channel_weights( fmt.channels )
+      self._step = int(round(fmt.rate * 0.1))  # 100ms gating sub-blocks
+      self._pending = np.zeros(0)
+      self._subblocks = []
+
+   def feed( self, samples ):
+      """
+      Analyze a block of samples.
+
+      :param samples: Array of shape (frames, channels).
+      :type  samples: :class:`numpy.ndarray`
+      """
+      if not len(samples):
+         return
+      self.peak = max( self.peak, float(np.abs(samples).max()) )
+      # K-weight each channel (overlap-save FFT convolution)
+      ext = np.concatenate( (self._hist, samples) )
+      self._hist = ext[len(ext)-len(self._hist):]
+      nfft = 1 << int(math.ceil(math.log(len(ext)+len(self._h), 2)))
+      spec = np.fft.rfft( ext, nfft, axis=0 )
+      spec *= np.fft.rfft( self._h, nfft )[:,np.newaxis]
+      y = np.fft.irfft( spec, nfft, axis=0 )[len(self._h)-1:len(ext)]
+      # sum weighted channel power into 100ms sub-blocks
+      power = np.concatenate( (self._pending, (y*y).dot(self._weights)) )
+      end = len(power) - len(power) % self._step
+      self._subblocks.append( power[:end].reshape(-1,self._step).sum(axis=1) )
+      self._pending = power[end:]
+
+   @property
+   def blocks( self ):
+      """
+      Array of mean square power for each 400ms gating block, with a 75%
+      overlap.
+      """
+      if self._fmt is None:
+         return np.zeros(0)
+      sub = np.concatenate( self._subblocks + [np.zeros(0)] )
+      if len(sub) < 4:
+         # short track, use a single block of all samples
+         total = sub.sum() + self._pending.sum()
+         count = len(sub)*self._step + len(self._pending)
+         return np.array( [total/count] ) if count else np.zeros(0)
+      window = np.convolve( sub, np.ones(4), mode='valid' )
+      return window / (4*self._step)
+
+   @property
+   def gain( self ):
+      """Track gain in dB, or :data:`None` for a silent track."""
+      return gain( self.blocks )
+
+
+def gain( blocks ):
+   """
+   Compute the gated integrated loudness of a set of gating blocks, and
+   return the gain relative to :data:`REFERENCE`.
+
+   :param blocks: Mean square power of each gating block.
+   :type  blocks: :class:`numpy.ndarray`
+
+   :returns: Gain in dB, or :data:`None` if all blocks are gated.
+   """
+   with np.errstate( divide='ignore' ):
+      level = -0.691 + 10*np.log10( blocks )
+   blocks = blocks[level > ABS_GATE]
+   if not len(blocks):
+      return None
+   rel = -0.691 + 10*math.log10( blocks.mean() ) + REL_GATE
+   blocks = blocks[-0.691 + 10*np.log10(blocks) > rel]
+   return REFERENCE - (-0.691 + 10*math.log10( blocks.mean() ))
+
+
+#############################################################################
+class AlbumGain( object ):
+   """
+   Thread-safe aggregation of track analysis results into album values.
+   """
+   def __init__( self, sizes ):
+      """
+      :param sizes:  Mapping of album directory to the number of tracks that
+                     will be analyzed.
+      :type  sizes:  dict
+      """
+      self._sizes = sizes
+      self._tracks = {}
+      self._lock = threading.Lock()
+
+   def __contains__( self, album ):
+      """:returns: :data:`True` if the album directory is analyzed."""
+      return album in self._sizes
+
+   def add( self, album, track, analyzer ):
+      """
+      Add the analysis result of one track.
+
+      :param album:    Album directory.
+      :type  album:    str
+
+      :param track:    Any object to identify the track.
+
+      :param analyzer: Completed track analysis.
+      :type  analyzer: :class:`Loudness`
+
+      :returns: :data:`None` if the album is not complete, otherwise a tuple
+                of (list of tracks, album gain, album peak).
+      """
+      with self._lock:
+         if album not in self._sizes:
+            return None
+         tracks = self._tracks.setdefault( album, [] )
+         tracks.append( (track, analyzer.blocks, analyzer.peak) )
+         if len(tracks) < self._sizes[album]:
+            return None
+         del self._tracks[album]
+      blocks = np.concatenate( [b for _,b,_ in tracks] )
+      peak = max( p for _,_,p in tracks )
+      return [t for t,_,_ in tracks], gain(blocks), peak
+
+
+def format_gain( value ):
+   """:returns: ReplayGain tag string of a gain value."""
+   return '%.2f dB' % (value,)
+
+
+def format_peak( value ):
+   """:returns: ReplayGain tag string of a peak value."""
+   return '%.6f' % (value,)
+
+
+def _channel_weights( channels ):
+   # BS.1770 weights, LFE is ignored and surround channels are boosted
+   if channels == 6:
+      return np.array( [1.0, 1.0, 1.0, 0.0, 1.41, 1.41] )
+   return np.ones( channels )
+
+
+def _k_filter( rate ):
+   """
+   Return the impulse response of the BS.1770 K-weighting filter
+   (pre-filter and RLB high-pass) for a sample rate.
+   """
+   with _filters_lock:
+      if rate not in _filters:
+         _filters[rate] = _k_impulse( rate )
+      return _filters[rate]
+
+
+def _k_impulse( rate ):
+   # high-shelf pre-filter
+   f0,g,q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+   k = math.tan( math.pi*f0/rate )
+   vh = math.pow( 10.0, g/20.0 )
+   vb = math.pow( vh, 0.4996667741545416 )
+   a0 = 1.0 + k/q + k*k
+   b1 = [(vh + vb*k/q + k*k)/a0, 2.0*(k*k - vh)/a0, (vh - vb*k/q + k*k)/a0]
+   a1 = [1.0, 2.0*(k*k - 1.0)/a0, (1.0 - k/q + k*k)/a0]
+   # RLB high-pass filter
+   f0,q = 38.13547087602444, 0.5003270373238773
+   k = math.tan( math.pi*f0/rate )
+   a0 = 1.0 + k/q + k*k
+   b2 = [1.0, -2.0, 1.0]
+   a2 = [1.0, 2.0*(k*k - 1.0)/a0, (1.0 - k/q + k*k)/a0]
+   # sample the frequency response, the IIR tail beyond FILTER_LEN is
+   # negligible
+   n = 1 << int(math.ceil(math.log(rate*FILTER_LEN, 2)))
+   z = np.exp( -1j * np.linspace(0, math.pi, n//2 + 1) )
+   resp = (np.polyval(b1[::-1], z) / np.polyval(a1[::-1], z) *
+           np.polyval(b2[::-1], z) / np.polyval(a2[::-1], z))
+   return np.fft.irfft( resp, n )
@@ -0,0 +1,351 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.metrics
+   ~~~~~~~~~~~~~~~~
+
+   Define the live metrics of a sync (or a sync service), for a monitoring
+   system. The metrics are served on a localhost HTTP endpoint (in the
+   OpenMetrics format, or the Prometheus text format for older scrapers),
+   or written to a file for the textfile collector of the Prometheus node
+   exporter.
+
+   ===================================  ==================================
+   Metric                               Description
+   ===================================  ==================================
+   ``flacsync_queue_depth``             Jobs waiting for an encoding
+                                        thread
+   ``flacsync_in_flight{stage}``        Files in a processing step
+                                        (``encode``, ``tag``, ``cover``)
+   ``flacsync_files{encoder,result}``   Files that were ``skipped`` (up to
+                                        date), ``encoded``, ``updated``
+                                        (new cover art) or ``failed``
+   ``flacsync_audio_seconds{encoder}``  Duration of the encoded audio
+   ``flacsync_written_bytes{encoder}``  Size of the encoded files
+   ``flacsync_spawns``                  Processes started by the encoders
+   ``flacsync_cover_cache_*``           Hits, misses and hit ratio of the
+                                        cover thumbnail cache (``--serve``)
+   ``flacsync_stage_seconds{stage}``    Histogram of the duration of each
+                                        processing step
+   ===================================  ==================================
+"""
+
+import BaseHTTPServer
+import os
+import threading
+import time
+
+from . import decoder
+from . import encoder as encoder_
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Processing steps of a file, see :attr:`flacsync.encoder._Encoder.stage`.
+STAGES = ('encode', 'tag', 'cover')
+
+#: Upper bounds (in seconds) of the buckets of the stage histograms.
+BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+#: Delay (in seconds) between updates of the metrics file.
+INTERVAL = 15.0
+
+#: Content type of the OpenMetrics format.
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+#: Content type of the Prometheus text format.
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+#############################################################################
+class Metrics( object ):
+   """
+   Counters of a sync, updated by :class:`flacsync.WorkUnit`.
+   """
+   def __init__( self, enc_type ):
+      """
+      :param enc_type: Encoder type of the sync, i.e. ``aac``.
+      :type  enc_type: str
+      """
+      self.enc_type = enc_type
+      #: Optional function returning the number of queued jobs.
+      self.queue_depth = None
+      #: Optional :class:`~flacsync.album.CoverCache` of the sync.
+      self.covers = None
+      self._counters = {}
+      self._stages = {}
+      self._histograms = dict( (s, [0]*(len(BUCKETS)+1) + [0.0]) for s in
+                               STAGES )
+      self._lock = threading.Lock()
+
+   def count( self, name, value=1, **labels ):
+      """
+      Add to a counter of the encoder type.
+
+      :param name:   Counter name, without the ``flacsync_`` prefix and the
+                     ``_total`` suffix.
+      :type  name:   str
+
+      :param value:  Increment.
+      :type  value:  float
+      """
+      labels['encoder'] = self.enc_type
+      key = (name, tuple(sorted(labels.items())))
+      with self._lock:
+         self._counters[key] = self._counters.get( key, 0 ) + value
+
+   def stage( self, encoder, stage ):
+      """
+      Record the start of a processing step of a file. The previous step of
+      the file is added to the stage histograms.
+
+      :param encoder: Encoder object of the file.
+      :type  encoder: :class:`~flacsync.encoder._Encoder`
+
+      :param stage:   Name of the step, or :data:`None` when the file is
+                      finished.
+      :type  stage:   str
+      """
+      now = time.time()
+      with self._lock:
+         old = self._stages.pop( encoder, None )
+         if old and old[0] in self._histograms:
+            self._observe( old[0], now - old[1] )
+         if stage:
+            self._stages[encoder] = (stage, now)
+
+   def finished( self, encoder, encoded, ok ):
+      """
+      Record a finished file.
+
+      :param encoder: Encoder object of the file.
+      :type  encoder: :class:`~flacsync.encoder._Encoder`
+
+      :param encoded: :data:`True` if the file was (re)encoded.
+      :type  encoded: boolean
+
+      :param ok:      :data:`False` if a processing step failed.
+      :type  ok:      boolean
+      """
+      self.stage( encoder, None )
+      if not ok:
+         self.count( 'files', result='failed' )
+      elif not encoded:
+         self.count( 'files', result='updated' )
+      else:
+         self.count( 'files', result='encoded' )
+         self.count( 'audio_seconds', audio_seconds(encoder) )
+         try:
+            self.count( 'written_bytes', os.path.getsize(encoder.dst) )
+         except OSError: pass  # ignore if removed by another instance
+
+   def render( self, openmetrics=True ):
+      """
+      :param openmetrics: Use the OpenMetrics format, instead of the
+                          Prometheus text format.
+      :type  openmetrics: boolean
+
+      :returns: Text of all metrics.
+      """
+      depth = self.queue_depth() if self.queue_depth else 0
+      with self._lock:
+         counters = sorted( self._counters.items() )
+         in_flight = dict( (s,0) for s in STAGES )
+         for stage,_ in self._stages.values():
+            if stage in in_flight:
+               in_flight[stage] += 1
+         histograms = dict( (s,list(h)) for s,h in self._histograms.items() )
+      families = [
+         ('queue_depth', 'gauge', 'Jobs waiting for an encoding thread.',
+            [('', {}, depth)]),
+         ('in_flight', 'gauge', 'Files in a processing step.',
+            [('', {'stage':s}, in_flight[s]) for s in STAGES]),
+         ]
+      helps = {
+         'files':'Processed files, by result.',
+         'audio_seconds':'Duration of the encoded audio.',
+         'written_bytes':'Size of the encoded files.',
+         }
+      for name in sorted( helps ):
+         samples = [('_total', dict(labels), value)
+                    for (n,labels),value in counters if n == name]
+         families.append( (name, 'counter', helps[name], samples) )
+      families.append( ('spawns', 'counter',
+            'Processes started by the encoders.',
+            [('_total', {}, encoder_.spawns())]) )
+      if self.covers:
+         hits,misses = self.covers.hits, self.covers.misses
+         families += [
+            ('cover_cache_hits', 'counter', 'Cover thumbnails found in the '
+               'cache.', [('_total', {}, hits)]),
+            ('cover_cache_misses', 'counter', 'Cover thumbnails converted.',
+               [('_total', {}, misses)]),
+            ('cover_cache_hit_ratio', 'gauge', 'Ratio of cover thumbnails '
+               'found in the cache.',
+               [('', {}, float(hits) / (hits+misses) if hits+misses else 0)]),
+            ]
+      samples = []
+      for s in STAGES:
+         h = histograms[s]
+         for bound,count in zip( BUCKETS + ('+Inf',), _cumulative(h[:-1]) ):
+            samples.append( ('_bucket', {'stage':s, 'le':str(bound)}, count) )
+         samples.append( ('_sum', {'stage':s}, h[-1]) )
+         samples.append( ('_count', {'stage':s}, sum(h[:-1])) )
+      families.append( ('stage_seconds', 'histogram',
+            'Duration of the processing steps of a file.', samples) )
+      lines = []
+      for name,kind,help_,samples in families:
+         name = 'flacsync_' + name
+         # the Prometheus text format names a counter by its samples
+         family = name + ('_total' if kind == 'counter' and not openmetrics
+                          else '')
+         lines.append( '# HELP %s %s' % (family, help_) )
+         lines.append( '# TYPE %s %s' % (family, kind) )
+         for suffix,labels,value in samples:
+            lines.append( '%s%s%s %s' % (name, suffix, _labels(labels),
+                                         _number(value)) )
+      if openmetrics:
+         lines.append( '# EOF' )
+      return '\n'.join( lines ) + '\n'
+
+   def _observe( self, stage, seconds ):
+      h = self._histograms[stage]
+      i = 0
+      while i < len(BUCKETS) and seconds > BUCKETS[i]:
+         i += 1
+      h[i] += 1
+      h[-1] += seconds
+
+
+#############################################################################
+class Exporter( object ):
+   """
+   Publish the metrics of a sync on a localhost HTTP endpoint, and/or in a
+   file that is rewritten periodically.
+   """
+   def __init__( self, metrics, port=None, path=None, interval=INTERVAL ):
+      """
+      :param metrics:  Metrics of the sync.
+      :type  metrics:  :class:`Metrics`
+
+      :param port:     HTTP port on the loopback interface, serving
+                       ``/metrics``.
+      :type  port:     int
+
+      :param path:     Metrics file path.
+      :type  path:     str
+
+      :param interval: Delay (in seconds) between updates of the file.
+      :type  interval: float
+      """
+      self.metrics = metrics
+      self.port = port
+      self.path = path
+      self.interval = interval
+      self._server = None
+      self._stop = threading.Event()
+
+   def start( self ):
+      """
+      Start serving, and writing the file.
+
+      :raises: :exc:`socket.error` if the port is not available.
+      """
+      targets = []
+      if self.port:
+         self._server = BaseHTTPServer.HTTPServer( ('127.0.0.1', self.port),
+                                                   _Handler )
+         self._server.metrics = self.metrics
+         targets.append( self._server.serve_forever )
+      if self.path:
+         self.write()
+         targets.append( self._update )
+      for t in targets:
+         thread = threading.Thread( target=t )
+         thread.daemon = True
+         thread.start()
+
+   def stop( self ):
+      """Stop serving, and write the final metrics to the file."""
+      if self._server:
+         self._server.shutdown()
+         self._server.server_close()
+      if self.path:
+         self._stop.set()
+         self.write()
+
+   def write( self ):
+      """Replace the metrics file, in the Prometheus text format."""
+      tmp = '%s.%d.tmp' % (self.path, os.getpid())
+      try:
+         with open(tmp, 'w') as fh:
+            fh.write( self.metrics.render(openmetrics=False) )
+         os.rename( tmp, self.path )
+      except (IOError, OSError) as exc:
+         print "WARN: metrics file '%s' not written, %s" % (self.path, exc)
+
+   def _update( self ):
+      while not self._stop.wait( self.interval ):
+         self.write()
+
+
+class _Handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+
+   def do_GET( self ):
+      if self.path.split('?')[0] != '/metrics':
+         self.send_error( 404 )
+         return
+      openmetrics = 'application/openmetrics-text' in self.headers.get(
+            'Accept', '')
+      data = self.server.metrics.render( openmetrics )
+      self.send_response( 200 )
+      self.send_header( 'Content-Type',
+                        OPENMETRICS if openmetrics else PROMETHEUS )
+      self.send_header( 'Content-Length', str(len(data)) )
+      self.end_headers()
+      self.wfile.write( data )
+
+   def log_message( self, *args ):
+      pass   # do not mix the scrapes with the sync progress
+
+
+def audio_seconds( encoder ):
+   """
+   :returns: Duration in seconds of the source audio of an encoder object,
+             read from the STREAMINFO block, or 0 if unknown.
+   """
+   try:
+      info = decoder.FlacDecoder( encoder.flac ).info
+   except (IOError, ValueError):
+      return 0.0
+   samples = info.samples
+   track = encoder.track
+   if track:
+      samples = (track.end or samples) - track.start
+   return float(samples) / info.rate if info.rate else 0.0
+
+
+def _cumulative( counts ):
+   total = 0
+   for c in counts:
+      total += c
+      yield total
+
+
+def _labels( labels ):
+   if not labels:
+      return ''
+   return '{%s}' % (','.join( '%s="%s"' % (k, str(v).replace('\\', r'\\')
+         .replace('"', r'\"').replace('\n', r'\n'))
+         for k,v in sorted(labels.items()) ),)
+
+
+def _number( value ):
+   if isinstance( value, float ):
+      return repr( value )
+   return str( value )
@@ -0,0 +1,83 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.mirror
+   ~~~~~~~~~~~~~~~
+
+   Define the delivery of output files to additional destination
+   directories (mirrors), so that each file is only encoded once.
+
+   A file is delivered with the cheapest method supported by the
+   destination file system: a hard link (same file system), a reflink
+   (copy-on-write clone, i.e. Btrfs or XFS) or a buffered copy. The
+   modification time of the source is kept, so that an up-to-date mirror
+   file is not delivered again.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Size of the copy buffer, in bytes.
+BUFSIZE = 1 << 20
+
+# Linux ioctl to clone the extents of a file, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+def link_or_copy( src, dst ):
+   """
+   Replace a destination file with a link or copy of a source file.
+
+   :param src:    Source file path.
+   :type  src:    str
+
+   :param dst:    Destination file path; missing directories are created.
+   :type  dst:    str
+
+   :returns: Method used, one of ``'link'``, ``'reflink'`` or ``'copy'``.
+   :raises: :exc:`IOError` or :exc:`OSError` if the file can not be
+            delivered.
+   """
+   try:
+      os.makedirs( os.path.dirname(dst) )
+   except OSError: pass  # ignore if dir already exists
+   # write to a temporary file, so that an interrupted copy is not mistaken
+   # for an up-to-date file
+   tmp = '%s.%d.tmp' % (dst, os.getpid())
+   try:
+      try:
+         os.link( src, tmp )
+         method = 'link'
+      except OSError as exc:
+         if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                              errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+         method = _clone_or_copy( src, tmp )
+         shutil.copystat( src, tmp )
+      os.rename( tmp, dst )
+   finally:
+      if os.path.exists( tmp ):
+         os.remove( tmp )
+   return method
+
+
+def _clone_or_copy( src, dst ):
+   with open(src, 'rb') as fsrc:
+      with open(dst, 'wb') as fdst:
+         try:
+            fcntl.ioctl( fdst.fileno(), _FICLONE, fsrc.fileno() )
+            return 'reflink'
+         except (IOError, OSError):
+            pass  # not supported by the file system, or different devices
+         shutil.copyfileobj( fsrc, fdst, BUFSIZE )
+         return 'copy'
@@ -0,0 +1,215 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.mp3
+   ~~~~~~~~~~~~
+
+   Define MPEG audio Layer III frame parsing, used to join separately encoded
+   segments of a track into a single gapless MP3 file.
+
+   .. seealso::
+
+      The `LAME tag <http://gabriel.mp3-tech.org/mp3infotag.html>`_
+      specification for details regarding the Xing/LAME info frame.
+"""
+
+import struct
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Layer III bit rates in kbps, by MPEG-1 and MPEG-2/2.5 bit rate index.
+BITRATES = {
+   1:[0,32,40,48,56,64,80,96,112,128,160,192,224,256,320],
+   2:[0,8,16,24,32,40,48,56,64,80,96,112,128,144,160],
+}
+#: Sample rates by MPEG version (1, 2, 2.5) and sample rate index.
+RATES = {1:[44100,48000,32000], 2:[22050,24000,16000], 25:[11025,12000,8000]}
+
+_VERSIONS = {3:1, 2:2, 0:25}
+
+
+#############################################################################
+class Frame( object ):
+   """
+   Layer III frame header.
+   """
+   def __init__( self, header ):
+      """
+      :param header: First 4 bytes of the frame.
+      :type  header: str
+
+      :raises: :exc:`ValueError` if header is not a valid Layer III frame.
+      """
+      h, = struct.unpack('>I', header)
+      version = _VERSIONS.get( (h>>19) & 3 )
+      bitrate = (h>>12) & 0xf
+      rate = (h>>10) & 3
+      if ((h>>21) & 0x7ff != 0x7ff or not version or (h>>17) & 3 != 1 or
+            bitrate in (0,15) or rate == 3):
+         raise ValueError( "invalid MP3 frame header" )
+      self.version = version
+      self.mono = (h>>6) & 3 == 3
+      self.rate = RATES[version][rate]
+      self.bitrate = BITRATES[min(version,2)][bitrate]
+      scale = 144000 if version == 1 else 72000
+      self.size = scale * self.bitrate // self.rate + ((h>>9) & 1)
+
+   @property
+   def samples( self ):
+      """Number of samples per channel encoded in the frame."""
+      return 1152 if self.version == 1 else 576
+
+   @property
+   def xing_offset( self ):
+      """Offset of the Xing/LAME tag from the start of the frame."""
+      if self.version == 1:
+         return 4 + (17 if self.mono else 32)
+      return 4 + (9 if self.mono else 17)
+
+
+def frames( data, offset=0 ):
+   """
+   Walk the frames of an MPEG audio stream.
+
+   :param data:   Stream data.
+   :type  data:   str
+
+   :param offset: Start position of the first frame.
+   :type  offset: int
+
+   :returns: Generator of (offset, :class:`Frame`) tuples.
+   """
+   while offset + 4 <= len(data):
+      try:
+         frame = Frame( data[offset:offset+4] )
+      except ValueError:
+         return   # trailing tag or garbage
+      if offset + frame.size > len(data):
+         return   # truncated frame
+      yield offset, frame
+      offset += frame.size
+
+
+def info_tag( data, offset, frame ):
+   """
+   :returns: Offset of the 'Xing' or 'Info' tag in a frame, or :data:`None`
+             if the frame is not an info frame.
+   """
+   pos = offset + frame.xing_offset
+   if data[pos:pos+4] in ('Xing','Info'):
+      return pos
+   return None
+
+
+def id3v2_size( data ):
+   """:returns: Size of the ID3v2 tag at the start of the data (or 0)."""
+   if data[:3] != 'ID3' or len(data) < 10:
+      return 0
+   size = 0
+   for c in data[6:10]:
+      size = (size << 7) | (ord(c) & 0x7f)
+   return 10 + size
+
+
+def empty_id3v2( padding=1024 ):
+   """:returns: An ID3v2.4 tag without frames, for later tagging."""
+   size = ''.join( chr((padding >> s) & 0x7f) for s in (21,14,7,0) )
+   return 'ID3\x04\x00\x00' + size + '\x00'*padding
+
+
+def crc16( data, crc=0 ):
+   """:returns: CRC-16 (polynomial 0x8005, reflected) used by the LAME tag."""
+   for c in data:
+      crc ^= ord(c)
+      for _ in range(8):
+         crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+   return crc
+
+
+def join( out, segments, samples ):
+   """
+   Join separately encoded segments into a single MP3 stream.
+
+   Each segment is a tuple of (data, first, count). The frames
+   ``first .. first+count`` of each segment are copied to :data:`out`, where
+   frame 0 is the first audio frame after the info frame. A count of
+   :data:`None` copies all remaining frames.
+
+   The first segment must start with a LAME info frame, which is updated
+   with the frame count, seek table and gapless playback values of the
+   joined stream.
+
+   :param out:      Writable, seekable output file.
+   :type  out:      file
+
+   :param segments: List of segment tuples.
+   :type  segments: list
+
+   :param samples:  Total number of samples per channel of the track.
+   :type  samples:  int
+
+   :raises: :exc:`ValueError` if a segment is missing frames.
+   """
+   data = segments[0][0]
+   walk = frames( data )
+   try:
+      info_pos,info = walk.next()
+   except StopIteration:
+      raise ValueError( "no MP3 frames in segment" )
+   tag_pos = info_tag( data, info_pos, info )
+   if tag_pos is None:
+      raise ValueError( "segment has no LAME info frame" )
+   flags, = struct.unpack('>I', data[tag_pos+4:tag_pos+8])
+   if flags & 0xf != 0xf:
+      raise ValueError( "unsupported info frame fields: %x" % (flags,) )
+   info_data = bytearray( data[info_pos:info_pos+info.size] )
+
+   base = out.tell()
+   out.write( str(info_data) )
+   offsets = []   # start of each audio frame, relative to the info frame
+   size = info.size
+   spf = None
+   for i,(seg,first,count) in enumerate(segments):
+      walk = frames( seg )
+      if i == 0:
+         walk.next()  # skip info frame
+      kept = 0
+      for n,(pos,frame) in enumerate(walk):
+         if n < first:
+            continue
+         if count is not None and kept == count:
+            break
+         out.write( seg[pos:pos+frame.size] )
+         offsets.append( size )
+         size += frame.size
+         spf = frame.samples
+         kept += 1
+      if count is not None and kept != count:
+         raise ValueError( "segment %d is missing MP3 frames" % (i,) )
+
+   # update the info frame
+   t = tag_pos - info_pos
+   info_data[t+8:t+16] = struct.pack('>II', len(offsets), size)
+   for i in range(100):
+      pos = offsets[len(offsets)*i//100] if offsets else 0
+      info_data[t+16+i] = min( 255, 256*pos//size )
+   if info_data[t+120:t+124] == 'LAME':
+      delay = (info_data[t+141] << 4) | (info_data[t+142] >> 4)
+      padding = len(offsets)*(spf or 0) - delay - samples
+      padding = max( 0, min(padding, 0xfff) )
+      info_data[t+141:t+144] = struct.pack('>I', (delay << 12) | padding)[1:]
+      info_data[t+148:t+152] = struct.pack('>I', size)
+      # music CRC would require a full pass over the audio data, clear it
+      info_data[t+152:t+154] = '\x00\x00'
+      crc = crc16( str(info_data[:t+154]) )
+      info_data[t+154:t+156] = struct.pack('>H', crc)
+   end = out.tell()
+   out.seek( base )
+   out.write( str(info_data) )
+   out.seek( end )
@@ -0,0 +1,137 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.orphan
+   ~~~~~~~~~~~~~~~
+
+   Define the removal of orphaned destination files, that have no
+   corresponding source file.
+
+   Files are removed in batches by a pool of threads, since the latency of
+   each unlink on slow media (i.e. an SD card) is much larger than its CPU
+   cost. Files can also be moved to a trash directory in the destination,
+   for undo. Only the parent directories of removed files are checked for
+   pruning, instead of every directory in the destination.
+"""
+
+import multiprocessing.dummy as mp
+import os
+import time
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Orphan policies, see :func:`flacsync.del_dest_orphans`.
+POLICIES = ('delete', 'keep', 'prompt', 'list')
+
+#: Name of the trash directory, in :data:`flacsync.util.STATE_DIR`.
+TRASH_DIR = 'trash'
+
+#: Number of files removed by each job.
+BATCH = 64
+
+
+def trash_dir( dest_dir ):
+   """
+   :returns: New trash directory path of a destination, named by the current
+             time.
+   """
+   return os.path.join( dest_dir, util.STATE_DIR, TRASH_DIR,
+                        time.strftime('%Y%m%d-%H%M%S') )
+
+
+def remove( paths, threads=1, root=None, trash=None ):
+   """
+   Remove files in parallel batches.
+
+   :param paths:     Files to remove.
+   :type  paths:     list
+
+   :param threads:   Number of threads removing files.
+   :type  threads:   int
+
+   :param root:      Destination root directory, required by :data:`trash`.
+   :type  root:      str
+
+   :param trash:     Trash directory; files are moved to the same path
+                     relative to :data:`root`, instead of being deleted.
+   :type  trash:     str
+
+   :returns: List of removed files.
+   """
+   paths = list(paths)
+   batches = [paths[i:i+BATCH] for i in range(0, len(paths), BATCH)]
+   if not batches:
+      return []
+   pool = mp.Pool( processes=max(1, min(threads, len(batches))) )
+   try:
+      done = pool.map( lambda b: _remove_batch(b, root, trash), batches )
+   finally:
+      pool.close()
+      pool.join()
+   return [p for batch in done for p in batch]
+
+
+def _remove_batch( paths, root, trash ):
+   removed = []
+   for p in paths:
+      try:
+         if trash:
+            dst = os.path.join( trash, os.path.relpath(p, root) )
+            try:
+               os.makedirs( os.path.dirname(dst) )
+            except OSError: pass  # ignore if dir already exists
+            os.rename( p, dst )
+         else:
+            os.remove( p )
+         removed.append( p )
+      except OSError as exc:
+         print "WARN: orphan '%s' not removed, %s" % (p, exc.strerror)
+   return removed
+
+
+def prune( paths, root ):
+   """
+   Remove the parent directories of removed files, if they are empty. A
+   removed directory's parent is checked next, up to (but excluding) the
+   root directory.
+
+   :param paths:  Removed files.
+   :type  paths:  list
+
+   :param root:   Destination root directory.
+   :type  root:   str
+
+   :returns: Number of removed directories.
+   """
+   root = os.path.abspath( root )
+   dirs = set( os.path.dirname(os.path.abspath(p)) for p in paths )
+   count = 0
+   # deepest first, so that a parent is checked after all of its children
+   pending = sorted( dirs, key=lambda d: d.count(os.sep) )
+   while pending:
+      d = pending.pop()
+      if d == root or not d.startswith(root + os.sep):
+         continue
+      try:
+         os.rmdir( d )
+      except OSError:
+         continue   # not empty
+      count += 1
+      parent = os.path.dirname( d )
+      if parent not in dirs:
+         dirs.add( parent )
+         # keep the list ordered by depth
+         depth = parent.count(os.sep)
+         i = len(pending)
+         while i and pending[i-1].count(os.sep) > depth:
+            i -= 1
+         pending.insert( i, parent )
+   return count
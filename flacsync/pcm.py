@@ -0,0 +1,194 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.pcm
+   ~~~~~~~~~~~~
+
+   Define a streaming pipe for the WAV output of the FLAC decoder, allowing
+   the decoded PCM samples to be inspected before passing them to an
+   encoder.
+"""
+
+import struct
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Size of each read from the decoder pipe, in bytes.
+BUFSIZE = 1<<16
+
+# numpy is only imported for sample conversion, see :func:`to_float`
+np = util.LazyModule( 'numpy' )
+
+
+#############################################################################
+class WavFormat( object ):
+   """
+   Sample format of a WAV stream.
+   """
+   def __init__( self, channels, rate, width, frames=None ):
+      """
+      :param channels: Number of audio channels.
+      :type  channels: int
+
+      :param rate:  Sample rate in Hz.
+      :type  rate:  int
+
+      :param width: Size of a single sample in bytes.
+      :type  width: int
+
+      :param frames: Length of the stream in frames, if known.
+      :type  frames: int
+      """
+      self.channels = channels
+      self.rate = rate
+      self.width = width
+      self.frames = frames
+
+   @property
+   def block_align( self ):
+      """Size of a single frame (one sample of every channel) in bytes."""
+      return self.channels * self.width
+
+
+def read_wav_header( fh ):
+   """
+   Read a RIFF/WAVE header from a stream, up to the start of the sample data.
+
+   :param fh: Stream positioned at the start of the WAV file.
+   :type  fh: file
+
+   :returns: Tuple of (:class:`WavFormat`, raw header bytes).
+   :raises: :exc:`ValueError` if the stream is not a PCM WAV file.
+   """
+   raw = [_read( fh, 12 )]
+   riff,_,wave = struct.unpack('<4sI4s', raw[0])
+   if riff != 'RIFF' or wave != 'WAVE':
+      raise ValueError( "decoder output is not a WAV stream" )
+   fmt = None
+   while True:
+      hdr = _read( fh, 8 )
+      raw.append( hdr )
+      cid,size = struct.unpack('<4sI', hdr)
+      if cid == 'data':
+         if fmt and 0 < size < 0xffffffff and size % fmt.block_align == 0:
+            fmt.frames = size // fmt.block_align
+         break
+      body = _read( fh, size + size%2 )
+      raw.append( body )
+      if cid == 'fmt ':
+         _,channels,rate,_,align,_ = struct.unpack('<HHIIHH', body[:16])
+         fmt = WavFormat( channels, rate, align // channels )
+   if not fmt:
+      raise ValueError( "WAV stream has no 'fmt ' chunk" )
+   return fmt, ''.join(raw)
+
+
+def wav_header( fmt ):
+   """
+   :returns: Canonical RIFF/WAVE header string of a sample format.
+   """
+   size = 0xffffffff
+   if fmt.frames is not None:
+      size = min( fmt.frames * fmt.block_align, size - 36 )
+   return struct.pack( '<4sI4s4sIHHIIHH4sI',
+         'RIFF', min(size + 36, 0xffffffff), 'WAVE',
+         'fmt ', 16, 1, fmt.channels, fmt.rate, fmt.rate*fmt.block_align,
+         fmt.block_align, fmt.width*8, 'data', size )
+
+
+def to_float( data, fmt ):
+   """
+   Convert raw little-endian PCM sample data to a floating point array.
+
+   :param data: Raw sample data, a whole number of frames.
+   :type  data: str
+
+   :param fmt:  Sample format of :data:`data`.
+   :type  fmt:  :class:`WavFormat`
+
+   :returns: :mod:`numpy` array of shape (frames, channels), with a range of
+             -1.0 to 1.0.
+   """
+   if fmt.width == 1:
+      a = (np.frombuffer(data, np.uint8).astype(np.float64) - 128) / 128.0
+   elif fmt.width == 2:
+      a = np.frombuffer(data, '<i2') / 32768.0
+   elif fmt.width == 3:
+      b = np.frombuffer(data, np.uint8).reshape(-1,3).astype(np.int32)
+      a = b[:,0] | (b[:,1] << 8) | (b[:,2] << 16)
+      a = np.where( a & 0x800000, a - 0x1000000, a ) / 8388608.0
+   elif fmt.width == 4:
+      a = np.frombuffer(data, '<i4') / 2147483648.0
+   else:
+      raise ValueError( "unsupported sample width: %d" % (fmt.width,) )
+   return a.reshape( -1, fmt.channels )
+
+
+def pipe( src, dst, taps=(), convert=None ):
+   """
+   Copy a WAV stream from :data:`src` to :data:`dst`, passing all samples to
+   each tap.
+
+   A tap is any object providing ``start(fmt)``, which is called once with
+   the :class:`WavFormat` of the stream, and ``feed(samples)``, which is
+   called with each block of samples converted by :func:`to_float`.
+
+   :param src:  Input stream (decoder stdout).
+   :type  src:  file
+
+   :param dst:  Output stream (encoder stdin).
+   :type  dst:  file
+
+   :param taps: Sample consumers.
+   :type  taps: list
+
+   :param convert: Optional sample format converter, applied before the
+                   samples are passed to the taps and written.
+   :type  convert: :class:`~flacsync.resample.Converter`
+   """
+   fmt,header = read_wav_header( src )
+   out_fmt = convert.start( fmt ) if convert else None
+   if out_fmt:
+      dst.write( wav_header(out_fmt) )
+   else:
+      dst.write( header )
+      convert = None
+   for t in taps:
+      t.start( out_fmt or fmt )
+   carry = ''
+   while True:
+      data = src.read( BUFSIZE )
+      if not data:
+         break
+      if not convert:
+         dst.write( data )
+      if taps or convert:
+         data = carry + data
+         end = len(data) - len(data) % fmt.block_align
+         carry = data[end:]
+         samples = to_float( data[:end], fmt )
+         if convert:
+            samples = convert.process( samples )
+            dst.write( convert.quantize(samples) )
+         for t in taps:
+            t.feed( samples )
+   if convert:
+      samples = convert.flush()
+      dst.write( convert.quantize(samples) )
+      for t in taps:
+         t.feed( samples )
+
+
+def _read( fh, size ):
+   data = fh.read( size )
+   if len(data) != size:
+      raise ValueError( "unexpected end of WAV stream" )
+   return data
@@ -0,0 +1,144 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.prefetch
+   ~~~~~~~~~~~~~~~~~
+
+   Define a read-ahead stage for source files, used on slow or seek-bound
+   storage (i.e. USB hard disks and network mounts).
+
+   A background thread reads the source files of upcoming jobs, in job
+   order, into the OS page cache. The decoder of each job then reads its
+   file from memory, instead of competing with the other decoders for disk
+   seeks.
+"""
+
+import os
+import threading
+import time
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Size of each read, in bytes.
+CHUNK = 1<<20
+
+
+#############################################################################
+class Prefetcher( object ):
+   """
+   Read-ahead of source files, limited to a number of files and bytes that
+   are read but not yet used by a job.
+   """
+   def __init__( self, paths, depth, max_bytes ):
+      """
+      :param paths:  Source file paths, in the order they are used by jobs.
+      :type  paths:  list
+
+      :param depth:  Max number of files read ahead of the jobs.
+      :type  depth:  int
+
+      :param max_bytes: Max number of bytes read ahead of the jobs. A single
+                        larger file is still read.
+      :type  max_bytes: int
+      """
+      self.depth = depth
+      self.max_bytes = max_bytes
+      #: Number of files that were completely read before use.
+      self.hits = 0
+      #: Number of files that were not read before use.
+      self.misses = 0
+      #: Total time (in seconds) jobs waited for a file being read.
+      self.stall = 0.0
+      self._paths = []
+      for p in paths:
+         if p not in self._paths:
+            self._paths.append( p )
+      self._state = {}   # path -> 'reading', 'ready' or 'used'
+      self._ahead = {}   # path -> size, of files read but not yet used
+      self._cond = threading.Condition()
+      self._stop = False
+      self._thread = None
+
+   def start( self ):
+      """Start the read-ahead thread."""
+      self._thread = threading.Thread( target=self._run )
+      self._thread.daemon = True
+      self._thread.start()
+
+   def stop( self ):
+      """Stop the read-ahead thread."""
+      with self._cond:
+         self._stop = True
+         self._cond.notify_all()
+      if self._thread:
+         self._thread.join()
+
+   def acquire( self, path ):
+      """
+      Mark a file as used by a job. Waits until the file is read, if the
+      read is in progress.
+
+      :param path:  Source file path.
+      :type  path:  str
+      """
+      with self._cond:
+         state = self._state.get( path )
+         if state == 'used':
+            return
+         if state == 'reading':
+            start = time.time()
+            while self._state[path] == 'reading':
+               self._cond.wait()
+            self.stall += time.time() - start
+            state = 'ready'
+         if state == 'ready':
+            self.hits += 1
+         else:
+            self.misses += 1
+         self._state[path] = 'used'
+         self._ahead.pop( path, None )
+         self._cond.notify_all()
+
+   def report( self ):
+      """:returns: Summary string of the read-ahead statistics."""
+      return 'prefetch: %d hits, %d misses, %.1fs stalled' % (
+            self.hits, self.misses, self.stall)
+
+   def _run( self ):
+      for path in self._paths:
+         try:
+            size = os.path.getsize( path )
+         except OSError:
+            continue
+         with self._cond:
+            while not self._stop and self._ahead and (
+                  len(self._ahead) >= self.depth or
+                  sum(self._ahead.values()) + size > self.max_bytes):
+               self._cond.wait()
+            if self._stop:
+               return
+            if path in self._state:   # already used by a job
+               continue
+            self._state[path] = 'reading'
+            self._ahead[path] = size
+         try:
+            self._read( path )
+         finally:
+            with self._cond:
+               if self._state[path] == 'reading':
+                  self._state[path] = 'ready'
+               self._cond.notify_all()
+
+   def _read( self, path ):
+      try:
+         with open(path, 'rb') as fh:
+            while not self._stop and fh.read( CHUNK ):
+               pass
+      except IOError:
+         pass
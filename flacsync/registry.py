@@ -0,0 +1,116 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.registry
+   ~~~~~~~~~~~~~~~~~
+
+   Define a registry of encoder classes, that are imported only when
+   selected.
+
+   Built-in encoders are registered by ``'module:class'`` name. Third-party
+   encoders are registered from a ``setup.py`` entry point of the
+   ``flacsync.encoders`` group, i.e.::
+
+      entry_points = {
+         'flacsync.encoders': ['opus = flacsync_opus:OpusEncoder'],
+      }
+
+   or at run-time with :meth:`Registry.register`. The entry points are only
+   searched for a name that is not registered, since loading the entry point
+   index is slow.
+
+   An encoder class is created with the keyword arguments of
+   :class:`flacsync.encoder._Encoder`, and the encoder options prefixed by
+   its name (i.e. ``aac_q``). It should be derived from
+   :class:`~flacsync.encoder._Encoder`, and implement the ``encode``,
+   ``tag``, ``set_cover`` and ``set_album_gain`` methods.
+"""
+
+import importlib
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Entry point group of third-party encoders.
+ENTRY_POINTS = 'flacsync.encoders'
+
+
+#############################################################################
+class Registry( object ):
+   """
+   Mapping of encoder names to classes, imported on first lookup.
+   """
+   def __init__( self, builtins, group=ENTRY_POINTS ):
+      """
+      :param builtins: Mapping of name to ``'module:class'`` string.
+      :type  builtins: dict
+
+      :param group:  Entry point group of third-party encoders.
+      :type  group:  str
+      """
+      self.group = group
+      self._specs = dict( builtins )
+      self._classes = {}
+
+   def register( self, name, spec ):
+      """
+      Register an encoder.
+
+      :param name:   Encoder name, as selected by ``--type``.
+      :type  name:   str
+
+      :param spec:   Encoder class, or ``'module:class'`` string.
+      """
+      self._specs[name] = spec
+      self._classes.pop( name, None )
+
+   def keys( self ):
+      """:returns: Sorted list of the registered names."""
+      return sorted( self._specs )
+
+   def __contains__( self, name ):
+      try:
+         self[name]
+      except KeyError:
+         return False
+      return True
+
+   def __getitem__( self, name ):
+      """
+      :returns: Encoder class of a name.
+      :raises: :exc:`KeyError` if the name is not registered, or the encoder
+               module can not be imported.
+      """
+      if name not in self._classes:
+         spec = self._specs.get( name ) or self._entry_point( name )
+         if spec is None:
+            raise KeyError( name )
+         try:
+            self._classes[name] = _load( spec )
+         except (ImportError, AttributeError) as exc:
+            raise KeyError( "%s (%s)" % (name, exc) )
+      return self._classes[name]
+
+   def _entry_point( self, name ):
+      try:
+         import pkg_resources
+      except ImportError:
+         return None
+      for ep in pkg_resources.iter_entry_points( self.group, name ):
+         return ep
+      return None
+
+
+def _load( spec ):
+   # import an encoder class from a spec string, or entry point
+   if hasattr( spec, 'load' ):
+      return spec.load()
+   if not isinstance( spec, basestring ):
+      return spec
+   module,attr = spec.split(':')
+   return getattr( importlib.import_module(module), attr )
@@ -0,0 +1,249 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.resample
+   ~~~~~~~~~~~~~~~~~
+
+   Define a streaming sample rate and bit depth converter, used to reduce
+   high resolution audio before it is passed to an encoder.
+
+   Sample rates are converted with a polyphase windowed-sinc filter, and
+   samples are quantized with TPDF dither. The dither noise is generated
+   from a fixed seed, so the output is identical across runs.
+
+   .. note::
+
+      The converter requires the :mod:`numpy` package.
+"""
+
+import fractions
+import math
+
+from . import pcm
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Number of filter taps per output sample (at the lowest of both rates).
+TAPS = 32
+#: Filter pass-band edge, relative to the output Nyquist frequency.
+ROLLOFF = 0.91
+#: Kaiser window beta parameter of the filter.
+BETA = 8.6
+#: Seed of the dither noise generator.
+SEED = 0x666c6163
+#: Lowest output sample rate selected by :func:`target_rate`.
+MIN_RATE = 32000
+#: Max number of output frames computed at once.
+BLOCK = 1<<16
+
+# numpy is only imported by a run that converts audio
+np = util.LazyModule( 'numpy' )
+
+
+def available():
+   """:returns: :data:`True` if conversion is supported."""
+   return util.importable( np )
+
+
+def target_rate( rate, max_rate ):
+   """
+   Return the output sample rate for a source rate. The source rate is
+   halved until it is below :data:`max_rate`, in order to keep a simple
+   conversion ratio (i.e. 192kHz -> 48kHz, 176.4kHz -> 44.1kHz). If this
+   results in a rate below :data:`MIN_RATE`, :data:`max_rate` is used.
+
+   :param rate:     Source sample rate in Hz.
+   :type  rate:     int
+
+   :param max_rate: Maximum sample rate in Hz.
+   :type  max_rate: int
+   """
+   best = rate
+   while best > max_rate and best % 2 == 0:
+      best //= 2
+   if MIN_RATE <= best <= max_rate:
+      return best
+   return max_rate
+
+
+#############################################################################
+class Converter( object ):
+   """
+   Streaming converter of a single WAV stream. Instances are used by
+   :func:`flacsync.pcm.pipe`.
+   """
+   def __init__( self, max_rate=None, max_bits=None ):
+      """
+      :param max_rate: Maximum output sample rate in Hz.
+      :type  max_rate: int
+
+      :param max_bits: Maximum output bits per sample (16 or 24).
+      :type  max_bits: int
+      """
+      self.max_rate = max_rate
+      self.max_bits = max_bits
+      self._resampler = None
+
+   def start( self, fmt ):
+      """
+      :param fmt: Sample format of the source stream.
+      :type  fmt: :class:`~flacsync.pcm.WavFormat`
+
+      :returns: Output sample format, or :data:`None` if no conversion is
+                required.
+      """
+      rate = fmt.rate
+      if self.max_rate and rate > self.max_rate:
+         rate = target_rate( rate, self.max_rate )
+      width = fmt.width
+      if self.max_bits and width*8 > self.max_bits:
+         width = self.max_bits // 8
+      if (rate,width) == (fmt.rate,fmt.width):
+         return None
+      width = max( width, 2 )  # 8-bit output is unsigned, use 16-bit
+      if rate != fmt.rate:
+         self._resampler = Resampler( fmt.rate, rate, fmt.channels )
+      self._rng = np.random.RandomState( SEED )
+      self._scale = float(1 << (width*8 - 1))
+      self._dtype = {2:'<i2', 3:'<i4', 4:'<i4'}[width]
+      frames = fmt.frames
+      if frames is not None and self._resampler:
+         frames = self._resampler.output_frames( frames )
+      self.fmt = pcm.WavFormat( fmt.channels, rate, width, frames )
+      return self.fmt
+
+   def process( self, samples ):
+      """
+      Convert a block of samples.
+
+      :param samples: Array of shape (frames, channels).
+      :type  samples: :class:`numpy.ndarray`
+
+      :returns: Converted float samples, prior to quantization.
+      """
+      if self._resampler:
+         samples = self._resampler.process( samples )
+      return samples
+
+   def flush( self ):
+      """:returns: Remaining float samples at the end of the stream."""
+      if self._resampler:
+         return self._resampler.flush()
+      return np.zeros( (0,self.fmt.channels) )
+
+   def quantize( self, samples ):
+      """
+      Dither and quantize float samples to the output bit depth.
+
+      :returns: Raw little-endian sample data.
+      """
+      # TPDF noise, the sum of two consecutive uniform values per sample
+      noise = self._rng.uniform(-0.5, 0.5, samples.shape + (2,)).sum(axis=-1)
+      q = np.floor( samples*self._scale + noise + 0.5 )
+      q = np.clip( q, -self._scale, self._scale-1 ).astype( self._dtype )
+      if self.fmt.width == 3:
+         return q.view(np.uint8).reshape(-1,4)[:,:3].tobytes()
+      return q.tobytes()
+
+
+#############################################################################
+class Resampler( object ):
+   """
+   Streaming rational ratio resampler.
+   """
+   def __init__( self, in_rate, out_rate, channels ):
+      ratio = fractions.Fraction( out_rate, in_rate )
+      self.up,self.down = ratio.numerator, ratio.denominator
+      self.channels = channels
+      # taps of each polyphase filter, in input samples
+      ratio = max( 1.0, float(self.down)/self.up )
+      self.taps = 2 * int(math.ceil( TAPS/2.0 * ratio ))
+      self._phases = _design( self.up, self.down, self.taps )
+      # group delay of the filter, at the upsampled rate
+      self._delay = (self.taps*self.up - 1) // 2
+      # buffered input, starting with the history needed by the 1st output
+      self._buf = np.zeros( (self.taps-1, channels) )
+      self._base = -(self.taps-1)
+      self._in_frames = 0
+      self._out_frames = 0
+
+   def output_frames( self, in_frames ):
+      """:returns: Number of output frames of a stream length."""
+      return -(-in_frames*self.up // self.down)
+
+   def process( self, samples ):
+      """
+      :param samples: Array of shape (frames, channels).
+
+      :returns: All output samples that can be computed from the input so
+                far.
+      """
+      self._buf = np.concatenate( (self._buf, samples) )
+      self._in_frames += len(samples)
+      return self._run( self._base + len(self._buf) )
+
+   def flush( self ):
+      """:returns: Remaining output samples at the end of the stream."""
+      total = self.output_frames( self._in_frames )
+      pad = (self._delay + self.down) // self.up + self.taps
+      self._buf = np.concatenate( (self._buf, np.zeros((pad,self.channels))) )
+      return self._run( self._base + len(self._buf), total )
+
+   def _run( self, avail, total=None ):
+      # last output that only needs input indices below 'avail'
+      end = ((avail-1)*self.up - self._delay) // self.down + 1
+      if total is not None:
+         end = min( end, total )
+      out = []
+      for k in range( self._out_frames, end, BLOCK ):
+         ks = np.arange( k, min(k+BLOCK, end) )
+         pos = ks*self.down + self._delay
+         n0,ph = pos // self.up - self._base, pos % self.up
+         if self.up == 1:
+            # decimation only, filter the input and keep every Nth sample
+            out.append( self._fft_filter(n0[-1]+1)[n0] )
+         else:
+            y = np.zeros( (len(ks),self.channels) )
+            coef = self._phases[ph]
+            for i in range(self.taps):
+               y += coef[:,i,np.newaxis] * self._buf[n0-i]
+            out.append( y )
+      self._out_frames = max( self._out_frames, end )
+      # drop input that is no longer needed
+      pos = self._out_frames*self.down + self._delay
+      keep = pos // self.up - (self.taps-1) - self._base
+      if keep > 0:
+         self._buf = self._buf[keep:]
+         self._base += keep
+      if not out:
+         return np.zeros( (0,self.channels) )
+      return np.concatenate( out )
+
+   def _fft_filter( self, stop ):
+      # linear convolution of the buffered input with the filter, up to index
+      # 'stop' of the buffer
+      x = self._buf[:stop]
+      nfft = 1 << int(math.ceil(math.log(len(x) + self.taps, 2)))
+      spec = np.fft.rfft( x, nfft, axis=0 )
+      spec *= np.fft.rfft( self._phases[0], nfft )[:,np.newaxis]
+      return np.fft.irfft( spec, nfft, axis=0 )[:stop]
+
+
+def _design( up, down, taps ):
+   """
+   Return the polyphase decomposition of a Kaiser windowed-sinc low-pass
+   filter, as an array of shape (up, taps).
+   """
+   n = taps * up
+   cutoff = ROLLOFF * 0.5 / max(up, down)   # relative to upsampled rate
+   t = np.arange(n) - (n-1)//2    # centered on the group delay
+   h = 2*cutoff * np.sinc( 2*cutoff*t ) * np.kaiser( n, BETA ) * up
+   # phase p holds taps h[p], h[p+up], h[p+2*up], ...
+   return h.reshape( taps, up ).T.copy()
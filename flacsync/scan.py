@@ -0,0 +1,165 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.scan
+   ~~~~~~~~~~~~~
+
+   Define a persistent cache of source directory state, used to prune
+   unchanged album directories from incremental scans.
+"""
+
+import json
+import os
+
+from . import encoder
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#############################################################################
+class ScanCache( object ):
+   """
+   Record of each source directory mtime and child listing from a previous
+   run.
+
+   A directory is *clean* when its mtime and cover art files have not
+   changed since the last run in which all of its files were found to be
+   up-to-date. Adding, removing or renaming an entry changes the mtime of a
+   directory, so the cached listing of a clean directory is used, and its
+   files are not listed or stat'ed.
+
+   .. note::
+
+      Modifying a FLAC file in-place does not change the mtime of its
+      directory. Such changes are only detected by a deep scan, which is
+      forced every :data:`deep_every` runs.
+
+      Likewise, the outputs of a clean directory are not checked: an output
+      file that is deleted (or damaged) in the destination is not encoded
+      again until a deep scan.
+   """
+   def __init__( self, path, deep_every=0 ):
+      """
+      :param path:   File path of the persistent cache.
+      :type  path:   str
+
+      :param deep_every: Force a full re-scan every N runs, 0 to disable.
+      :type  deep_every: int
+      """
+      super( ScanCache, self).__init__()
+      self.path = path
+      self.runs = 0
+      self._dirs = {}
+      self._visited = {}
+      self.load()
+      self.deep = bool(deep_every) and self.runs % deep_every == 0
+
+   def load( self ):
+      """Read cache contents from disk, ignoring a missing or corrupt file."""
+      try:
+         with open(self.path) as fh:
+            data = json.load(fh)
+         self.runs = data['runs']
+         self._dirs = dict( (_str(k),_from_json(v))
+                              for k,v in data['dirs'].items() )
+      except (IOError, ValueError, KeyError):
+         self.runs = 0
+         self._dirs = {}
+
+   def save( self ):
+      """
+      Write cache contents to disk. Only directories visited in this run are
+      retained.
+      """
+      data = {'runs':self.runs+1,
+              'dirs':dict((k,v) for k,v in self._visited.items() if v)}
+      util.save_json( self.path, data )
+
+   def invalidate( self, dir_ ):
+      """
+      Mark a directory as not clean, i.e. it contains a file that must be
+      (re)encoded.
+      """
+      if dir_ in self._visited:
+         self._visited[dir_] = None
+
+   def commit( self ):
+      """
+      Use the state of the directories visited so far for the next walks,
+      in a long-lived process (see :mod:`flacsync.service`).
+      """
+      for k,v in self._visited.items():
+         if v:
+            self._dirs[k] = v
+         else:
+            self._dirs.pop( k, None )
+
+   def walk( self, top ):
+      """
+      Directory tree generator, similar to :func:`os.walk` (with
+      ``followlinks=True``).
+
+      :param top: Root directory of the tree.
+      :type  top: str
+
+      :returns: Generator of ``(root, dirs, files, clean)`` tuples.
+      """
+      stack = [top]
+      while stack:
+         root = stack.pop()
+         try:
+            mtime = os.stat(root).st_mtime
+         except OSError:
+            continue
+         entry = self._dirs.get(root)
+         clean = not self.deep and self._is_clean( root, entry, mtime )
+         if not clean:
+            try:
+               names = os.listdir(root)
+            except OSError:
+               continue
+            dirs,files = [],[]
+            for n in names:
+               if os.path.isdir(os.path.join(root,n)):
+                  dirs.append(n)
+               else:
+                  files.append(n)
+            entry = {'mtime':mtime, 'dirs':dirs, 'files':files,
+                     'covers':_cover_mtimes(root,files)}
+         self._visited[root] = entry
+         yield root, entry['dirs'], entry['files'], clean
+         stack.extend( os.path.join(root,d) for d in reversed(entry['dirs']) )
+
+   @staticmethod
+   def _is_clean( root, entry, mtime ):
+      if not entry or entry['mtime'] != mtime:
+         return False
+      return entry['covers'] == _cover_mtimes(root, entry['files'])
+
+
+def _str( name ):
+   # json returns unicode, convert back to the byte string names of os.listdir
+   return name.encode('utf-8') if isinstance(name,unicode) else name
+
+
+def _from_json( entry ):
+   entry['dirs'] = map(_str, entry['dirs'])
+   entry['files'] = map(_str, entry['files'])
+   entry['covers'] = dict((_str(k),v) for k,v in entry['covers'].items())
+   return entry
+
+
+def _cover_mtimes( root, files ):
+   mtimes = {}
+   for f in files:
+      if f in encoder.COVERS:
+         try:
+            mtimes[f] = os.path.getmtime(os.path.join(root,f))
+         except OSError: pass
+   return mtimes
@@ -0,0 +1,422 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.service
+   ~~~~~~~~~~~~~~~~
+
+   Define a long-lived sync service, that keeps its caches and encoding
+   threads between syncs, and the client of the service.
+
+   A client connects to the Unix socket of the service, and sends a request
+   as one line of JSON::
+
+      {"sources": ["/music/flac/artist/album"], "priority": "interactive"}
+
+   The service replies with one line of JSON per progress event, until the
+   request is finished:
+
+   * ``queued``: the request is accepted; ``coalesced`` is true if it
+     joined an identical request that is not started yet.
+   * ``start``: the source files are scanned; ``files`` is the number of
+     files to encode.
+   * ``file``: a file is finished; ``ok`` is false if it failed.
+   * ``done``: all files are finished, with the ``encoded`` and ``failed``
+     counts.
+   * ``error``: the request is invalid, or the service stopped.
+
+   Requests are scanned one at a time, and their jobs are queued for the
+   encoding threads by priority: the jobs of an ``interactive`` request are
+   started before the remaining jobs of ``background`` requests.
+"""
+
+import itertools
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Request priorities, highest first.
+PRIORITIES = ('interactive', 'background')
+
+#: Name of the source directory index of a service (see
+#: :class:`~flacsync.scan.ScanCache`), in :data:`flacsync.util.STATE_DIR`.
+SCAN_FILE = 'scan-service.json'
+
+
+#############################################################################
+class Request( object ):
+   """
+   Sync request of one or more clients.
+   """
+   def __init__( self, id_, sources, priority='interactive', deep=False ):
+      """
+      :param id_:      Request number.
+      :type  id_:      int
+
+      :param sources:  Absolute source paths to sync, or an empty list for
+                       the whole base directory.
+      :type  sources:  list
+
+      :param priority: Request priority, one of :data:`PRIORITIES`.
+      :type  priority: str
+
+      :param deep:     Scan the source directories, even if they are
+                       unchanged since the previous scan.
+      :type  deep:     boolean
+      """
+      self.id = id_
+      self.sources = sources
+      self.priority = priority
+      self.deep = deep
+      #: Number of files to encode, set by the plan function of the
+      #: :class:`Service`.
+      self.files = 0
+      self.encoded = 0
+      self.failed = 0
+      #: :class:`~flacsync.WorkUnit` of the request, once scanned.
+      self.work = None
+      #: Set once the request is finished.
+      self.finished = threading.Event()
+      self._jobs = 0
+      self._clients = []
+      self._lock = threading.Lock()
+
+   @property
+   def key( self ):
+      """Identical requests have the same key."""
+      return (tuple(sorted(self.sources)), self.deep)
+
+   def attach( self, client ):
+      """
+      :param client: File object of a client connection, receiving the
+                     events of the request.
+      :type  client: file
+      """
+      with self._lock:
+         self._clients.append( client )
+
+   def emit( self, event, **fields ):
+      """
+      Send an event to all clients. Clients that closed the connection are
+      dropped.
+      """
+      fields.update( event=event, id=self.id )
+      line = _line( fields )
+      with self._lock:
+         for c in list(self._clients):
+            if not _send( c, line ):
+               self._clients.remove( c )
+
+   def file_done( self, encoder, ok ):
+      """
+      Send the event of a finished file, see
+      :attr:`flacsync.WorkUnit.listener`.
+      """
+      with self._lock:
+         if ok:
+            self.encoded += 1
+         else:
+            self.failed += 1
+      self.emit( 'file', src=_text(encoder.src), dst=_text(encoder.dst),
+                 ok=bool(ok) )
+
+   def close( self ):
+      """Release the clients of a finished request."""
+      with self._lock:
+         self._clients = []
+      self.finished.set()
+
+
+#############################################################################
+class Service( object ):
+   """
+   Queue of sync requests, and the threads scanning and encoding them.
+   """
+   def __init__( self, path, threads, plan, finish=None ):
+      """
+      :param path:     Unix socket path.
+      :type  path:     str
+
+      :param threads:  Number of encoding threads.
+      :type  threads:  int
+
+      :param plan:     Function of a :class:`Request`, that scans its source
+                       files and sets :attr:`Request.files`. Returns a tuple
+                       of the :class:`~flacsync.WorkUnit` and the list of
+                       (function, args) jobs of the request, see
+                       :func:`flacsync.get_jobs`. Raises :exc:`ValueError`
+                       for an invalid request.
+      :type  plan:     function
+
+      :param finish:   Function of a :class:`Request`, called once its jobs
+                       are finished.
+      :type  finish:   function
+      """
+      self.path = path
+      self.threads = threads
+      self._plan = plan
+      self._finish = finish
+      self._ids = itertools.count( 1 )
+      self._seq = itertools.count()
+      self._requests = Queue.PriorityQueue()
+      self._jobs = Queue.PriorityQueue()
+      self._queued = {}
+      self._running = set()
+      self._lock = threading.Lock()
+      self._threads = []
+      self._server = None
+      self._stopping = False
+
+   @property
+   def depth( self ):
+      """Number of queued jobs, not started by an encoding thread."""
+      return self._jobs.qsize()
+
+   def start( self ):
+      """
+      Listen on the socket, and start the scanning and encoding threads.
+
+      :raises: :exc:`ValueError` if another service is listening on the
+               socket.
+      """
+      if os.path.exists( self.path ):
+         probe = socket.socket( socket.AF_UNIX )
+         try:
+            probe.connect( self.path )
+         except socket.error:
+            os.remove( self.path )   # left by a service that was killed
+         else:
+            probe.close()
+            raise ValueError( "a service is running on '%s'" % (self.path,) )
+      self._server = _Server( self.path, _Handler )
+      self._server.service = self
+      os.chmod( self.path, 0600 )
+      targets = [self._server.serve_forever, self._scan]
+      targets += [self._work] * self.threads
+      for t in targets:
+         thread = threading.Thread( target=t )
+         thread.daemon = True
+         thread.start()
+         self._threads.append( thread )
+
+   def stop( self ):
+      """
+      Stop listening, abort the running requests, and wait for the threads
+      to finish. The files being encoded are completed.
+      """
+      self._server.shutdown()
+      self._server.server_close()
+      try:
+         os.remove( self.path )
+      except OSError: pass  # ignore if already removed
+      with self._lock:
+         self._stopping = True
+         for r in self._running:
+            if r.work:
+               r.work.abort = True
+      # stop markers are queued ahead of the requests, and after the jobs
+      self._requests.put( (-1, self._seq.next(), None) )
+      self._threads[1].join()
+      last = len(PRIORITIES)
+      for _ in range(self.threads):
+         self._jobs.put( (last, self._seq.next(), None, None, None) )
+      for t in self._threads[2:]:
+         t.join()
+      with self._lock:
+         queued,self._queued = self._queued.values(),{}
+      for r in queued:
+         r.emit( 'error', message='service stopped' )
+         r.close()
+
+   def submit( self, sources, priority='interactive', deep=False,
+               client=None ):
+      """
+      Queue a sync request, or join an identical request that is not
+      started yet. A joined request is raised to the higher priority.
+
+      :param sources:  Absolute source paths to sync.
+      :type  sources:  list
+
+      :param priority: Request priority, one of :data:`PRIORITIES`.
+      :type  priority: str
+
+      :param deep:     See :class:`Request`.
+      :type  deep:     boolean
+
+      :param client:   File object of the client connection.
+      :type  client:   file
+
+      :returns: :class:`Request` object.
+      :raises: :exc:`ValueError` if the priority is not valid.
+      """
+      if priority not in PRIORITIES:
+         raise ValueError( "unknown priority '%s'" % (priority,) )
+      with self._lock:
+         req = Request( None, list(sources), priority, bool(deep) )
+         queued = self._queued.get( req.key )
+         if queued:
+            req = queued
+         else:
+            req.id = self._ids.next()
+            self._queued[req.key] = req
+         rank = PRIORITIES.index( priority )
+         if not queued or rank < PRIORITIES.index( req.priority ):
+            # an upgraded request is queued again, the old entry is ignored
+            req.priority = priority
+            self._requests.put( (rank, self._seq.next(), req) )
+         if client:
+            _send( client, _line({'event':'queued', 'id':req.id,
+                  'priority':req.priority, 'coalesced':bool(queued)}) )
+            req.attach( client )
+      return req
+
+   def _scan( self ):
+      # scan the requests one at a time, and queue their jobs
+      while True:
+         _,_,req = self._requests.get()
+         if req is None:
+            return
+         with self._lock:
+            if self._queued.get( req.key ) is not req:
+               continue   # upgraded, or already scanned
+            del self._queued[req.key]
+         try:
+            work,jobs = self._plan( req )
+         except Exception as exc:
+            # i.e. a file removed during the scan; the thread must survive
+            # for the next requests
+            if not isinstance( exc, (ValueError, IOError, OSError) ):
+               print "ERROR: request %d failed, %s !!" % (req.id, exc)
+            req.emit( 'error', message=str(exc) or exc.__class__.__name__ )
+            req.close()
+            continue
+         req.work = work
+         req._jobs = len(jobs)
+         req.emit( 'start', files=req.files )
+         if not jobs:
+            self._done( req )
+            continue
+         rank = PRIORITIES.index( req.priority )
+         with self._lock:
+            self._running.add( req )
+            if work and self._stopping:
+               work.abort = True
+         for func,args in jobs:
+            self._jobs.put( (rank, self._seq.next(), req, func, args) )
+
+   def _work( self ):
+      # run the queued jobs, highest priority first
+      while True:
+         _,_,req,func,args = self._jobs.get()
+         if req is None:
+            return
+         try:
+            func( *args )
+         except Exception as exc:
+            print "ERROR: request %d failed, %s !!" % (req.id, exc)
+         with req._lock:
+            req._jobs -= 1
+            last = not req._jobs
+         if last:
+            self._done( req )
+
+   def _done( self, req ):
+      with self._lock:
+         self._running.discard( req )
+      if self._finish:
+         self._finish( req )
+      req.emit( 'done', files=req.files, encoded=req.encoded,
+                failed=req.failed )
+      req.close()
+
+
+class _Server( SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer ):
+   daemon_threads = True
+
+
+class _Handler( SocketServer.StreamRequestHandler ):
+
+   def handle( self ):
+      line = self.rfile.readline()
+      if not line:
+         return   # i.e. the probe of Service.start
+      try:
+         data = json.loads( line )
+         sources = [s.encode('utf-8') for s in data.get('sources', [])]
+         req = self.server.service.submit( sources,
+               data.get('priority', 'interactive'), data.get('deep', False),
+               self.wfile )
+      except (ValueError, AttributeError, TypeError) as exc:
+         _send( self.wfile, _line({'event':'error', 'message':str(exc)}) )
+         return
+      # keep the connection open, for the events of the request
+      req.finished.wait()
+
+   def finish( self ):
+      try:
+         SocketServer.StreamRequestHandler.finish( self )
+      except socket.error:
+         pass   # closed by the client
+
+
+def submit( path, sources, priority='interactive', deep=False ):
+   """
+   Request a sync from a service.
+
+   :param path:     Unix socket path of the service.
+   :type  path:     str
+
+   :param sources:  Absolute source paths to sync, or an empty list for the
+                    whole base directory of the service.
+   :type  sources:  list
+
+   :param priority: Request priority, one of :data:`PRIORITIES`.
+   :type  priority: str
+
+   :param deep:     See :class:`Request`.
+   :type  deep:     boolean
+
+   :returns: Generator of the event dictionaries of the request.
+   :raises: :exc:`socket.error` if the service is not running.
+   """
+   sock = socket.socket( socket.AF_UNIX )
+   sock.connect( path )
+   fh = sock.makefile( 'r+b' )
+   try:
+      fh.write( _line({'sources':[_text(s) for s in sources],
+                       'priority':priority, 'deep':deep}) )
+      fh.flush()
+      for line in fh:
+         yield json.loads( line )
+   finally:
+      fh.close()
+      sock.close()
+
+
+def _line( data ):
+   return json.dumps( data ) + '\n'
+
+
+def _send( client, line ):
+   # :returns: False if the client closed the connection
+   try:
+      client.write( line )
+      client.flush()
+      return True
+   except (IOError, socket.error):
+      return False
+
+
+def _text( path ):
+   # file names are byte strings, json strings are unicode
+   return path.decode('utf-8', 'replace') if isinstance(path, str) else path
@@ -0,0 +1,147 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.shard
+   ~~~~~~~~~~~~~~
+
+   Define a deterministic partition of the source tree, used to divide a
+   single sync between multiple hosts that share the source and destination
+   directories.
+
+   Files are assigned to a shard by a stable hash of their directory path,
+   relative to the base directory, so every file of an album is handled by
+   the same host. Each shard records a manifest in the destination once it
+   completes, which is checked by a final (unsharded) merge run.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from . import util
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Sub-directory of :data:`flacsync.util.STATE_DIR` holding shard manifests.
+MANIFEST_DIR = 'shards'
+
+
+#############################################################################
+class Shard( object ):
+   """
+   A single slice of the source tree.
+   """
+   def __init__( self, index, count ):
+      """
+      :param index:  Shard number, from 1 to :data:`count`.
+      :type  index:  int
+
+      :param count:  Total number of shards.
+      :type  count:  int
+      """
+      if not 1 <= index <= count:
+         raise ValueError( "shard %d is not in range 1..%d" % (index,count) )
+      self.index = index
+      self.count = count
+
+   def __str__( self ):
+      return '%d/%d' % (self.index, self.count)
+
+   def contains( self, rel_dir ):
+      """
+      :param rel_dir: Album directory, relative to the base (or destination)
+                      directory.
+      :type  rel_dir: str
+
+      :returns: :data:`True` if the directory belongs to this shard.
+      """
+      return shard_of( rel_dir, self.count ) == self.index
+
+   def select( self, base_dir, files ):
+      """
+      :returns: Generator of the files of :data:`base_dir` (or a mirror of
+                it) located in album directories of this shard.
+      """
+      return (f for f in files if self.contains( _rel_dir(f, base_dir) ))
+
+   def manifest_path( self, dest_dir ):
+      """:returns: Path of the manifest of this shard in :data:`dest_dir`."""
+      return os.path.join( dest_dir, util.STATE_DIR, MANIFEST_DIR,
+                           '%d-of-%d.json' % (self.index, self.count) )
+
+   def write_manifest( self, dest_dir, jobs ):
+      """
+      Record the completion of this shard.
+
+      :param dest_dir: Destination root directory.
+      :type  dest_dir: str
+
+      :param jobs:     Number of files encoded by the shard.
+      :type  jobs:     int
+      """
+      data = {'index':self.index, 'count':self.count, 'time':time.time(),
+              'jobs':jobs}
+      util.save_json( self.manifest_path(dest_dir), data )
+
+
+def parse( spec ):
+   """
+   Parse a shard specification of the form ``i/N``.
+
+   :returns: :class:`Shard` instance.
+   :raises: :exc:`ValueError` if the specification is invalid.
+   """
+   try:
+      index,count = map( int, spec.split('/') )
+   except ValueError:
+      raise ValueError( "shard '%s' is not of the form i/N" % (spec,) )
+   return Shard( index, count )
+
+
+def shard_of( rel_dir, count ):
+   """
+   :returns: Shard number (1 to :data:`count`) of an album directory.
+   """
+   digest = hashlib.md5( rel_dir.replace(os.sep,'/') ).hexdigest()
+   return int(digest[:8], 16) % count + 1
+
+
+def merge( dest_dir ):
+   """
+   Reconcile the manifests written by each shard of a previous sharded
+   sync, and remove them.
+
+   :param dest_dir: Destination root directory.
+   :type  dest_dir: str
+
+   :returns: List of :class:`Shard` objects that did not complete. Empty if
+             all shards completed, or there are no manifests.
+   """
+   mdir = os.path.join( dest_dir, util.STATE_DIR, MANIFEST_DIR )
+   try:
+      names = [f for f in os.listdir(mdir) if f.endswith('.json')]
+   except OSError:
+      names = []
+   manifests = []
+   for name in names:
+      try:
+         with open(os.path.join(mdir,name)) as fh:
+            manifests.append( json.load(fh) )
+      except (IOError, ValueError):
+         pass
+      os.remove( os.path.join(mdir,name) )
+   # only manifests of the most recent partition are used
+   count = max([(m['time'],m['count']) for m in manifests] or [(0,0)])[1]
+   found = set( m['index'] for m in manifests if m['count'] == count )
+   return [Shard(i,count) for i in range(1,count+1) if i not in found]
+
+
+def _rel_dir( path, base_dir ):
+   return os.path.relpath( os.path.dirname(path), base_dir )
@@ -0,0 +1,113 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.steps
+   ~~~~~~~~~~~~~~
+
+   Define a concurrent engine of the process steps of a file.
+
+   By default, a worker thread runs the steps of a file in sequence: encode,
+   read the source tags, prepare the cover thumbnail, and write the tags and
+   the cover. With the engine, the steps that do not need the output (the
+   source tags and the thumbnail) run on a helper thread while the encoder
+   processes run. Each class of steps is limited by its own semaphore:
+
+   ==========  ==========================================================
+   ``decode``  reads of the source file (tags and cover art)
+   ``encode``  decoder and encoder processes
+   ``tag``     tag and cover writes of the output (i.e. tagger processes)
+   ==========  ==========================================================
+
+   The worker pool holds :data:`WORKERS` files per encoder slot, so the
+   encoder slots are kept busy while other files are tagged.
+"""
+
+import multiprocessing.dummy as mp
+import threading
+
+from . import decoder
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Resource classes of the steps.
+CLASSES = ('decode', 'encode', 'tag')
+
+#: Worker threads (files in flight) per encoder slot.
+WORKERS = 2
+
+
+#############################################################################
+class Engine( object ):
+   """
+   Semaphores of the step classes, and the helper threads of the early
+   steps of each file.
+   """
+   def __init__( self, limits, threads ):
+      """
+      :param limits: Mapping of each class of :data:`CLASSES` to the max
+                     number of concurrent steps.
+      :type  limits: dict
+
+      :param threads: Number of helper threads, running the early steps.
+      :type  threads: int
+      """
+      self._slots = dict( (c, threading.BoundedSemaphore(limits[c]))
+                          for c in CLASSES )
+      self._pool = mp.Pool( processes=threads )
+
+   def slot( self, name ):
+      """
+      :returns: Semaphore of a step class, used as a context manager around
+                the step.
+      """
+      return self._slots[name]
+
+   def prepare( self, encoder, resize=False ):
+      """
+      Start the early steps of a file: read the source tags, and prepare the
+      cover thumbnail (see :meth:`~flacsync.encoder._Encoder.thumbnail_data`)
+      unless the album provides one.
+
+      :param encoder: Encoder object of the file.
+      :type  encoder: :class:`~flacsync.encoder._Encoder`
+
+      :param resize:  Resize the cover thumbnail.
+      :type  resize:  boolean
+
+      :returns: Result object; ``get()`` waits for the source tags, and
+                raises the error of the tag read.
+      """
+      return self._pool.apply_async( self._prepare, (encoder, resize) )
+
+   def close( self ):
+      """Wait for the running steps, and stop the helper threads."""
+      self._pool.close()
+      self._pool.join()
+
+   def _prepare( self, encoder, resize ):
+      with self._slots['decode']:
+         tags = decoder.FlacDecoder( encoder.flac ).tags
+         if encoder.cover and not encoder.cover_data:
+            try:
+               encoder.cover_data = encoder.thumbnail_data( resize )
+            except Exception:
+               pass  # reported by the cover step, that tries again
+      return tags
+
+
+class _Unlimited( object ):
+   # step context without an engine
+   def __enter__( self ):
+      pass
+
+   def __exit__( self, *exc ):
+      pass
+
+#: Step context of a run without an engine.
+UNLIMITED = _Unlimited()
@@ -0,0 +1,112 @@
+"""
+   Test module for album.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import album
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _encoder( dst, cover='/flac/a/cover.jpg' ):
+   e = Mock()
+   e.dst = dst
+   e.cover = cover
+   e.cover_dst = cover and cover.replace('/flac', '/aac')
+   e.cover_data = None
+   e.thumbnail_data.return_value = 'jpeg'
+   return e
+
+
+class TestAlbum(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.dir = os.path.join(self.tmp, 'artist', 'album')
+      self.tracks = [_encoder(os.path.join(self.dir, '%d.m4a' % (i,)))
+                        for i in range(3)]
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_group(self):
+      "Group encoders by destination directory."
+      other = _encoder( '/aac/b/1.m4a' )
+      albums = album.group( self.tracks + [other] )
+      eq_( sorted(albums), ['/aac/b', self.dir] )
+      eq_( albums[self.dir].encoders, self.tracks )
+
+   def test_prepare(self):
+      "Create the destination dir and the cover thumbnail once."
+      a = album.Album( self.tracks )
+      a.prepare( True )
+      a.prepare( True )
+      assert os.path.isdir( self.dir )
+      eq_( [e.cover_data for e in self.tracks], ['jpeg']*3 )
+      eq_( sum(e.thumbnail_data.call_count for e in self.tracks), 1 )
+      self.tracks[0].thumbnail_data.assert_called_with( True )
+
+   def test_finish(self):
+      "Track completion, and failed tracks."
+      a = album.Album( self.tracks )
+      assert not a.finish( self.tracks[0], True )
+      assert not a.finish( self.tracks[1], False )
+      assert not a.complete
+      assert a.finish( self.tracks[2], True )
+      eq_( a.failed, [self.tracks[1]] )
+
+   def test_copy_cover(self):
+      "Copy each cover file once."
+      a = album.Album( self.tracks + [_encoder(self.dir + '/4.m4a', None)] )
+      a.copy_cover( True )
+      eq_( sum(e.copy_cover.call_count for e in a.encoders), 1 )
+
+
+class TestCoverCache(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.cover = os.path.join(self.tmp, 'cover.jpg')
+      open(self.cover, 'w').close()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_thumbnail(self):
+      "Thumbnails are converted again after the cover changed."
+      covers = album.CoverCache()
+      e = _encoder( '/aac/a/1.m4a', self.cover )
+      eq_( covers.thumbnail(e), 'jpeg' )
+      eq_( covers.thumbnail(_encoder('/aac/a/2.m4a', self.cover)), 'jpeg' )
+      eq_( (covers.hits, covers.misses), (1, 1) )
+      os.utime( self.cover, (0,0) )
+      covers.thumbnail( e )
+      eq_( (covers.hits, covers.misses), (1, 2) )
+      eq_( e.thumbnail_data.call_count, 2 )
+
+   def test_size(self):
+      "Least recently used thumbnails are dropped."
+      covers = album.CoverCache( size=1 )
+      e = _encoder( '/aac/a/1.m4a', self.cover )
+      covers.thumbnail( e )
+      covers.thumbnail( e, resize=True )
+      covers.thumbnail( e )
+      eq_( covers.misses, 3 )
+
+   def test_prepare(self):
+      "Albums use the thumbnails of the cache."
+      covers = album.CoverCache()
+      for i in range(2):
+         a = album.Album( [_encoder(os.path.join(self.tmp, 'a', '1.m4a'),
+                                    self.cover)] )
+         a.prepare( False, covers )
+      eq_( (covers.hits, covers.misses), (1, 1) )
@@ -0,0 +1,97 @@
+"""
+   Test module for budget.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import budget
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _encoder( src, size ):
+   e = Mock()
+   e.src = e.flac = src
+   e.track = None
+   e.size = size
+   return e
+
+
+class TestBudget(unittest.TestCase):
+
+   def setUp(self):
+      self.now = 1000.0
+      patcher = patch( 'flacsync.budget.job_size', lambda e: e.size )
+      patcher.start()
+      self.addCleanup( patcher.stop )
+
+   def test_parse_duration(self):
+      "Parse hour, minute and second durations."
+      eq_( budget.parse_duration('3h'), 3*3600 )
+      eq_( budget.parse_duration('1h30m'), 5400 )
+      eq_( budget.parse_duration('90m'), 5400 )
+      eq_( budget.parse_duration('45'), 45 )
+      assert_raises( ValueError, budget.parse_duration, '' )
+      assert_raises( ValueError, budget.parse_duration, '3d' )
+
+   def test_admit(self):
+      "Defer jobs once the estimated cost exceeds the remaining time."
+      b = budget.Budget( 100, clock=lambda: self.now )
+      small,large,last = [_encoder('/f%d.flac'%(i,), s)
+                            for i,s in enumerate((10,50,1))]
+      assert b.admit( small )    # no estimate yet
+      b.record( small, 20.0 )    # 2 seconds per byte
+      self.now += 20
+      assert not b.admit( large )
+      assert not b.admit( last ) # no new jobs after the first deferred
+      eq_( b.deferred, [large,last] )
+
+   def test_order(self):
+      "Order deferred files first, changed settings last, then by policy."
+      e = [_encoder('/flac/%s.flac' % (c,), s) for c,s in zip('abc',(3,1,2))]
+      eq_( budget.order(e, 'path'), e )
+      eq_( budget.order(e, 'smallest'), [e[1],e[2],e[0]] )
+      eq_( budget.order(e, 'smallest', set(['/flac/a.flac'])),
+           [e[0],e[1],e[2]] )
+      eq_( budget.order(e, 'path', later=set(['/flac/a.flac'])),
+           [e[1],e[2],e[0]] )
+
+   def test_deferred_file(self):
+      "Save and load the deferred file list, relative to BASE_DIR."
+      dest = tempfile.mkdtemp()
+      try:
+         e = [_encoder('/flac/a/%d.flac' % (i,), 1) for i in range(2)]
+         budget.save_deferred( '/flac', dest, e )
+         eq_( budget.load_deferred('/music/flac', dest),
+              set(['/music/flac/a/0.flac', '/music/flac/a/1.flac']) )
+         budget.save_deferred( '/flac', dest, [] )
+         eq_( budget.load_deferred('/flac', dest), set() )
+      finally:
+         shutil.rmtree( dest )
+
+   @patch('flacsync.util.disk_location')
+   def test_disk_order(self, mock_location):
+      "Order files by physical location on disk."
+      offsets = {'/flac/a.flac':(1,0,300), '/flac/b.flac':(1,0,100),
+                 '/flac/c.flac':(1,1,5)}
+      mock_location.side_effect = lambda f: offsets[f]
+      e = [_encoder(f, 1) for f in sorted(offsets)]
+      eq_( budget.order(e, 'disk'), [e[1],e[0],e[2]] )
+
+   def test_throughput(self):
+      "Record the read rate of each job order policy."
+      dest = tempfile.mkdtemp()
+      try:
+         eq_( budget.save_throughput(dest, 'path', 10.0), {} )
+         eq_( budget.save_throughput(dest, 'disk', 20.0), {'path':10.0} )
+         eq_( budget.save_throughput(dest, 'path', 11.0), {'disk':20.0} )
+      finally:
+         shutil.rmtree( dest )
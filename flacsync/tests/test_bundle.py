@@ -0,0 +1,106 @@
+"""
+   Test module for bundle.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import bundle
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestBundle(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.dest = os.path.join(self.tmp, 'aac')
+      self.device = os.path.join(self.tmp, 'usb')
+      self.path = os.path.join(self.tmp, 'car.tar')
+      for f in ('a/1.m4a', 'a/2.m4a', 'b/1.m4a'):
+         self._write( f, f )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def _write(self, name, data, mtime=1000):
+      path = os.path.join(self.dest, name)
+      try:
+         os.makedirs( os.path.dirname(path) )
+      except OSError: pass
+      with open(path, 'w') as fh:
+         fh.write( data )
+      os.utime( path, (mtime, mtime) )
+
+   def _device_files(self):
+      return sorted( f for f in bundle.manifest(self.device) )
+
+   def test_full(self):
+      "First bundle of a device contains all files."
+      eq_( bundle.export(self.path, self.dest, 'car'), (3, 0, 21) )
+      eq_( bundle.apply(self.path, self.device), (3, 0) )
+      eq_( bundle.manifest(self.device), bundle.manifest(self.dest) )
+
+   def test_delta(self):
+      "Later bundles contain changed files, and deleted files."
+      bundle.export( self.path, self.dest, 'car' )
+      bundle.apply( self.path, self.device )
+      self._write( 'a/2.m4a', 'new', 2000 )
+      shutil.rmtree( os.path.join(self.dest, 'b') )
+      eq_( bundle.export(self.path, self.dest, 'car'), (1, 1, 3) )
+      eq_( bundle.apply(self.path, self.device), (1, 1) )
+      eq_( self._device_files(), ['a/1.m4a', 'a/2.m4a'] )
+      assert not os.path.exists( os.path.join(self.device, 'b') )
+      with open(os.path.join(self.device, 'a/2.m4a')) as fh:
+         eq_( fh.read(), 'new' )
+
+   def test_missing_bundle(self):
+      "A bundle that does not follow the device state is rejected."
+      bundle.export( self.path, self.dest, 'car' )
+      self._write( 'c/1.m4a', 'c' )
+      bundle.export( self.path, self.dest, 'car' )
+      assert_raises( ValueError, bundle.apply, self.path, self.device )
+      eq_( bundle.apply(self.path, self.device, force=True), (1, 0) )
+
+   def test_lost_bundle(self):
+      "A lost bundle is replaced by an export from the device state."
+      bundle.export( self.path, self.dest, 'car' )
+      bundle.apply( self.path, self.device )
+      applied = bundle._load( os.path.join(self.device, '.flacsync',
+                                           'bundle.json') )['id']
+      self._write( 'c/1.m4a', 'c' )
+      bundle.export( self.path, self.dest, 'car' )   # lost
+      self._write( 'd/1.m4a', 'd' )
+      bundle.export( self.path, self.dest, 'car' )
+      assert_raises( ValueError, bundle.apply, self.path, self.device )
+      eq_( bundle.export(self.path, self.dest, 'car', base=applied),
+           (2, 0, 2) )
+      eq_( bundle.apply(self.path, self.device), (2, 0) )
+      eq_( bundle.manifest(self.device), bundle.manifest(self.dest) )
+      assert_raises( ValueError, bundle.export, self.path, self.dest, 'car',
+                     base='unknown' )
+
+   def test_pending(self):
+      "Only the last exports are kept, and those before the base dropped."
+      state = os.path.join( self.dest, '.flacsync', 'exports', 'car.json' )
+      with patch.object( bundle, 'MAX_PENDING', 3 ):
+         for i in range(4):
+            self._write( 'c/%d.m4a' % (i,), 'c' )
+            bundle.export( self.path, self.dest, 'car' )
+      data = bundle._load( state )
+      eq_( len(data['exports']), 3 )
+      bundle.export( self.path, self.dest, 'car', base=data['id'] )
+      eq_( len(bundle._load(state)['exports']), 2 )
+
+   def test_unsafe_path(self):
+      "Paths outside of the device are rejected."
+      assert_raises( ValueError, bundle._target, '/usb', '../etc/passwd' )
+      assert_raises( ValueError, bundle._target, '/usb', '/etc/passwd' )
+      eq_( bundle._target('/usb', 'a/1.m4a'), '/usb/a/1.m4a' )
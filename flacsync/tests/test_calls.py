@@ -0,0 +1,233 @@
+"""
+   Test module for the file system calls and process launches of each
+   processed file.
+
+   The source files are real files in a temporary directory, while
+   :mod:`subprocess` and :mod:`PIL.Image` are replaced by counting fakes, so
+   that an extra ``stat``, directory listing or encoder launch per file
+   fails a budget. The budgets are fixed per file, and are checked with two
+   album sizes, so that a cost that grows with the size of the album (i.e.
+   a scan of the album directory for each track) also fails.
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import album
+from .. import decoder
+from .. import encoder
+from .. import job
+from .. import WorkUnit
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+TRACKS = 4
+
+#: Max ``stat`` calls per file, for each processing path.
+STATS = {
+   # mtimes of the source, output and cover (util.newer checks that each
+   # file exists, then reads its mtime), and the check of the cover file
+   'skip':9,
+   # the same, except that the output does not exist; the album work is
+   # shared by its tracks
+   'encode':5,
+   # the mtimes of the skip check, of the cover update and of the cover
+   # copy
+   'cover':14,
+   }
+
+# wrapped calls, by counter name
+CALLS = {
+   'stat'   :'os.stat',
+   'lstat'  :'os.lstat',
+   'listdir':'os.listdir',
+   'open'   :'__builtin__.open',
+   'os_open':'os.open',
+   }
+
+
+def _flac( path, title ):
+   # minimal FLAC file: STREAMINFO and a VORBIS_COMMENT block
+   comment = 'TITLE=%s' % (title,)
+   data = struct.pack('<I', 0) + struct.pack('<I', 1)
+   data += struct.pack('<I', len(comment)) + comment
+   with open(path, 'wb') as fh:
+      fh.write( 'fLaC' + struct.pack('>I', 34) + '\0'*34 )
+      fh.write( struct.pack('>I', 0x84000000 | len(data)) + data )
+
+
+class FakeProcess(object):
+   "Process that exits without error."
+   returncode = 0
+
+   def __init__(self, *args, **kwargs):
+      pass
+
+   def wait(self):
+      return 0
+
+
+class Calls(object):
+   """
+   Context of the counted calls, see :data:`CALLS`. Process launches are
+   counted as ``spawn``, and cover images opened as ``image``.
+   """
+   def __init__(self):
+      self.counts = {}
+      self.image = Mock()
+      self.image.open.return_value.save.side_effect = \
+            lambda fh, fmt: fh.write('jpeg')
+
+   def __enter__(self):
+      self._patches = [(k, patch(v, Mock(wraps=_original(v))))
+                       for k,v in CALLS.items()]
+      self._patches.append( ('spawn', patch('subprocess.Popen',
+                                            Mock(side_effect=FakeProcess))) )
+      self._mocks = [(k, p.start()) for k,p in self._patches]
+      self._image = patch('flacsync.encoder.Image', self.image)
+      self._image.start()
+      return self
+
+   def __exit__(self, *exc):
+      self._image.stop()
+      for _,p in self._patches:
+         p.stop()
+      self.counts = dict( (k, m.call_count) for k,m in self._mocks )
+      self.counts['image'] = self.image.open.call_count
+
+   def per_file(self, files):
+      "Counts divided by the number of processed files."
+      return dict( (k, float(v) / files) for k,v in self.counts.items() )
+
+
+def _original( name ):
+   module,attr = name.rsplit('.', 1)
+   return getattr( __import__(module), attr )
+
+
+class TestBudget(unittest.TestCase):
+   tracks = TRACKS
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.src = os.path.join( self.tmp, 'flac', 'album' )
+      self.dest = os.path.join( self.tmp, 'aac' )
+      os.makedirs( self.src )
+      old = time.time() - 100
+      for i in range(self.tracks):
+         path = os.path.join( self.src, '%02d.flac' % (i+1,) )
+         _flac( path, 'Track %d' % (i+1,) )
+         os.utime( path, (old, old) )
+      self.cover = os.path.join( self.src, 'cover.jpg' )
+      with open(self.cover, 'wb') as fh:
+         fh.write( 'jpeg' )
+      os.utime( self.cover, (old, old) )
+      # one time setup, outside of the counted calls
+      encoder.null()
+      tempfile.gettempdir()
+
+   def tearDown(self):
+      shutil.rmtree( self.tmp )
+
+   def _stats(self, per_file, path):
+      # a stat of each entry of the album dir per track (i.e. an os.walk of
+      # the dir to find the cover) exceeds the budget of TestBudgetLarge
+      assert_less_equal( per_file['stat'] + per_file['lstat'], STATS[path] )
+
+   def _jobs(self):
+      plan = job.Plan( encoder.AacEncoder, aac_q='0.35',
+                       base_dir=os.path.join(self.tmp, 'flac'),
+                       dest_dir=self.dest )
+      return [plan.add( os.path.join(self.src, f) )
+              for f in sorted(os.listdir(self.src)) if f.endswith('.flac')]
+
+   def _outputs(self, age=0):
+      # up to date outputs of all tracks
+      for j in self._jobs():
+         try:
+            os.makedirs( os.path.dirname(j.dst) )
+         except OSError: pass
+         with open(j.dst, 'wb') as fh:
+            fh.write( 'm4a' )
+         mtime = time.time() - age
+         os.utime( j.dst, (mtime, mtime) )
+
+   def _run(self, jobs, force=False):
+      opts = Mock( force=force, analyze_gain=False, max_rate=None,
+                   max_bits=None, art_resize=False, art_copy=False )
+      work = WorkUnit( opts, len(jobs) )
+      work.albums = album.group( jobs )
+      with patch('sys.stdout'):
+         for j in jobs:
+            work.do_work( j )
+
+   def test_skip(self):
+      "Up to date files are checked without process launches."
+      self._outputs()
+      jobs = self._jobs()
+      with Calls() as calls:
+         eq_( list(job.pending(jobs)), [] )
+      per_file = calls.per_file( self.tracks )
+      eq_( per_file['spawn'], 0 )
+      eq_( per_file['image'], 0 )
+      eq_( per_file['open'] + per_file['os_open'], 0 )
+      eq_( per_file['listdir'], 1 )
+      self._stats( per_file, 'skip' )
+
+   def test_encode(self):
+      "A full AAC encode launches the encoder, tagger and cover tagger."
+      jobs = list( job.pending(self._jobs(), force=True) )
+      with Calls() as calls:
+         self._run( jobs, force=True )
+      per_file = calls.per_file( self.tracks )
+      eq_( per_file['spawn'], 3 )
+      # cover thumbnail is shared by the album
+      eq_( calls.counts['image'], 1 )
+      # tags read from the FLAC file, and the temporary files of the
+      # encoder error output and the cover thumbnail
+      eq_( per_file['open'], 1 )
+      eq_( per_file['os_open'], 2 )
+      eq_( per_file['listdir'], 1 )
+      self._stats( per_file, 'encode' )
+
+   def test_tag(self):
+      "Tags are written by a single process launch."
+      self._outputs()
+      enc = self._jobs()[0].encoder()
+      tags = {}.fromkeys( decoder.FlacDecoder.FLAC_TAGS )
+      with Calls() as calls:
+         ok_( enc.tag(tags) )
+      eq_( calls.counts['spawn'], 1 )
+      eq_( sum(calls.counts.values()), 1 )
+
+   def test_cover(self):
+      "A newer cover is added to up to date outputs, with one launch each."
+      self._outputs( age=200 )
+      for j in self._jobs():
+         os.utime( j.flac, (0, 0) )
+      jobs = list( job.pending(self._jobs()) )
+      eq_( len(jobs), self.tracks )
+      with Calls() as calls:
+         self._run( jobs )
+      per_file = calls.per_file( self.tracks )
+      eq_( per_file['spawn'], 1 )
+      eq_( calls.counts['image'], 1 )
+      eq_( per_file['open'], 0 )
+      eq_( per_file['os_open'], 1 )
+      eq_( per_file['listdir'], 1 )
+      self._stats( per_file, 'cover' )
+
+
+class TestBudgetLarge(TestBudget):
+   "The same budgets per file, in an album directory of 4x the entries."
+   tracks = 4*TRACKS
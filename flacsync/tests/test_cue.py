@@ -0,0 +1,170 @@
+"""
+   Test module for cue.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import cue
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+CUE_SHEET = '''REM GENRE Rock
+REM DATE 1999
+PERFORMER "The Band"
+TITLE "Live Album"
+FILE "album.flac" WAVE
+  TRACK 01 AUDIO
+    TITLE "Intro"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Song: Two?"
+    PERFORMER "Guest"
+    INDEX 00 03:58:50
+    INDEX 01 04:00:15
+'''
+
+
+def _streaminfo( rate=44100 ):
+   bits = (rate << 44) | (1 << 41) | (15 << 36) | 44100*600
+   return ('fLaC' + '\x00\x00\x00\x22' + struct.pack('>HH', 4096, 4096) +
+           '\x00'*6 + struct.pack('>Q', bits) + '\x00'*16)
+
+
+def _cuesheet_block( starts ):
+   data = '\x00'*128 + struct.pack('>Q', 88200) + '\x01' + '\x00'*258
+   data += chr(len(starts) + 1)
+   for num,offset in starts + [(170, 44100*600)]:
+      data += struct.pack('>QB', offset, num) + '\x00'*26
+      if num == 170:
+         data += '\x00'
+      else:
+         data += '\x01' + struct.pack('>QB', 0, 1) + '\x00'*3
+   return '\x85' + struct.pack('>I', len(data))[1:] + data
+
+
+def _comment_block( fields ):
+   data = struct.pack('<I', 0) + struct.pack('<I', len(fields))
+   for f in fields:
+      data += struct.pack('<I', len(f)) + f
+   return '\x04' + struct.pack('>I', len(data))[1:] + data
+
+
+class TestParseCue(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.image = os.path.join(self.tmp, 'album.flac')
+      with open(self.image, 'wb') as fh:
+         fh.write( _streaminfo() )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_tracks(self):
+      "Convert INDEX 01 times to sample ranges and merge album tags."
+      t1,t2 = cue.parse_cue( CUE_SHEET, self.image )
+      eq_( (t1.start, t1.end), (0, t2.start) )
+      eq_( (t2.start, t2.end), (240*44100 + 15*44100//75, None) )
+      eq_( t2.decode_opts(), ['--skip=%d' % (t2.start,)] )
+      eq_( t1.tags['album'], 'Live Album' )
+      eq_( t1.tags['artist'], 'The Band' )
+      eq_( t2.tags['artist'], 'Guest' )
+      eq_( t2.tags['year'], '1999' )
+      eq_( (t2.tags['track'], t2.tags['totaltracks']), ('2', '2') )
+
+   def test_unquoted(self):
+      "Unquoted values are the rest of the line, and may have quotes."
+      text = CUE_SHEET.replace( 'TITLE "Song: Two?"',
+            "TITLE It's So Easy" ).replace( 'PERFORMER "Guest"',
+            "PERFORMER  Guns N' Roses " ).replace( 'REM GENRE Rock',
+            "REM GENRE Rock 'n' Roll" )
+      t1,t2 = cue.parse_cue( text, self.image )
+      eq_( t2.tags['title'], "It's So Easy" )
+      eq_( t2.tags['artist'], "Guns N' Roses" )
+      eq_( t1.tags['genre'], "Rock 'n' Roll" )
+      eq_( t1.tags['title'], 'Intro' )
+
+   def test_path(self):
+      "Virtual track paths are named after the number and a safe title."
+      t1,t2 = cue.parse_cue( CUE_SHEET, self.image )
+      eq_( t2.path, os.path.join(self.tmp, '02 - Song_ Two_.flac') )
+      path = cue.TrackPath( t2 )
+      eq_( path, t2.path )
+      assert path.track is t2
+
+   def test_multi_file(self):
+      "Reject cue sheets of a multi file rip."
+      text = CUE_SHEET + 'FILE "other.flac" WAVE\n'
+      assert_raises( ValueError, cue.parse_cue, text, self.image )
+
+   def test_find_tracks(self):
+      "Find a sidecar cue sheet, or an embedded CUESHEET block."
+      eq_( cue.find_tracks(self.image), [] )
+      with open(os.path.join(self.tmp, 'album.cue'), 'w') as fh:
+         fh.write( CUE_SHEET )
+      tracks = cue.find_tracks( self.image )
+      eq_( len(tracks), 2 )
+      eq_( tracks[0].cue, os.path.join(self.tmp, 'album.cue') )
+      eq_( len(cue.dir_tracks(self.tmp)), 2 )
+
+   def test_embedded(self):
+      "Read track offsets of an embedded CUESHEET block, without lead-out."
+      with open(self.image, 'wb') as fh:
+         fh.write( _streaminfo() + _cuesheet_block([(1,0),(2,44100*200)]) )
+      t1,t2 = cue.read_cuesheet( self.image )
+      eq_( (t1.number, t1.start, t1.end), (1, 0, 44100*200) )
+      eq_( (t2.number, t2.start, t2.end), (2, 44100*200, None) )
+      eq_( t2.path, os.path.join(self.tmp, '02 - Track 02.flac') )
+
+   def test_merge_tags(self):
+      "Image track replaygain values are used as album values."
+      track = cue.Track( self.image, 1, 0, tags={'title':'Intro'} )
+      tags = track.merge_tags( {'title':'Whole Album', 'album':'A',
+            'rg_album_gain':None, 'rg_album_peak':None,
+            'rg_track_gain':'-3.00 dB', 'rg_track_peak':'0.9'} )
+      eq_( tags['title'], 'Intro' )
+      eq_( tags['album'], 'A' )
+      eq_( tags['rg_album_gain'], '-3.00 dB' )
+      eq_( tags['rg_track_gain'], None )
+
+   def test_single_track(self):
+      "A file with an embedded CUESHEET of one track is not an image."
+      with open(self.image, 'wb') as fh:
+         fh.write( _streaminfo() + _cuesheet_block([(1,0)]) )
+      eq_( cue.read_cuesheet(self.image), [] )
+      eq_( cue.find_tracks(self.image), [] )
+
+   def test_embedded_titles(self):
+      "Track titles of an image are read from its Vorbis comments."
+      starts = [(1,0),(2,44100*240 + 44100//5)]
+      with open(self.image, 'wb') as fh:
+         fh.write( _streaminfo() + _comment_block(['ALBUM=Live Album',
+               'CUE_TRACK01_TITLE=Intro', 'CUE_TRACK02_PERFORMER=Guest']) +
+               _cuesheet_block(starts) )
+      t1,t2 = cue.read_cuesheet( self.image )
+      eq_( t1.tags['title'], 'Intro' )
+      eq_( t1.path, os.path.join(self.tmp, '01 - Intro.flac') )
+      eq_( t2.tags.get('title'), None )
+      eq_( t2.tags['artist'], 'Guest' )
+      # the cue sheet text of a CUESHEET comment
+      with open(self.image, 'wb') as fh:
+         fh.write( _streaminfo() + _comment_block(['CUESHEET=' + CUE_SHEET]) +
+               _cuesheet_block(starts) )
+      t1,t2 = cue.read_cuesheet( self.image )
+      eq_( (t1.tags['title'], t2.tags['title']), ('Intro', 'Song: Two?') )
+      eq_( t2.tags['artist'], 'Guest' )
+      eq_( (t2.tags['track'], t2.tags['totaltracks']), ('2', '2') )
+      eq_( (t2.start, t2.end), (44100*240 + 44100//5, None) )
+      tags = t2.merge_tags( dict.fromkeys(['title', 'rg_album_gain',
+            'rg_album_peak', 'rg_track_gain', 'rg_track_peak']) )
+      eq_( tags['title'], 'Song: Two?' )
@@ -10,7 +10,10 @@
 
 from __future__ import absolute_import
 
-from mock import Mock,patch
+from mock import Mock,patch,PropertyMock
+import os
+import struct
+import tempfile
 import unittest
 from .. import decoder
 
@@ -19,15 +22,71 @@ class TestFlacTags( unittest.TestCase ):
    def setUp(self):
       self.d = decoder.FlacDecoder('temp_file.flac')
 
-   @patch('subprocess.Popen')
-   def testTags(self,mock_popen):
-      popen_ret = Mock()
-      popen_ret.communicate.return_value = ('artist=metallica',[])
-      mock_popen.return_value = popen_ret
-      t = self.d._read_tag('artist')
-      self.assertEquals( t, 'metallica' )
-
-      popen_ret.communicate.return_value = ('artist=metallica\n'+
-                                            'artist=iron maiden',[])
-      t = self.d._read_tag('artist')
-      self.assertEquals( t, 'metallica - iron maiden' )
+   @patch('flacsync.decoder.FlacDecoder.comments', new_callable=PropertyMock)
+   def testTags(self,mock_comments):
+      mock_comments.return_value = {'artist':['metallica']}
+      t = self.d.tags
+      self.assertEquals( t['artist'], 'metallica' )
+      self.assertEquals( t['album'], None )
+
+      mock_comments.return_value = {'artist':['metallica','iron maiden ']}
+      t = self.d.tags
+      self.assertEquals( t['artist'], 'metallica - iron maiden' )
+
+      mock_comments.side_effect = IOError
+      t = self.d.tags
+      self.assertEquals( t['artist'], None )
+
+
+class TestStreamInfo( unittest.TestCase ):
+
+   def testStreamInfo(self):
+      # 44.1kHz, stereo, 16 bits, 441000 samples
+      bits = (44100 << 44) | (1 << 41) | (15 << 36) | 441000
+      data = ('fLaC' + '\x80\x00\x00\x22' + struct.pack('>HH', 4096, 4096) +
+              '\x00'*6 + struct.pack('>Q', bits) + '\x00'*16)
+      info = decoder.StreamInfo(data)
+      self.assertEquals( (info.rate, info.channels, info.bits, info.samples),
+                         (44100, 2, 16, 441000) )
+      self.assertEquals( info.block_size, 4096 )
+      self.assertEquals( info.duration, 10.0 )
+      self.assertRaises( ValueError, decoder.StreamInfo, 'OggS' + data[4:] )
+
+
+class TestComments( unittest.TestCase ):
+
+   def setUp(self):
+      fd,self.name = tempfile.mkstemp(suffix='.flac')
+      os.close(fd)
+
+   def tearDown(self):
+      os.remove(self.name)
+
+   def _write(self, data):
+      with open(self.name, 'wb') as fh:
+         fh.write(data)
+
+   def testComments(self):
+      fields = ['ARTIST=Miles Davis', 'Genre=Jazz', 'GENRE=Modal', 'bad']
+      block = struct.pack('<I', 3) + 'ref' + struct.pack('<I', len(fields))
+      for f in fields:
+         block += struct.pack('<I', len(f)) + f
+      data = ('fLaC' + '\x00\x00\x00\x22' + '\x00'*34 +     # STREAMINFO
+              '\x01\x00\x00\x04' + '\x00'*4 +               # PADDING
+              '\x84' + struct.pack('>I', len(block))[1:] + block)
+      self._write( data )
+      d = decoder.FlacDecoder(self.name)
+      self.assertEquals( d.comments,
+                         {'artist':['Miles Davis'], 'genre':['Jazz','Modal']} )
+      self.assertEquals( d.picture, None )
+      self._write( 'OggS' + data[4:] )
+      self.assertRaises( ValueError, getattr, d, 'comments' )
+
+   def testPicture(self):
+      mime,desc = 'image/jpeg','front'
+      block = (struct.pack('>II', 3, len(mime)) + mime +
+               struct.pack('>I', len(desc)) + desc +
+               struct.pack('>IIIII', 250, 250, 24, 0, 4) + 'JPEG')
+      self._write( 'fLaC' + '\x00\x00\x00\x22' + '\x00'*34 +
+                   '\x86' + struct.pack('>I', len(block))[1:] + block )
+      self.assertEquals( decoder.FlacDecoder(self.name).picture, 'JPEG' )
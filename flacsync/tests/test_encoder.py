@@ -4,10 +4,12 @@
 
 from __future__ import absolute_import
 
+import os
 import unittest
 from nose.tools import *
 from mock import *
 
+from .. import decoder
 from .. import encoder
 from .. import util
 
@@ -16,18 +18,20 @@ __email__ = 'flacsync@tuxcoder.com'
 
 
 class TestCovers(unittest.TestCase):
-   WALK_VALUE = [('root_dir', 'dummy',
-                        ('file1.flac','file2.flac','cover.jpg'))]
+   LIST_VALUE = ['file1.flac','file2.flac','cover.jpg']
 
-   WALK_NO_COVER = [('root_dir', 'dummy',
-                        ('file1.flac','file2.flac','file3.flac'))]
+   LIST_NO_COVER = ['file1.flac','file2.flac','file3.flac']
 
-   @patch( 'os.walk' )
-   def _new_encoder( self, mock_walk, walk_value=WALK_VALUE):
-      mock_walk.return_value = iter(walk_value)
-      E = encoder._Encoder( src='./sample.flac', ext='ext',
+   @patch( 'os.path.isfile' )
+   @patch( 'os.listdir' )
+   def _new_encoder( self, mock_listdir, mock_isfile, list_value=LIST_VALUE):
+      mock_listdir.return_value = list_value
+      mock_isfile.return_value = True
+      E = encoder._Encoder( src='root_dir/sample.flac', ext='ext',
             base_dir='base', dest_dir='dest')
-      mock_walk.assert_called_with('.') # base of 'src' arg
+      mock_listdir.assert_called_with('root_dir') # base of 'src' arg
+      # only the matching cover file is checked
+      eq_( mock_isfile.call_count, int('cover.jpg' in list_value) )
       return E
 
    def test_get_cover(self):
@@ -37,7 +41,7 @@ class TestCovers(unittest.TestCase):
 
    def test_get_cover_without_cover(self):
       "Cover is not set when no cover file is present"
-      E = self._new_encoder( walk_value=self.WALK_NO_COVER)
+      E = self._new_encoder( list_value=self.LIST_NO_COVER)
       eq_( E.cover, None )
 
    @patch('flacsync.util.newer')
@@ -45,7 +49,59 @@ class TestCovers(unittest.TestCase):
       "No update of covers is detect if cover file does not exist."
       mock_newer.return_value = False
       # getmtime return values: dest file, src file
-      E = self._new_encoder( walk_value=self.WALK_NO_COVER)
+      E = self._new_encoder( list_value=self.LIST_NO_COVER)
       val = E.skip_encode()
       eq_( val, True )
       eq_( len(mock_newer.call_args_list), 1)
+
+
+class TestSplit(unittest.TestCase):
+
+   @patch('flacsync.encoder._Encoder._get_embedded_cover')
+   @patch('flacsync.encoder._Encoder._get_cover')
+   def setUp(self, mock_cover, mock_embedded):
+      mock_cover.return_value = None
+      mock_embedded.return_value = None
+      self.E = encoder.Mp3Encoder( src='base/sample.flac', base_dir='base',
+            dest_dir='dest', mp3_q='3')
+
+   def _split(self, duration, rate=44100, count=4):
+      info = Mock( rate=rate, block_size=4096, duration=duration,
+                   samples=int(duration*rate) )
+      with patch.object(decoder.FlacDecoder, 'info', new_callable=PropertyMock) as p:
+         p.return_value = info
+         with patch('flacsync.util.newer') as mock_newer:
+            mock_newer.return_value = True
+            return self.E.split( 600, count )
+
+   def test_short_track(self):
+      "Tracks shorter than the split time are not split."
+      eq_( self._split(599), 1 )
+
+   def test_unsupported_rate(self):
+      "Tracks with a non MPEG-1 sample rate are not split."
+      eq_( self._split(3600, rate=96000), 1 )
+
+   def test_segments(self):
+      "Segments cover the track and are aligned to FLAC and MP3 frames."
+      eq_( self._split(3600), 4 )
+      segs = self.E._segments
+      eq_( segs[0][0], 0 )
+      eq_( segs[-1][1], 3600*44100 )
+      for (s1,e1),(s2,e2) in zip(segs, segs[1:]):
+         eq_( e1, s2 )
+         eq_( e1 % 1152, 0 )
+         eq_( e1 % 4096, 0 )
+
+   def test_parts(self):
+      "Segments are encoded to a temporary dir, removed with the segments."
+      self._split(3600)
+      with patch('flacsync.encoder._call', return_value=0) as mock_call, \
+           patch.object(self.E, '_pre_encode'):
+         ok_( self.E.encode_segment(1) )
+      part = self.E._part(1)
+      ok_( part in mock_call.call_args[0][0] )
+      ok_( not part.startswith('dest') )
+      ok_( os.path.isdir(os.path.dirname(part)) )
+      eq_( self.E.join_segments(discard=True), False )
+      ok_( not os.path.exists(os.path.dirname(part)) )
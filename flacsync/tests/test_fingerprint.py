@@ -0,0 +1,78 @@
+"""
+   Test module for fingerprint.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import fingerprint
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestFingerprint(unittest.TestCase):
+
+   @patch('subprocess.Popen')
+   def test_fingerprint(self, mock_popen):
+      "Fingerprint changes with quality, encoder version and max rate."
+      mock_popen.return_value.communicate.return_value = (
+            'LAME 64bits version 3.100 (http://lame.sf.net)', None)
+      eq_( fingerprint.encoder_version('mp3'), '3.100' )
+      fp = fingerprint.fingerprint( 'mp3', {'mp3_q':'3'} )
+      eq_( fp, fingerprint.fingerprint('mp3', {'mp3_q':'3'}) )
+      assert fp != fingerprint.fingerprint( 'mp3', {'mp3_q':'2'} )
+      assert fp != fingerprint.fingerprint( 'mp3', {'mp3_q':'3'}, 44100 )
+      mock_popen.return_value.communicate.return_value = (
+            'LAME 64bits version 3.99.5', None)
+      assert fp != fingerprint.fingerprint( 'mp3', {'mp3_q':'3'} )
+      mock_popen.side_effect = OSError
+      eq_( fingerprint.encoder_version('mp3'), None )
+
+
+class TestFingerprints(unittest.TestCase):
+
+   def setUp(self):
+      self.dest = tempfile.mkdtemp()
+      self.old = Mock(dst=os.path.join(self.dest, 'a/1.mp3'))
+      self.new = Mock(dst=os.path.join(self.dest, 'a/2.mp3'))
+      os.makedirs( os.path.join(self.dest, 'a') )
+      open(self.old.dst, 'w').close()
+
+   def tearDown(self):
+      shutil.rmtree(self.dest)
+
+   def test_adopt(self):
+      "Existing outputs without a fingerprint match the current settings."
+      fps = fingerprint.Fingerprints( self.dest, 'fp1' )
+      eq_( fps.last, None )
+      assert not fps.changed( self.old )
+      assert not fps.changed( self.new )
+      eq_( fps.entries, {'a/1.mp3':'fp1'} )
+      fps.save()
+      fps = fingerprint.Fingerprints( self.dest, 'fp2' )
+      eq_( fps.last, 'fp1' )
+      assert fps.changed( self.old )
+
+   def test_record(self):
+      "Only outputs encoded with other settings are changed."
+      fps = fingerprint.Fingerprints( self.dest, 'fp1' )
+      fps.record( self.old )
+      fps.save()
+      fps = fingerprint.Fingerprints( self.dest, 'fp2' )
+      fps.record( self.new )
+      fps.save()
+      fps = fingerprint.Fingerprints( self.dest, 'fp2' )
+      assert fps.changed( self.old )
+      assert not fps.changed( self.new )
+
+   def test_empty(self):
+      "Nothing is written without outputs."
+      fingerprint.Fingerprints( self.dest, 'fp1' ).save()
+      assert not os.path.exists( os.path.join(self.dest, '.flacsync') )
@@ -0,0 +1,105 @@
+"""
+   Test module for index.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import index
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _flac( path, **tags ):
+   # write a FLAC header with a VORBIS_COMMENT block of the tags
+   fields = ['%s=%s' % (k.upper(),v) for k,v in sorted(tags.items())]
+   block = struct.pack('<I', 0) + struct.pack('<I', len(fields))
+   for f in fields:
+      block += struct.pack('<I', len(f)) + f
+   dir_ = os.path.dirname(path)
+   if not os.path.isdir(dir_):
+      os.makedirs(dir_)
+   with open(path, 'wb') as fh:
+      fh.write( 'fLaC' + '\x00\x00\x00\x22' + '\x00'*34 +
+                '\x84' + struct.pack('>I', len(block))[1:] + block )
+
+
+class TestTagIndex(unittest.TestCase):
+
+   def setUp(self):
+      self.base = tempfile.mkdtemp()
+      _flac( os.path.join(self.base, 'a/1.flac'), genre='Jazz', rating='5',
+             artist='Miles Davis' )
+      _flac( os.path.join(self.base, 'a/2.flac'), genre='Jazz', rating='3',
+             artist='John Coltrane' )
+      _flac( os.path.join(self.base, 'b/1.flac'), genre='Rock',
+             albumartist='Queen' )
+      self.idx = index.TagIndex( self.base )
+      eq_( self.idx.update(2), (3,0) )
+
+   def tearDown(self):
+      self.idx.close()
+      shutil.rmtree(self.base)
+
+   def _select(self, *terms):
+      return [os.path.relpath(f, self.base) for f in self.idx.select(terms)]
+
+   def test_query(self):
+      "Select files by tag equality, substring and number."
+      eq_( self._select('genre=jazz'), ['a/1.flac', 'a/2.flac'] )
+      eq_( self._select('genre!=Jazz'), ['b/1.flac'] )
+      eq_( self._select('artist~davis|COLTRANE'), ['a/1.flac', 'a/2.flac'] )
+      eq_( self._select('genre=jazz|rock', 'rating>=4'), ['a/1.flac'] )
+      eq_( self._select('album_artist=queen'), ['b/1.flac'] )
+      eq_( self._select('artist~%'), [] )
+      sources = [os.path.join(self.base, 'b')]
+      eq_( self.idx.select(['genre!=pop'], sources),
+           [os.path.join(self.base, 'b/1.flac')] )
+
+   def test_sources(self):
+      "Source paths select whole directories, or single files."
+      _flac( os.path.join(self.base, 'a b/1.flac'), genre='Jazz' )
+      _flac( os.path.join(self.base, 'a/1.flac.bak/1.flac'), genre='Jazz' )
+      self.idx.update()
+      select = lambda *s: [os.path.relpath(f, self.base) for f in
+            self.idx.select(['genre=jazz'], [os.path.join(self.base, p)
+                                              for p in s])]
+      eq_( select('a'), ['a/1.flac', 'a/1.flac.bak/1.flac', 'a/2.flac'] )
+      eq_( select('a/'), ['a/1.flac', 'a/1.flac.bak/1.flac', 'a/2.flac'] )
+      eq_( select('a/1.flac'), ['a/1.flac'] )
+      eq_( select('a b'), ['a b/1.flac'] )
+
+   def test_incremental(self):
+      "Only new or changed files are read, and removed files are dropped."
+      path = os.path.join(self.base, 'a/2.flac')
+      _flac( path, genre='Blues' )
+      os.utime( path, (0,0) )
+      os.remove( os.path.join(self.base, 'b/1.flac') )
+      with patch.object( index, '_read_entry',
+                         wraps=index._read_entry ) as read:
+         eq_( self.idx.update(), (1,1) )
+      eq_( read.call_count, 1 )
+      eq_( self._select('genre=blues'), ['a/2.flac'] )
+      eq_( self._select(), ['a/1.flac', 'a/2.flac'] )
+
+   def test_persistent(self):
+      "The index is stored in the base directory."
+      self.idx.close()
+      self.idx = index.TagIndex( self.base )
+      eq_( self._select('rating<4'), ['a/2.flac'] )
+      eq_( self.idx.update(), (0,0) )
+
+   def test_parse_term(self):
+      "Invalid query terms are rejected."
+      eq_( index.parse_term('Year >= 1970'), ('date', '>=', 1970.0) )
+      assert_raises( ValueError, index.parse_term, 'genre' )
+      assert_raises( ValueError, index.parse_term, 'genre=' )
+      assert_raises( ValueError, index.parse_term, 'rating>x' )
@@ -19,6 +19,7 @@ class TestMainCmdArgs(unittest.TestCase):
    def setUp(self):
       self.f_enc_orig = flacsync.ENCODERS
       self.mock_aac_enc = Mock()
+      self.mock_aac_enc.return_value.dst = '/aac/file1.m4a'
       # mock encoder object dict object
       flacsync.ENCODERS = {'aac':self.mock_aac_enc}
 
@@ -55,3 +56,74 @@ class TestMainCmdArgs(unittest.TestCase):
       self.mock_aac_enc.return_value.skip_encode.assert_called()
       # file was skiped, so verify it was not called
       assert mock_pool.return_value.apply_async.called
+
+   @patch('os.remove')
+   @patch('flacsync.verify.verify')
+   @patch('multiprocessing.dummy.Pool')
+   @patch('flacsync.get_src_files')
+   def test_verify( self, mock_get_src_files, mock_pool, mock_verify,
+                    mock_remove):
+      "Remove damaged output files of up to date flac files, when verified."
+      enc = self.mock_aac_enc.return_value
+      enc.skip_encode.return_value = True
+      enc.is_stale.return_value = False
+      mock_get_src_files.return_value = iter(['file1.flac'])
+      mock_verify.side_effect = lambda jobs, threads: [(jobs[0], 'truncated')]
+      flacsync.main(argv=['--verify','/flac']) # <-- test function
+      eq_( [j.src for j in mock_verify.call_args[0][0]], ['file1.flac'] )
+      mock_remove.assert_called_with( '/aac/file1.m4a' )
+
+
+class TestDelOrphans(unittest.TestCase):
+
+   @patch('flacsync.orphan')
+   @patch('flacsync.get_dest_orphans')
+   def test_list( self, mock_orphans, mock_orphan):
+      "Orphans are only printed by the 'list' policy."
+      mock_orphans.return_value = iter(['/aac/a.m4a'])
+      eq_( flacsync.del_dest_orphans('/aac', '/flac', [], policy='list'), [] )
+      assert not mock_orphan.remove.called
+
+   @patch('flacsync.orphan')
+   @patch('flacsync.get_dest_orphans')
+   def test_delete( self, mock_orphans, mock_orphan):
+      "Orphans are removed without a prompt by the 'delete' policy."
+      mock_orphans.return_value = iter(['/aac/a.m4a'])
+      mock_orphan.remove.return_value = ['/aac/a.m4a']
+      flacsync.del_dest_orphans('/aac', '/flac', [], policy='delete')
+      eq_( list(mock_orphan.remove.call_args[0][0]), ['/aac/a.m4a'] )
+      mock_orphan.prune.assert_called_with( ['/aac/a.m4a'], '/aac' )
+
+   @patch('__builtin__.raw_input')
+   @patch('sys.stdin')
+   @patch('flacsync.orphan')
+   @patch('flacsync.get_dest_orphans')
+   def test_prompt( self, mock_orphans, mock_orphan, mock_stdin, mock_input):
+      "Orphans selected at the prompt are removed."
+      mock_stdin.isatty.return_value = True
+      mock_orphans.return_value = iter(['/aac/a', '/aac/b', '/aac/c'])
+      mock_input.side_effect = ['no', 'all']
+      flacsync.del_dest_orphans('/aac', '/flac', [], prune=False)
+      eq_( mock_orphan.remove.call_args[0][0], ['/aac/b', '/aac/c'] )
+      assert not mock_orphan.prune.called
+
+
+class TestSegments(unittest.TestCase):
+
+   def setUp(self):
+      opts = Mock( time_budget=None, throttle=False )
+      self.work = flacsync.WorkUnit( opts, 2 )
+      self.work.budget = self.work.throttle = self.work.prefetcher = None
+      self.job = Mock( src='/flac/a/01.flac' )
+      self.job.encoder.return_value.dst = '/mp3/a/01.mp3'
+
+   def test_abort(self):
+      "Segments of an aborted run are discarded, and not joined."
+      enc = self.job.encoder.return_value
+      with patch('sys.stdout'):
+         self.work.do_segment( self.job, 0, 2 )
+         self.work.abort = True
+         self.work.do_segment( self.job, 1, 2 )
+      eq_( enc.encode_segment.call_count, 1 )
+      enc.join_segments.assert_called_once_with( discard=True )
+      ok_( self.job.release.called )
@@ -0,0 +1,113 @@
+"""
+   Test module for job.py
+"""
+
+from __future__ import absolute_import
+
+import subprocess as sp
+import sys
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import cue
+from .. import job
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class DummyEncoder(object):
+   SEGMENTS = True
+
+   def __init__(self, src, base_dir, dest_dir):
+      self.src = src
+      self.dst = src.replace(base_dir, dest_dir).replace('.flac', '.m4a')
+      self.cover_data = None
+
+
+class TestJob(unittest.TestCase):
+
+   def setUp(self):
+      self.enc_class = Mock(side_effect=DummyEncoder, SEGMENTS=True)
+      self.plan = job.Plan( self.enc_class, base_dir='/flac',
+                            dest_dir='/aac' )
+
+   def test_paths(self):
+      "Paths are stored in a shared directory table."
+      a = self.plan.add( '/flac/x/01.flac' )
+      b = self.plan.add( '/flac/x/02.flac' )
+      eq_( (a.src, a.flac), ('/flac/x/01.flac', '/flac/x/01.flac') )
+      eq_( a.dir, b.dir )
+      eq_( self.enc_class.call_count, 0 )
+      eq_( a.dst, '/aac/x/01.m4a' )
+      eq_( b.dst, '/aac/x/02.m4a' )
+      eq_( self.plan.dirs, ['/flac/x', '/aac/x'] )
+      assert a.SEGMENTS
+      assert not hasattr( a, '__dict__' )
+
+   def test_track(self):
+      "Tracks of an image keep the track object."
+      track = cue.Track( '/flac/x/image.flac', 2, 1000, tags={'title':'B'} )
+      j = self.plan.add( cue.TrackPath(track) )
+      eq_( j.src, '/flac/x/02 - B.flac' )
+      eq_( j.src.track, track )
+      eq_( j.flac, '/flac/x/image.flac' )
+
+   def test_encoder(self):
+      "Encoder object is kept until the job is released."
+      j = self.plan.add( '/flac/x/01.flac' )
+      j.cover_data = 'jpeg'
+      eq_( j.encoder().cover_data, 'jpeg' )
+      eq_( self.enc_class.call_count, 1 )
+      j.release()
+      eq_( j.encoder().cover_data, None )
+
+   def test_split(self):
+      "Only the segments of a split are kept, for the job encoder object."
+      def create( src, **kwargs ):
+         enc = DummyEncoder( src, **kwargs )
+         enc.split = Mock( return_value=2 )
+         enc.segments = (100, 44100, [(0,50), (50,100)])
+         return enc
+      self.enc_class.side_effect = create
+      j = self.plan.add( '/flac/x/01.flac' )
+      eq_( j.split(600, 4), 2 )
+      eq_( j._encoder, None )
+      eq_( j.encoder().segments, (100, 44100, [(0,50), (50,100)]) )
+
+   def test_pending(self):
+      "Only jobs that are not up to date are selected."
+      skip = {'/flac/x/01.flac':True, '/flac/x/02.flac':False}
+      def create( src, **kwargs ):
+         enc = DummyEncoder( src, **kwargs )
+         enc.skip_encode = lambda: skip[src]
+         enc.settings_changed = lambda: True
+         return enc
+      self.enc_class.side_effect = create
+      jobs = [self.plan.add(f) for f in sorted(skip)]
+      eq_( [j.src for j in job.pending(jobs)], ['/flac/x/02.flac'] )
+      assert jobs[1].changed
+      eq_( len(list(job.pending(jobs, True))), 2 )
+      eq_( [j._encoder for j in jobs], [None, None] )
+
+
+class TestMemory(unittest.TestCase):
+
+   def test_job_size(self):
+      "Peak memory of 100k planned jobs stays below 400 bytes per job."
+      script = '\n'.join([
+         'import resource, sys',
+         'from flacsync import job',
+         'from flacsync.tests.test_job import DummyEncoder',
+         'def rss(): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+         'base = rss()',
+         "plan = job.Plan( DummyEncoder, base_dir='/flac', dest_dir='/aac' )",
+         "jobs = [plan.add('/flac/Artist %d/Album %d/%02d - Title.flac' % (",
+         '        i//100, i//10, i%10)) for i in range(100000)]',
+         'for j in jobs: j.dst',
+         'print (rss() - base) * 1024 // len(jobs)',
+         ])
+      out = sp.Popen( [sys.executable, '-c', script],
+                      stdout=sp.PIPE ).communicate()[0]
+      assert int(out) < 400, "%s bytes per job" % (out.strip(),)
@@ -0,0 +1,258 @@
+"""
+   Test module for lease.py
+"""
+
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import encoder
+from .. import get_albums
+from .. import job
+from .. import lease
+from .. import WorkUnit
+from .test_calls import Calls, TRACKS, _flac
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+JOBS = ['artist/album/%02d.m4a' % (i,) for i in range(20)]
+
+
+def _done_file( tmp, job ):
+   return os.path.join( tmp, job.replace('/','_') )
+
+
+def _queue( tmp, **kwargs ):
+   return lease.LeaseQueue( os.path.join(tmp,'leases'), JOBS, key=str,
+         is_done=lambda j: os.path.exists(_done_file(tmp,j)), **kwargs )
+
+
+def _worker( tmp ):
+   # stands in for a flacsync instance on another host
+   q = _queue( tmp, poll=0.01 )
+   q.start()
+   while True:
+      job = q.claim()
+      if job is None:
+         break
+      time.sleep( 0.01 )
+      with open(os.path.join(tmp,'log'), 'a') as fh:
+         fh.write( job + '\n' )
+      open( _done_file(tmp,job), 'w' ).close()
+      q.release( job )
+   q.stop()
+
+
+class TestLeaseQueue(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_processes(self):
+      "Jobs are completed exactly once by a group of processes."
+      procs = [multiprocessing.Process(target=_worker, args=(self.tmp,))
+                  for _ in range(4)]
+      for p in procs:
+         p.start()
+      for p in procs:
+         p.join()
+      with open(os.path.join(self.tmp,'log')) as fh:
+         done = fh.read().split()
+      eq_( sorted(done), JOBS )
+      eq_( os.listdir(os.path.join(self.tmp,'leases')), [] )
+
+   def test_expired(self):
+      "Reclaim the lease of a dead instance after it expires."
+      dead = _queue( self.tmp, expiry=60 )
+      eq_( dead.claim(), JOBS[0] )
+      q = _queue( self.tmp, expiry=60, poll=0.01 )
+      eq_( q.claim(), JOBS[1] )
+      path = dead._lease( JOBS[0] )
+      os.utime( path, (time.time()-120, time.time()-120) )
+      jobs = set( iter(q.claim, None) )
+      eq_( jobs, set(JOBS[2:] + JOBS[:1]) )
+
+   def test_reclaim_discard(self):
+      "The output of a reclaimed job is discarded, and done again."
+      dead = _queue( self.tmp, expiry=60 )
+      eq_( dead.claim(), JOBS[0] )
+      # a partial output, newer than the source
+      open( _done_file(self.tmp, JOBS[0]), 'w' ).close()
+      path = dead._lease( JOBS[0] )
+      os.utime( path, (time.time()-120, time.time()-120) )
+      discard = Mock()
+      q = _queue( self.tmp, expiry=60, discard=discard )
+      eq_( q.claim(), JOBS[0] )
+      discard.assert_called_once_with( JOBS[0] )
+      ok_( q.owns(JOBS[0]) )
+      with patch('sys.stdout'):
+         ok_( not dead.owns(JOBS[0]) )
+      eq_( dead.lost, [JOBS[0]] )
+
+   def test_unlocked_files(self):
+      "Lease files are not accessed while holding the queue lock."
+      q = _queue( self.tmp )
+      real_acquire = q._acquire
+      def acquire( job ):
+         ok_( not q._lock.locked() )
+         return real_acquire( job )
+      with patch.object(q, '_acquire', Mock(side_effect=acquire)), \
+           patch.object(q, '_owns', Mock(side_effect=lambda *a: \
+                                         not q._lock.locked())):
+         eq_( q.claim(), JOBS[0] )
+         ok_( q.owns(JOBS[0]) )
+         q.release( JOBS[0] )
+
+   def test_reclaim_race(self):
+      "An expired lease is replaced in place, by one instance at a time."
+      slow = _queue( self.tmp, expiry=60 )
+      eq_( slow.claim(), JOBS[0] )
+      path = slow._lease( JOBS[0] )
+      old = time.time() - 120
+      os.utime( path, (old, old) )
+      # another instance holds the reclaim lock
+      lock = path + '.reclaim'
+      open( lock, 'w' ).close()
+      q = _queue( self.tmp, expiry=60 )
+      eq_( q._acquire(JOBS[0]), None )
+      # the lease file exists during the whole reclaim
+      os.remove( lock )
+      real_rename = os.rename
+      def rename( src, dst ):
+         ok_( os.path.exists(path) )
+         real_rename( src, dst )
+         ok_( os.path.exists(path) )
+      with patch('os.rename', Mock(side_effect=rename)) as mock_rename, \
+           patch('os.remove', Mock(wraps=os.remove)) as mock_remove:
+         eq_( q.claim(), JOBS[0] )
+      eq_( mock_rename.call_args[0][1], path )
+      ok_( call(path) not in mock_remove.call_args_list )
+      # the slow instance is told, and does not release the new lease
+      with patch('sys.stdout'):
+         slow.expiry = 0.04
+         slow.start()
+         time.sleep( 0.1 )
+         slow.stop()
+      eq_( slow.lost, [JOBS[0]] )
+      ok_( os.path.exists(path) )
+      q.release( JOBS[0] )
+      eq_( os.listdir(os.path.join(self.tmp, 'leases')), [] )
+
+   def test_stale_reclaim_lock(self):
+      "The reclaim lock of a dead instance is removed after it expires."
+      dead = _queue( self.tmp, expiry=60 )
+      eq_( dead.claim(), JOBS[0] )
+      path = dead._lease( JOBS[0] )
+      old = time.time() - 120
+      os.utime( path, (old, old) )
+      open( path + '.reclaim', 'w' ).close()
+      os.utime( path + '.reclaim', (old, old) )
+      q = _queue( self.tmp, expiry=60 )
+      eq_( q._acquire(JOBS[0]), None )
+      eq_( q.claim(), JOBS[0] )
+
+   def test_wait_live(self):
+      "Wait for a live lease, and skip the job once it is completed."
+      other = _queue( self.tmp )
+      eq_( other.claim(), JOBS[0] )
+      for j in JOBS[1:]:
+         open( _done_file(self.tmp,j), 'w' ).close()
+      def finish():
+         time.sleep( 0.1 )
+         open( _done_file(self.tmp,JOBS[0]), 'w' ).close()
+         other.release( JOBS[0] )
+      threading.Thread( target=finish ).start()
+      q = _queue( self.tmp, poll=0.01 )
+      start = time.time()
+      eq_( q.claim(), None )
+      assert time.time() - start >= 0.1
+
+
+class TestLost(unittest.TestCase):
+
+   def test_lost(self):
+      "A job is stopped once its lease is lost, and its output kept."
+      opts = Mock( force=False, analyze_gain=False, max_rate=None,
+                   max_bits=None )
+      work = WorkUnit( opts, 1 )
+      work.budget = work.throttle = work.prefetcher = None
+      j = Mock( src='/flac/a/01.flac' )
+      enc = j.encoder.return_value
+      enc.dst = '/aac/a/01.m4a'
+      enc.encode.side_effect = ValueError( 'truncated' )
+      leases = Mock()
+      leases.claim.side_effect = [j, j, None]
+      leases.owns.side_effect = [False, True, False]
+      with patch('sys.stdout'), patch('os.remove') as mock_remove:
+         work.do_claimed( leases )
+      eq_( enc.encode.call_count, 1 )
+      ok_( not mock_remove.called )
+      eq_( leases.release.call_count, 2 )
+
+
+class TestCooperate(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.base = os.path.join( self.tmp, 'flac' )
+      self.dest = os.path.join( self.tmp, 'aac' )
+      src = os.path.join( self.base, 'album' )
+      os.makedirs( src )
+      self.flacs = []
+      for i in range(TRACKS):
+         path = os.path.join( src, '%02d.flac' % (i+1,) )
+         _flac( path, 'Track %d' % (i+1,) )
+         self.flacs.append( path )
+      open( os.path.join(src, 'cover.jpg'), 'w' ).close()
+      self.finished = set()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def _instance(self, order):
+      # stands in for a flacsync instance with --cooperate -j
+      plan = job.Plan( encoder.AacEncoder, aac_q='0.35', base_dir=self.base,
+                       dest_dir=self.dest )
+      jobs = [plan.add( self.flacs[i] ) for i in order]
+      opts = Mock( force=False, analyze_gain=False, max_rate=None,
+                   max_bits=None, art_resize=False, art_copy=True,
+                   cooperate=True )
+      work = WorkUnit( opts, len(jobs) )
+      work.albums = get_albums( jobs, opts )
+      work.listener = lambda e, ok: self.finished.add( e.src )
+      q = lease.LeaseQueue( os.path.join(self.dest, 'leases'), jobs,
+            key=lambda j: os.path.relpath(j.dst, self.dest),
+            is_done=lambda j: j.src in self.finished, poll=0.01 )
+      return work, q
+
+   def test_copy_cover(self):
+      "Cover art is copied when two instances share the tracks of an album."
+      half = TRACKS // 2
+      a,qa = self._instance( range(TRACKS) )
+      b,qb = self._instance( range(half, TRACKS) + range(half) )
+      with Calls(), patch('sys.stdout'):
+         held = [qb.claim() for _ in range(half)]
+         # a encodes the first half, then waits for the leases of b
+         thread = threading.Thread( target=a.do_claimed, args=(qa,) )
+         thread.start()
+         for j in held:
+            b.do_work( j )
+            qb.release( j )
+         b.do_claimed( qb )
+         thread.join( 10 )
+      eq_( self.finished, set(self.flacs) )
+      ok_( os.path.exists(os.path.join(self.dest, 'album', 'cover.jpg')) )
+      eq_( [j for j in qa._pending + qb._pending], [] )
@@ -0,0 +1,88 @@
+"""
+   Test module for ledger.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import ledger
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestLedger(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.base = os.path.join(self.tmp, 'flac')
+      self.dest = os.path.join(self.tmp, 'aac')
+      os.makedirs( self.base )
+      self.src = os.path.join(self.base, 'a.flac')
+      with open(self.src, 'wb') as fh:
+         fh.write( 'x' * 100 )
+      self.enc = Mock(src=self.src, flac=self.src, track=None)
+      self.now = [1000.0]
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def _ledger(self):
+      return ledger.Ledger( self.base, self.dest, clock=lambda: self.now[0] )
+
+   def test_backoff(self):
+      "Skip a failed file until the retry delay expires, doubled each time."
+      led = self._ledger()
+      assert not led.skip( self.enc )
+      led.record( self.enc, 'encode', 'bad frame' )
+      assert led.skip( self.enc )
+      self.now[0] += ledger.BACKOFF
+      assert not led.skip( self.enc )
+      led.record( self.enc, 'encode', 'bad frame' )
+      self.now[0] += ledger.BACKOFF
+      assert led.skip( self.enc )
+      self.now[0] += ledger.BACKOFF
+      assert not led.skip( self.enc )
+      entry = led.entries['a.flac']
+      eq_( (entry['count'], entry['stage'], entry['error']),
+           (2, 'encode', 'bad frame') )
+
+   def test_source_changed(self):
+      "Retry a failed file at once when the source file changes."
+      led = self._ledger()
+      led.record( self.enc, 'tag' )
+      with open(self.src, 'ab') as fh:
+         fh.write( 'y' )
+      assert not led.skip( self.enc )
+      led.record( self.enc, 'tag' )
+      eq_( led.entries['a.flac']['count'], 1 )
+
+   def test_clear(self):
+      "A successful file is removed from the ledger."
+      led = self._ledger()
+      led.record( self.enc, 'cover' )
+      led.save()
+      led = self._ledger()
+      assert led.skip( self.enc )
+      led.clear( self.enc )
+      led.save()
+      eq_( self._ledger().entries, {} )
+
+   def test_save_merge(self):
+      "Saved changes are merged with entries written by another instance."
+      other = Mock(src=os.path.join(self.base, 'b.flac'), flac=self.src,
+                   track=None)
+      led1 = self._ledger()
+      led2 = self._ledger()
+      led1.record( self.enc, 'encode' )
+      led2.record( other, 'encode' )
+      led1.save()
+      led2.save()
+      eq_( sorted(self._ledger().entries), ['a.flac', 'b.flac'] )
+      eq_( led2.failed, 1 )
@@ -0,0 +1,61 @@
+"""
+   Test module for loudness.py
+"""
+
+from __future__ import absolute_import
+
+import unittest
+import numpy as np
+from nose.tools import *
+from mock import *
+
+from .. import loudness
+from .. import pcm
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _sine( amp, rate=44100, secs=3 ):
+   t = np.arange(rate*secs) / float(rate)
+   s = amp * np.sin(2*np.pi*997*t)
+   return np.column_stack( (s,s) )
+
+
+def _analyze( samples, rate=44100, chunk=10000 ):
+   L = loudness.Loudness()
+   L.start( pcm.WavFormat(2, rate, 2) )
+   for i in range(0, len(samples), chunk):
+      L.feed( samples[i:i+chunk] )
+   return L
+
+
+class TestLoudness(unittest.TestCase):
+
+   def test_sine_level(self):
+      "A full scale 997Hz stereo sine measures 0 LUFS."
+      L = _analyze( _sine(1.0) )
+      assert abs(L.gain - loudness.REFERENCE) < 0.05, L.gain
+      eq_( L.peak, 1.0 )
+
+   def test_chunking(self):
+      "Results do not depend on the size of the sample blocks."
+      samples = _sine(0.5)
+      eq_( round(_analyze(samples, chunk=1000).gain, 6),
+           round(_analyze(samples, chunk=65536).gain, 6) )
+
+   def test_silence(self):
+      "Silent tracks have no gain value."
+      L = _analyze( np.zeros((44100,2)) )
+      eq_( L.gain, None )
+
+   def test_album_gain(self):
+      "Album values are returned once all tracks are added."
+      album = loudness.AlbumGain( {'dir':2} )
+      loud,quiet = _analyze(_sine(1.0)), _analyze(_sine(0.5))
+      eq_( album.add('dir', 't1', loud), None )
+      tracks,gain,peak = album.add('dir', 't2', quiet)
+      eq_( tracks, ['t1','t2'] )
+      eq_( peak, 1.0 )
+      assert loud.gain < gain < quiet.gain
+      eq_( album.add('other', 't3', loud), None )
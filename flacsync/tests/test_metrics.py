@@ -0,0 +1,154 @@
+"""
+   Test module for metrics.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import urllib2
+from nose.tools import *
+from mock import *
+
+from .. import album
+from .. import encoder
+from .. import metrics
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _samples( text ):
+   # map of sample name (with labels) to value
+   return dict( l.rsplit(' ', 1) for l in text.splitlines()
+                if l and not l.startswith('#') )
+
+
+class TestMetrics(unittest.TestCase):
+
+   def setUp(self):
+      self.metrics = metrics.Metrics( 'aac' )
+
+   def test_render(self):
+      "Counters are named by their samples in the Prometheus text format."
+      self.metrics.count( 'files', 3, result='skipped' )
+      text = self.metrics.render()
+      ok_( '# TYPE flacsync_files counter' in text )
+      ok_( text.endswith('# EOF\n') )
+      samples = _samples( text )
+      eq_( samples['flacsync_files_total{encoder="aac",result="skipped"}'],
+           '3' )
+      eq_( samples['flacsync_queue_depth'], '0' )
+      text = self.metrics.render( openmetrics=False )
+      ok_( '# TYPE flacsync_files_total counter' in text )
+      ok_( '# EOF' not in text )
+
+   def test_stage(self):
+      "Files in a step are in flight, and finished steps are observed."
+      enc = Mock()
+      with patch('time.time', return_value=100.0):
+         self.metrics.stage( enc, 'encode' )
+      samples = _samples( self.metrics.render() )
+      eq_( samples['flacsync_in_flight{stage="encode"}'], '1' )
+      with patch('time.time', return_value=103.0):
+         self.metrics.stage( enc, 'tag' )
+      samples = _samples( self.metrics.render() )
+      eq_( samples['flacsync_in_flight{stage="encode"}'], '0' )
+      eq_( samples['flacsync_in_flight{stage="tag"}'], '1' )
+      bucket = 'flacsync_stage_seconds_bucket{le="%s",stage="encode"}'
+      eq_( samples[bucket % ('2.5',)], '0' )
+      eq_( samples[bucket % ('5.0',)], '1' )
+      eq_( samples[bucket % ('+Inf',)], '1' )
+      eq_( samples['flacsync_stage_seconds_sum{stage="encode"}'], '3.0' )
+      eq_( samples['flacsync_stage_seconds_count{stage="encode"}'], '1' )
+
+   def test_finished(self):
+      "Finished files are counted by result, with the size of the outputs."
+      tmp = tempfile.mkdtemp()
+      try:
+         enc = Mock( dst=os.path.join(tmp, 'a.m4a') )
+         with open(enc.dst, 'wb') as fh:
+            fh.write( 'm4a' )
+         self.metrics.stage( enc, 'cover' )
+         with patch.object(metrics, 'audio_seconds', return_value=2.5):
+            self.metrics.finished( enc, True, True )
+            self.metrics.finished( Mock(), False, True )
+            self.metrics.finished( Mock(), True, False )
+      finally:
+         shutil.rmtree( tmp )
+      samples = _samples( self.metrics.render() )
+      files = 'flacsync_files_total{encoder="aac",result="%s"}'
+      eq_( samples[files % ('encoded',)], '1' )
+      eq_( samples[files % ('updated',)], '1' )
+      eq_( samples[files % ('failed',)], '1' )
+      eq_( samples['flacsync_audio_seconds_total{encoder="aac"}'], '2.5' )
+      eq_( samples['flacsync_written_bytes_total{encoder="aac"}'], '3' )
+      eq_( samples['flacsync_in_flight{stage="cover"}'], '0' )
+
+   def test_covers(self):
+      "The hit ratio of the cover cache is only published with a cache."
+      ok_( 'cover_cache' not in self.metrics.render() )
+      self.metrics.covers = album.CoverCache()
+      self.metrics.covers.hits = 3
+      self.metrics.covers.misses = 1
+      samples = _samples( self.metrics.render() )
+      eq_( samples['flacsync_cover_cache_hit_ratio'], '0.75' )
+
+   def test_spawns(self):
+      "Process launches of the encoders are counted."
+      count = encoder.spawns()
+      with patch('subprocess.call', return_value=0):
+         encoder._call( 'true', shell=True )
+      eq_( encoder.spawns(), count + 1 )
+      samples = _samples( self.metrics.render() )
+      eq_( samples['flacsync_spawns_total'], str(count + 1) )
+
+
+class TestExporter(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.metrics = metrics.Metrics( 'ogg' )
+      self.metrics.count( 'files', result='encoded' )
+
+   def tearDown(self):
+      shutil.rmtree( self.tmp )
+
+   def test_file(self):
+      "The metrics file is replaced, in the Prometheus text format."
+      path = os.path.join( self.tmp, 'flacsync.prom' )
+      exporter = metrics.Exporter( self.metrics, path=path, interval=60 )
+      exporter.start()
+      self.metrics.count( 'files', result='encoded' )
+      exporter.stop()
+      with open(path) as fh:
+         text = fh.read()
+      files = 'flacsync_files_total{encoder="ogg",result="encoded"}'
+      eq_( _samples(text)[files], '2' )
+      ok_( '# EOF' not in text )
+      eq_( os.listdir(self.tmp), ['flacsync.prom'] )
+
+   def test_http(self):
+      "The metrics are served on localhost, in the negotiated format."
+      sock = socket.socket()
+      sock.bind( ('127.0.0.1', 0) )
+      port = sock.getsockname()[1]
+      sock.close()
+      exporter = metrics.Exporter( self.metrics, port=port )
+      exporter.start()
+      try:
+         url = 'http://127.0.0.1:%d/metrics' % (port,)
+         req = urllib2.Request( url,
+               headers={'Accept':'application/openmetrics-text'} )
+         resp = urllib2.urlopen( req, timeout=5 )
+         eq_( resp.info()['Content-Type'], metrics.OPENMETRICS )
+         ok_( resp.read().endswith('# EOF\n') )
+         resp = urllib2.urlopen( url, timeout=5 )
+         eq_( resp.info()['Content-Type'], metrics.PROMETHEUS )
+         assert_raises( urllib2.HTTPError, urllib2.urlopen, url + 'x',
+                        timeout=5 )
+      finally:
+         exporter.stop()
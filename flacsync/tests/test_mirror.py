@@ -0,0 +1,93 @@
+"""
+   Test module for mirror.py
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import encoder
+from .. import mirror
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestLinkOrCopy(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.src = os.path.join(self.tmp, 'a.m4a')
+      with open(self.src, 'wb') as fh:
+         fh.write( 'x' * 1000 )
+      os.utime( self.src, (1000, 1000) )
+      self.dst = os.path.join(self.tmp, 'm/b/a.m4a')
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_link(self):
+      "Files on the same file system are hard linked."
+      eq_( mirror.link_or_copy(self.src, self.dst), 'link' )
+      eq_( os.stat(self.dst).st_ino, os.stat(self.src).st_ino )
+
+   @patch('os.link')
+   def test_copy(self, mock_link):
+      "Files are copied across file systems, keeping the mtime."
+      mock_link.side_effect = OSError(errno.EXDEV, 'cross-device link')
+      assert mirror.link_or_copy(self.src, self.dst) in ('reflink', 'copy')
+      with open(self.dst, 'rb') as fh:
+         eq_( fh.read(), 'x' * 1000 )
+      eq_( os.path.getmtime(self.dst), 1000 )
+      eq_( os.listdir(os.path.dirname(self.dst)), ['a.m4a'] )
+
+   @patch('shutil.copyfileobj')
+   @patch('os.link')
+   def test_failed(self, mock_link, mock_copy):
+      "A failed copy leaves no partial file."
+      mock_link.side_effect = OSError(errno.EXDEV, 'cross-device link')
+      mock_copy.side_effect = IOError(errno.ENOSPC, 'no space')
+      with patch('fcntl.ioctl', side_effect=IOError):
+         assert_raises( IOError, mirror.link_or_copy, self.src, self.dst )
+      eq_( os.listdir(os.path.dirname(self.dst)), [] )
+
+
+class TestDeliver(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.base = os.path.join(self.tmp, 'flac')
+      os.makedirs( os.path.join(self.base, 'album') )
+      self.src = os.path.join(self.base, 'album/1.flac')
+      open(self.src, 'w').close()
+      os.utime( self.src, (1000, 1000) )
+      self.mirrors = [os.path.join(self.tmp, 'm1'),
+                      os.path.join(self.tmp, 'm2')]
+      self.e = encoder._Encoder( src=self.src, ext='.m4a', base_dir=self.base,
+            dest_dir=os.path.join(self.tmp, 'aac'), mirrors=self.mirrors )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_deliver(self):
+      "Outputs are delivered to each missing or older mirror file."
+      eq_( self.e.deliver(), 0 )    # no output
+      self.e._pre_encode()
+      open(self.e.dst, 'w').close()
+      assert not self.e.skip_encode()
+      eq_( self.e.deliver(), 2 )
+      assert self.e.skip_encode()
+      eq_( self.e.deliver(), 0 )
+      # re-encode does not modify the hard linked mirror files
+      self.e._pre_encode()
+      with open(self.e.dst, 'w') as fh:
+         fh.write('new')
+      eq_( os.path.getsize(os.path.join(self.tmp, 'm1/album/1.m4a')), 0 )
+      eq_( self.e.deliver(), 2 )
+      eq_( os.path.getsize(os.path.join(self.tmp, 'm2/album/1.m4a')), 3 )
@@ -0,0 +1,72 @@
+"""
+   Test module for mp3.py
+"""
+
+from __future__ import absolute_import
+
+import struct
+import unittest
+from StringIO import StringIO
+from nose.tools import *
+from mock import *
+
+from .. import mp3
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+# MPEG-1 Layer III, 128kbps, 44.1kHz, stereo: 417 byte frames
+HEADER = '\xff\xfb\x90\x00'
+SIZE = 417
+
+
+def _frame( tag ):
+   return HEADER + tag * (SIZE-4)
+
+
+def _info_frame():
+   tag = ('Xing' + struct.pack('>III', 0xf, 0, 0) + '\x00'*104 +
+          'LAME3.100' + '\x00'*12 + struct.pack('>I', 576 << 12)[1:] +
+          '\x00'*12)
+   data = HEADER + '\x00'*32 + tag
+   return data + '\x00'*(SIZE-len(data))
+
+
+class TestJoin(unittest.TestCase):
+
+   def _join(self):
+      seg1 = _info_frame() + ''.join( _frame(c) for c in 'abcdef' )
+      seg2 = ''.join( _frame(c) for c in 'ghijkl' )
+      out = StringIO()
+      # keep a-c from the first, and j-l from the second segment
+      mp3.join( out, [(seg1,0,3),(seg2,3,None)], 6*1152 - 576 - 100 )
+      return out.getvalue()
+
+   def test_frames(self):
+      "Selected frames of all segments are joined after the info frame."
+      data = self._join()
+      walk = list( mp3.frames(data) )
+      eq_( len(walk), 7 )
+      eq_( ''.join(data[pos+4] for pos,_ in walk[1:]), 'abcjkl' )
+
+   def test_info_frame(self):
+      "Info frame is updated with the values of the joined stream."
+      data = self._join()
+      t = mp3.info_tag( data, 0, mp3.Frame(data[:4]) )
+      eq_( struct.unpack('>II', data[t+8:t+16]), (6, 7*SIZE) )
+      eq_( ord(data[t+16]), 256*SIZE // (7*SIZE) )
+      delay_pad, = struct.unpack('>I', '\x00' + data[t+141:t+144])
+      eq_( (delay_pad >> 12, delay_pad & 0xfff), (576, 100) )
+      crc, = struct.unpack('>H', data[t+154:t+156])
+      eq_( crc, mp3.crc16(data[:t+154]) )
+
+   def test_missing_frames(self):
+      "Segments with too few frames are rejected."
+      seg1 = _info_frame() + _frame('a')
+      assert_raises( ValueError, mp3.join, StringIO(), [(seg1,0,2)], 1 )
+
+   def test_empty_id3v2(self):
+      "Empty ID3v2 tag has a valid size."
+      tag = mp3.empty_id3v2()
+      eq_( mp3.id3v2_size(tag), len(tag) )
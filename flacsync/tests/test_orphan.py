@@ -0,0 +1,51 @@
+"""
+   Test module for orphan.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import orphan
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestOrphan(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.files = []
+      for d in ('a/x', 'a/y', 'b'):
+         os.makedirs( os.path.join(self.tmp, d) )
+         path = os.path.join( self.tmp, d, '01.m4a' )
+         open(path, 'w').close()
+         self.files.append( path )
+      os.makedirs( os.path.join(self.tmp, 'empty') )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def test_remove(self):
+      "Files are removed in batches."
+      with patch.object( orphan, 'BATCH', 2 ):
+         eq_( sorted(orphan.remove(self.files, 2)), sorted(self.files) )
+      assert not any( os.path.exists(f) for f in self.files )
+
+   def test_trash(self):
+      "Files are moved to the trash directory."
+      trash = os.path.join( self.tmp, 'trash' )
+      eq_( orphan.remove(self.files[:1], 1, self.tmp, trash), self.files[:1] )
+      assert os.path.exists( os.path.join(trash, 'a/x/01.m4a') )
+
+   def test_prune(self):
+      "Only the empty parent dirs of removed files are removed."
+      orphan.remove( self.files[:2] )
+      eq_( orphan.prune(self.files[:2], self.tmp), 3 )
+      eq_( sorted(os.listdir(self.tmp)), ['b', 'empty'] )
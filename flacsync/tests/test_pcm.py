@@ -0,0 +1,58 @@
+"""
+   Test module for pcm.py
+"""
+
+from __future__ import absolute_import
+
+import struct
+import unittest
+from StringIO import StringIO
+from nose.tools import *
+from mock import *
+
+from .. import pcm
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _wav( data, channels=2, rate=44100, width=2 ):
+   fmt = struct.pack('<HHIIHH', 1, channels, rate, rate*channels*width,
+                     channels*width, width*8)
+   body = 'WAVE' + 'fmt ' + struct.pack('<I',len(fmt)) + fmt + \
+          'data' + struct.pack('<I',len(data)) + data
+   return 'RIFF' + struct.pack('<I',len(body)) + body
+
+
+class TestPipe(unittest.TestCase):
+
+   def test_header(self):
+      "WAV format is read from the stream header."
+      fmt,raw = pcm.read_wav_header( StringIO(_wav('', 6, 96000, 3)) )
+      eq_( (fmt.channels,fmt.rate,fmt.width), (6,96000,3) )
+      eq_( len(raw), 44 )
+
+   def test_not_wav(self):
+      "Non-WAV streams are rejected."
+      assert_raises( ValueError, pcm.read_wav_header, StringIO('x'*44) )
+
+   def test_24bit(self):
+      "24-bit samples are converted to float."
+      data = '\xff\xff\x7f' + '\x00\x00\x80'
+      a = pcm.to_float( data, pcm.WavFormat(1, 44100, 3) )
+      eq_( a.shape, (2,1) )
+      assert abs(a[0,0] - 1.0) < 1e-6
+      eq_( a[1,0], -1.0 )
+
+   def test_pipe(self):
+      "Stream is copied unchanged, and all frames are passed to taps."
+      data = struct.pack('<6h', 1, 2, 3, 4, 5, 6)
+      wav = _wav( data )
+      tap = Mock()
+      out = StringIO()
+      with patch('flacsync.pcm.BUFSIZE', 5):
+         pcm.pipe( StringIO(wav), out, [tap] )
+      eq_( out.getvalue(), wav )
+      eq_( tap.start.call_args[0][0].channels, 2 )
+      frames = sum( len(c[0][0]) for c in tap.feed.call_args_list )
+      eq_( frames, 3 )
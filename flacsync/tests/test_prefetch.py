@@ -0,0 +1,85 @@
+"""
+   Test module for prefetch.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import prefetch
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestPrefetcher(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.paths = []
+      for i in range(6):
+         path = os.path.join(self.tmp, '%02d.flac' % (i,))
+         with open(path, 'wb') as fh:
+            fh.write( 'x' * 1000 )
+         self.paths.append( path )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def _wait_ready(self, pf, count):
+      for _ in range(500):
+         with pf._cond:
+            if pf._state.values().count('ready') == count:
+               return
+         time.sleep( 0.01 )
+
+   def test_depth(self):
+      "Read ahead at most 'depth' unused files, in job order."
+      pf = prefetch.Prefetcher( self.paths, 2, 1<<20 )
+      pf.start()
+      self._wait_ready( pf, 2 )
+      eq_( sorted(pf._ahead), self.paths[:2] )
+      for p in self.paths:
+         pf.acquire( p )
+      pf.stop()
+      eq_( pf.misses + pf.hits, 6 )
+      assert pf.hits >= 2
+
+   def test_max_bytes(self):
+      "Limit the size of unused files, but always read one file."
+      pf = prefetch.Prefetcher( self.paths, 4, 1500 )
+      pf.start()
+      self._wait_ready( pf, 1 )
+      time.sleep( 0.05 )
+      eq_( pf._ahead.keys(), self.paths[:1] )
+      pf.stop()
+
+   def test_miss(self):
+      "Files used before they are read are not read again."
+      pf = prefetch.Prefetcher( self.paths[:2] + self.paths[:1], 1, 1<<20 )
+      pf.acquire( self.paths[1] )
+      pf.start()
+      pf.acquire( self.paths[0] )
+      pf.stop()
+      eq_( pf.misses + pf.hits, 2 )
+      eq_( pf._ahead, {} )
+
+   def test_stall(self):
+      "Wait for a file being read, and report the stall time."
+      pf = prefetch.Prefetcher( self.paths, 1, 1<<20 )
+      def slow_read( path ):
+         time.sleep( 0.1 )
+      with patch.object( pf, '_read', side_effect=slow_read ):
+         pf.start()
+         time.sleep( 0.02 )
+         pf.acquire( self.paths[0] )
+      pf.stop()
+      eq_( pf.hits, 1 )
+      assert pf.stall >= 0.05
+      assert pf.report().startswith( 'prefetch: 1 hits, 0 misses' )
@@ -0,0 +1,68 @@
+"""
+   Test module for registry.py
+"""
+
+from __future__ import absolute_import
+
+import subprocess as sp
+import sys
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import registry
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class DummyEncoder(object):
+   pass
+
+
+class TestRegistry(unittest.TestCase):
+
+   def setUp(self):
+      self.reg = registry.Registry(
+            {'dummy':'flacsync.tests.test_registry:DummyEncoder'} )
+
+   @patch('importlib.import_module')
+   def test_lazy(self, mock_import):
+      "Encoder modules are imported on the first lookup of their name."
+      mock_import.return_value = sys.modules[__name__]
+      eq_( self.reg.keys(), ['dummy'] )
+      eq_( mock_import.call_count, 0 )
+      eq_( self.reg['dummy'], DummyEncoder )
+      eq_( self.reg['dummy'], DummyEncoder )
+      eq_( mock_import.call_count, 1 )
+
+   def test_register(self):
+      "Encoder classes and names may be registered at run-time."
+      self.reg.register( 'other', DummyEncoder )
+      eq_( self.reg['other'], DummyEncoder )
+      self.reg.register( 'broken', 'flacsync.no_such_module:Encoder' )
+      assert 'broken' not in self.reg
+
+   @patch('pkg_resources.iter_entry_points')
+   def test_entry_point(self, mock_iter):
+      "Unknown names are looked up in the entry points."
+      ep = Mock()
+      ep.load.return_value = DummyEncoder
+      mock_iter.side_effect = lambda group, name: [ep] if name == 'ep' else []
+      assert 'dummy' in self.reg
+      eq_( mock_iter.call_count, 0 )
+      eq_( self.reg['ep'], DummyEncoder )
+      mock_iter.assert_called_with( registry.ENTRY_POINTS, 'ep' )
+      assert 'missing' not in self.reg
+
+
+class TestStartup(unittest.TestCase):
+
+   def test_import(self):
+      "Importing flacsync does not import any heavy dependency."
+      heavy = ['numpy', 'PIL', 'Image', 'mutagen', 'pkg_resources']
+      out = sp.Popen( [sys.executable, '-c',
+            'import sys, flacsync; print " ".join(sorted(set('
+            'm.split(".")[0] for m in sys.modules)))'],
+            stdout=sp.PIPE ).communicate()[0]
+      eq_( [m for m in heavy if m in out.split()], [] )
@@ -0,0 +1,66 @@
+"""
+   Test module for resample.py
+"""
+
+from __future__ import absolute_import
+
+import unittest
+import numpy as np
+from nose.tools import *
+from mock import *
+
+from .. import pcm
+from .. import resample
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _convert( samples, rate, chunk, max_rate=48000, max_bits=16 ):
+   c = resample.Converter( max_rate, max_bits )
+   fmt = c.start( pcm.WavFormat(2, rate, 3, len(samples)) )
+   out = []
+   for i in range(0, len(samples), chunk):
+      out.append( c.quantize(c.process(samples[i:i+chunk])) )
+   out.append( c.quantize(c.flush()) )
+   return fmt, ''.join(out)
+
+
+class TestResample(unittest.TestCase):
+
+   def setUp(self):
+      t = np.arange(96000) / 96000.0
+      s = 0.5 * np.sin(2*np.pi*1000*t)
+      self.samples = np.column_stack( (s,s) )
+
+   def test_target_rate(self):
+      "Output rates keep a simple ratio to the source rate."
+      eq_( resample.target_rate(192000, 48000), 48000 )
+      eq_( resample.target_rate(176400, 48000), 44100 )
+      eq_( resample.target_rate(96000, 44100), 44100 )
+
+   def test_no_conversion(self):
+      "No conversion is done for streams within the limits."
+      c = resample.Converter( 48000, 16 )
+      eq_( c.start(pcm.WavFormat(2, 44100, 2)), None )
+
+   def test_length(self):
+      "Output length matches the header of the converted stream."
+      fmt,data = _convert( self.samples, 96000, 10000 )
+      eq_( (fmt.rate,fmt.width,fmt.frames), (48000,2,48000) )
+      eq_( len(data), fmt.frames * fmt.block_align )
+
+   def test_deterministic(self):
+      "Output is identical across runs and read sizes."
+      _,data1 = _convert( self.samples, 96000, 10000 )
+      _,data2 = _convert( self.samples, 96000, 10000 )
+      _,data3 = _convert( self.samples, 96000, 777 )
+      eq_( data1, data2 )
+      eq_( data1, data3 )
+
+   def test_signal(self):
+      "Resampled signal matches the source signal."
+      fmt,data = _convert( self.samples, 96000, 10000, max_bits=24 )
+      y = pcm.to_float( data, fmt )[:,0]
+      ref = 0.5 * np.sin(2*np.pi*1000*np.arange(len(y))/48000.0)
+      assert np.abs(y - ref)[100:-100].max() < 1e-3
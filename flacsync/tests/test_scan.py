@@ -0,0 +1,84 @@
+"""
+   Test module for scan.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import scan
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestScanCache(unittest.TestCase):
+
+   def setUp(self):
+      self.base = tempfile.mkdtemp()
+      self.album = os.path.join(self.base, 'artist', 'album')
+      os.makedirs(self.album)
+      for f in ('01.flac','02.flac','cover.jpg'):
+         open(os.path.join(self.album,f),'w').close()
+      self.path = os.path.join(self.base, 'state', 'scan.json')
+
+   def tearDown(self):
+      shutil.rmtree(self.base)
+
+   def _walk(self, deep_every=0):
+      cache = scan.ScanCache( self.path, deep_every )
+      result = dict((r,c) for r,d,f,c in cache.walk(self.album))
+      return cache, result[self.album]
+
+   def test_first_run_not_clean(self):
+      "Directories are listed when no cache exists."
+      cache,clean = self._walk()
+      eq_( clean, False )
+
+   def test_unchanged_dir_is_clean(self):
+      "Unchanged directories are not listed on the next run."
+      cache,clean = self._walk()
+      cache.save()
+      with patch('os.listdir') as mock_listdir:
+         cache,clean = self._walk()
+         assert not mock_listdir.called
+      eq_( clean, True )
+
+   def test_invalidated_dir_not_clean(self):
+      "Directories with pending work are not clean on the next run."
+      cache,clean = self._walk()
+      cache.invalidate( self.album )
+      cache.save()
+      cache,clean = self._walk()
+      eq_( clean, False )
+
+   def test_cover_change_not_clean(self):
+      "A modified cover file forces a directory to be listed."
+      cache,clean = self._walk()
+      cache.save()
+      cover = os.path.join(self.album,'cover.jpg')
+      os.utime( cover, (0,0) )
+      cache,clean = self._walk()
+      eq_( clean, False )
+
+   def test_deep_scan(self):
+      "Every Nth run lists all directories."
+      for i in range(3):
+         cache,clean = self._walk(deep_every=2)
+         eq_( clean, i%2 == 1 )
+         cache.save()
+
+   def test_commit(self):
+      "Committed directories are clean for the next walk of the same cache."
+      cache,clean = self._walk()
+      list( cache.walk(self.album) )
+      cache.commit()
+      eq_( [c for r,d,f,c in cache.walk(self.album)], [True] )
+      cache.invalidate( self.album )
+      cache.commit()
+      eq_( [c for r,d,f,c in cache.walk(self.album)], [False] )
@@ -0,0 +1,134 @@
+"""
+   Test module for service.py
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import service
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _events( client ):
+   return [json.loads(l) for l in client.getvalue().splitlines()]
+
+
+class TestService(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.path = os.path.join(self.tmp, 'flacsync.sock')
+      self.plans = {}
+      self.service = service.Service( self.path, 1, self.plan )
+
+   def tearDown(self):
+      if self.service._server:
+         self.service.stop()
+      shutil.rmtree(self.tmp)
+
+   def plan(self, request):
+      if request.sources == ['bad']:
+         raise ValueError( "'bad' is not a valid path" )
+      jobs = self.plans.get( request.sources[0], [] )
+      if callable(jobs):
+         jobs = jobs( request )
+      request.files = len(jobs)
+      return Mock(), jobs
+
+   def test_coalesce(self):
+      "Identical queued requests are joined, at the higher priority."
+      a,b = StringIO.StringIO(), StringIO.StringIO()
+      r1 = self.service.submit( ['/flac/x'], 'background', client=a )
+      r2 = self.service.submit( ['/flac/x'], 'interactive', client=b )
+      r3 = self.service.submit( ['/flac/y'] )
+      assert r1 is r2
+      assert r1 is not r3
+      eq_( r1.priority, 'interactive' )
+      eq_( _events(b), [{'event':'queued', 'id':1, 'priority':'interactive',
+                         'coalesced':True}] )
+      r1.emit( 'start', files=0 )
+      eq_( _events(a)[-1], {'event':'start', 'id':1, 'files':0} )
+
+   def test_priority(self):
+      "Interactive jobs are started before the background backlog."
+      order = []
+      gate = threading.Event()
+      started = threading.Event()
+      def job( name ):
+         started.set()
+         gate.wait()
+         order.append( name )
+      self.plans['/flac/bg'] = [(job, ('bg%d' % (i,),)) for i in range(3)]
+      self.plans['/flac/new'] = [(job, ('new',))]
+      self.service.start()
+      bg = self.service.submit( ['/flac/bg'], 'background' )
+      started.wait( 5 )
+      new = self.service.submit( ['/flac/new'] )
+      # wait until the interactive jobs are queued
+      for _ in range(500):
+         if new.work: break
+         threading.Event().wait( 0.01 )
+      gate.set()
+      ok_( bg.finished.wait(5) )
+      ok_( new.finished.wait(5) )
+      eq_( order, ['bg0', 'new', 'bg1', 'bg2'] )
+
+   def test_submit(self):
+      "Clients receive the progress events of a request."
+      encoder = Mock( src='/flac/a/1.flac', dst='/aac/a/1.m4a' )
+      self.plans['/flac/a'] = lambda r: [(r.file_done, (encoder, True))]
+      self.service.start()
+      events = list( service.submit(self.path, ['/flac/a']) )
+      eq_( [e['event'] for e in events], ['queued', 'start', 'file', 'done'] )
+      eq_( events[2]['src'], '/flac/a/1.flac' )
+      eq_( (events[3]['encoded'], events[3]['failed']), (1, 0) )
+
+   def test_invalid(self):
+      "Invalid requests are reported to the client."
+      self.service.start()
+      events = list( service.submit(self.path, ['bad']) )
+      eq_( [e['event'] for e in events], ['queued', 'error'] )
+      events = list( service.submit(self.path, [], priority='urgent') )
+      eq_( [e['event'] for e in events], ['error'] )
+
+   def test_plan_error(self):
+      "An unexpected error of a request does not stop the service."
+      def fail( request ):
+         raise AssertionError( "source file removed" )
+      self.plans['/flac/gone'] = fail
+      self.service.start()
+      with patch('sys.stdout'):
+         events = list( service.submit(self.path, ['/flac/gone']) )
+      eq_( [e['event'] for e in events], ['queued', 'error'] )
+      eq_( events[-1]['message'], 'source file removed' )
+      events = list( service.submit(self.path, ['/flac/other']) )
+      eq_( [e['event'] for e in events], ['queued', 'start', 'done'] )
+
+   def test_running(self):
+      "A second service can not use the socket of a running service."
+      self.service.start()
+      other = service.Service( self.path, 1, self.plan )
+      assert_raises( ValueError, other.start )
+      ok_( os.path.exists(self.path) )
+
+   def test_stale_socket(self):
+      "The socket of a killed service is replaced."
+      self.service.start()
+      self.service._server.shutdown()
+      self.service._server.server_close()
+      self.service._server = None
+      other = service.Service( self.path, 1, self.plan )
+      other.start()
+      other.stop()
+      ok_( not os.path.exists(self.path) )
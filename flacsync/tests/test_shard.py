@@ -0,0 +1,69 @@
+"""
+   Test module for shard.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import shard
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+class TestShard(unittest.TestCase):
+
+   def test_parse(self):
+      "Parse i/N shard specifications."
+      s = shard.parse( '2/3' )
+      eq_( (s.index, s.count), (2, 3) )
+      eq_( str(s), '2/3' )
+      assert_raises( ValueError, shard.parse, '0/3' )
+      assert_raises( ValueError, shard.parse, '4/3' )
+      assert_raises( ValueError, shard.parse, '2' )
+
+   def test_partition(self):
+      "Every file is selected by exactly one shard, by album directory."
+      files = ['/flac/artist%d/album%d/%02d.flac' % (a,b,t)
+                  for a in range(5) for b in range(4) for t in range(3)]
+      shards = [shard.Shard(i,3) for i in (1,2,3)]
+      slices = [list(s.select('/flac', files)) for s in shards]
+      eq_( sorted(sum(slices, [])), sorted(files) )
+      assert all( slices )
+      for slice_ in slices:
+         dirs = set( os.path.dirname(f) for f in slice_ )
+         eq_( len(slice_), 3*len(dirs) )
+      # stable across base directories
+      moved = [f.replace('/flac', '/mnt/aac', 1) for f in slices[0]]
+      eq_( list(shards[0].select('/mnt/aac', moved)), moved )
+
+
+class TestMerge(unittest.TestCase):
+
+   def setUp(self):
+      self.dest = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.dest)
+
+   def test_missing(self):
+      "Report shards without a manifest, and remove all manifests."
+      eq_( shard.merge(self.dest), [] )
+      shard.Shard(1,3).write_manifest( self.dest, 10 )
+      shard.Shard(3,3).write_manifest( self.dest, 0 )
+      eq_( map(str, shard.merge(self.dest)), ['2/3'] )
+      eq_( shard.merge(self.dest), [] )
+
+   def test_latest_partition(self):
+      "Ignore manifests of an older partition."
+      shard.Shard(1,3).write_manifest( self.dest, 1 )
+      with patch('time.time', return_value=1e10):
+         shard.Shard(1,2).write_manifest( self.dest, 1 )
+         shard.Shard(2,2).write_manifest( self.dest, 1 )
+      eq_( shard.merge(self.dest), [] )
@@ -0,0 +1,98 @@
+"""
+   Test module for steps.py
+"""
+
+from __future__ import absolute_import
+
+import threading
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import steps
+from .. import WorkUnit
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+TAGS = {'title':'A', 'artist':'B'}
+
+
+class TestEngine(unittest.TestCase):
+
+   def setUp(self):
+      self.engine = steps.Engine( dict.fromkeys(steps.CLASSES, 1), 2 )
+      self.enc = Mock( flac='/flac/a/01.flac', cover='/flac/a/cover.jpg',
+                       cover_data=None )
+      self.enc.thumbnail_data.return_value = 'jpeg'
+
+   def tearDown(self):
+      self.engine.close()
+
+   def test_prepare(self):
+      "Source tags are read, and the cover thumbnail is prepared."
+      with patch('flacsync.decoder.FlacDecoder') as mock_dec:
+         mock_dec.return_value.tags = TAGS
+         eq_( self.engine.prepare(self.enc, True).get(), TAGS )
+      mock_dec.assert_called_once_with( '/flac/a/01.flac' )
+      self.enc.thumbnail_data.assert_called_once_with( True )
+      eq_( self.enc.cover_data, 'jpeg' )
+
+   def test_album_cover(self):
+      "The thumbnail of the album, or a failed thumbnail, is not replaced."
+      self.enc.cover_data = 'album'
+      with patch('flacsync.decoder.FlacDecoder'):
+         self.engine.prepare( self.enc ).get()
+      eq_( self.enc.cover_data, 'album' )
+      self.enc.cover_data = None
+      self.enc.thumbnail_data.side_effect = IOError( 'not an image' )
+      with patch('flacsync.decoder.FlacDecoder') as mock_dec:
+         mock_dec.return_value.tags = TAGS
+         eq_( self.engine.prepare(self.enc).get(), TAGS )
+      eq_( self.enc.cover_data, None )
+
+   def test_slots(self):
+      "Steps of a class are limited by its semaphore."
+      with self.engine.slot( 'encode' ):
+         ok_( not self.engine.slot('encode').acquire(False) )
+         ok_( self.engine.slot('tag').acquire(False) )
+         self.engine.slot('tag').release()
+      ok_( self.engine.slot('encode').acquire(False) )
+      self.engine.slot('encode').release()
+
+
+class TestWorkUnit(unittest.TestCase):
+
+   def test_concurrent(self):
+      "Source tags are read while the file is encoded."
+      opts = Mock( force=False, analyze_gain=False, max_rate=None,
+                   max_bits=None, art_resize=False, art_copy=False )
+      work = WorkUnit( opts, 1 )
+      work.budget = work.throttle = work.prefetcher = None
+      work.steps = steps.Engine( dict.fromkeys(steps.CLASSES, 1), 1 )
+      j = Mock( src='/flac/a/01.flac' )
+      enc = j.encoder.return_value
+      enc.configure_mock( flac=j.src, dst='/aac/a/01.m4a', cover=None,
+                          track=None, fingerprints=None )
+      encoding = threading.Event()
+      read = threading.Event()
+      def tags():
+         ok_( encoding.wait(5) )
+         read.set()
+         return TAGS
+      def encode( *args ):
+         encoding.set()
+         ok_( read.wait(5) )
+         # the encoder slot is held during the encode step
+         ok_( not work.steps.slot('encode').acquire(False) )
+         return True
+      enc.encode.side_effect = encode
+      with patch('flacsync.decoder.FlacDecoder') as mock_dec, \
+           patch('flacsync.budget.job_size', return_value=0), \
+           patch('sys.stdout'):
+         type(mock_dec.return_value).tags = PropertyMock( side_effect=tags )
+         work.do_work( j )
+      work.steps.close()
+      enc.tag.assert_called_once_with( TAGS )
+      ok_( enc.set_cover.called )
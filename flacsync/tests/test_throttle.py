@@ -0,0 +1,101 @@
+"""
+   Test module for throttle.py
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+import unittest
+from io import BytesIO
+from nose.tools import *
+from mock import *
+
+from .. import throttle
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+IDLE = {'load':0.5, 'cpu':1.0, 'io':0.0, 'free':4096, 'children':0}
+
+
+class TestThrottle(unittest.TestCase):
+
+   def test_update(self):
+      "Remove a slot per sample over a limit, add one when under all limits."
+      t = throttle.Throttle( 3, 2.0, 20.0, 512 )
+      t.update( dict(IDLE, io=35.0) )
+      eq_( t.allowed, 0 )  # no running jobs
+      t.update( IDLE )
+      t.update( IDLE )
+      eq_( t.allowed, 2 )
+      t.acquire()
+      t.update( dict(IDLE, free=100) )
+      eq_( t.allowed, 0 )
+      # running jobs (and their processes) are not counted in the load
+      t.update( dict(IDLE, load=4.9, children=2) )
+      eq_( t.allowed, 1 )
+      t.update( dict(IDLE, load=5.1, children=2) )
+      eq_( t.allowed, 0 )
+
+   def test_own_load(self):
+      "The load of the running jobs alone does not reduce the slots."
+      cores = 4
+      t = throttle.Throttle( cores, float(cores), 20.0, 512 )
+      for _ in range(cores):
+         t.acquire()
+      # each job is a decoder and encoder pipeline, and a worker thread
+      busy = dict( IDLE, load=3.0*cores, children=2*cores )
+      t.update( busy )
+      eq_( t.allowed, cores )
+      # the same, if the child processes can not be counted
+      t.update( dict(busy, children=None) )
+      eq_( t.allowed, cores )
+      t.update( dict(busy, load=busy['load'] + cores + 0.5) )
+      eq_( t.allowed, cores - 1 )
+
+   def test_read_child_count(self):
+      "Descendant processes are counted from the process table."
+      stats = {'1':'1 (init) S 0', '10':'10 (flac sync) S 1',
+               '11':'11 (flac) R 10', '12':'12 (sh) S 10',
+               '13':'13 (lame) R 12', '20':'20 (other) R 1'}
+      def fake_open( path ):
+         return BytesIO( stats[path.split('/')[2]] )
+      with patch('os.listdir', return_value=stats.keys() + ['self']), \
+           patch('__builtin__.open', Mock(side_effect=fake_open)):
+         eq_( throttle.read_child_count(10), 3 )
+         eq_( throttle.read_child_count(13), 0 )
+      with patch('os.listdir', Mock(side_effect=OSError)):
+         eq_( throttle.read_child_count(), None )
+
+   def test_missing_psi(self):
+      "Pressure values that are not available are ignored."
+      t = throttle.Throttle( 2, 2.0, 20.0, 512 )
+      t.allowed = 1
+      t.update( dict(IDLE, cpu=None, io=None, free=None) )
+      eq_( t.allowed, 2 )
+
+   def test_pause(self):
+      "Jobs wait while no slot is allowed, and the wait time is reported."
+      t = throttle.Throttle( 2, 2.0, 20.0, 512 )
+      t.allowed = 0
+      started = []
+      job = threading.Thread( target=lambda: started.append(t.acquire()) )
+      job.start()
+      time.sleep( 0.05 )
+      eq_( started, [] )
+      t.update( IDLE )
+      job.join()
+      eq_( len(started), 1 )
+      assert t.throttled >= 0.04
+      assert t.report().startswith( 'background:' )
+
+   def test_read_pressure(self):
+      "Parse the 'some' average of a PSI file."
+      data = ('some avg10=12.50 avg60=2.87 avg300=3.04 total=57590210\n'
+              'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+      with patch('__builtin__.open', return_value=BytesIO(data)):
+         eq_( throttle.read_pressure('io'), 12.5 )
+      with patch('__builtin__.open', side_effect=IOError):
+         eq_( throttle.read_pressure('io'), None )
@@ -4,6 +4,10 @@
 
 from __future__ import absolute_import
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from nose.tools import *
 from mock import *
@@ -40,3 +44,53 @@ class TestUtil(unittest.TestCase):
       eq_( val, False )
 
 
+
+   def test_disk_location(self):
+      "Files are located by disk offset, or inode number."
+      st = os.stat( __file__ )
+      loc = util.disk_location( __file__ )
+      eq_( loc[0], st.st_dev )
+      assert loc[1:] == (1, st.st_ino) or loc[1] == 0
+      with patch( 'fcntl.ioctl', side_effect=IOError(25, 'not supported') ):
+         eq_( util.disk_location(__file__), (st.st_dev, 1, st.st_ino) )
+
+   def test_save_json(self):
+      "JSON files are replaced, with no temporary file left behind."
+      tmp = tempfile.mkdtemp()
+      try:
+         path = os.path.join( tmp, 'state', 'a.json' )
+         util.save_json( path, {'a':1} )
+         util.save_json( path, {'b':2}, indent=1 )
+         with open(path) as fh:
+            eq_( json.load(fh), {'b':2} )
+         with patch( 'json.dump', side_effect=ValueError ):
+            assert_raises( ValueError, util.save_json, path, {'c':3} )
+         eq_( os.listdir(os.path.dirname(path)), ['a.json'] )
+      finally:
+         shutil.rmtree( tmp )
+
+   def test_merge(self):
+      "Changes replace or remove entries, others are kept."
+      entries = {'a':1, 'b':2, 'c':3}
+      eq_( util.merge(entries, {'a':4, 'b':None, 'd':5, 'e':None}),
+           {'a':4, 'c':3, 'd':5} )
+
+
+class TestLazyModule(unittest.TestCase):
+   def test_lazy(self):
+      "Modules are imported on first use, trying each name."
+      with patch( 'importlib.import_module' ) as mock_import:
+         mock_import.side_effect = [ImportError, Mock(value=1)]
+         m = util.LazyModule( 'missing', 'present' )
+         eq_( mock_import.call_count, 0 )
+         eq_( m.value, 1 )
+         eq_( m.value, 1 )
+         eq_( [c[0][0] for c in mock_import.call_args_list],
+              ['missing', 'present'] )
+
+   def test_importable(self):
+      "Missing optional modules are detected."
+      assert util.importable( util.LazyModule('json') )
+      assert not util.importable( util.LazyModule('no_such_module') )
+      assert_raises( ImportError, getattr,
+                     util.LazyModule('no_such_module'), 'x' )
@@ -0,0 +1,154 @@
+"""
+   Test module for verify.py
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from nose.tools import *
+from mock import *
+
+from .. import verify
+from .test_mp3 import _frame, _info_frame, SIZE
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+def _atom( kind, data ):
+   return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def _mp4( seconds, scale=1000 ):
+   mvhd = _atom( 'mvhd', '\x00'*12 + struct.pack('>II', scale,
+                 int(seconds*scale)) + '\x00'*80 )
+   return (_atom('ftyp', 'M4A \x00\x00\x00\x00') + _atom('moov', mvhd) +
+           _atom('mdat', 'x'*1000))
+
+
+def _page( kind, granule, body ):
+   lacing = chr(255)*(len(body)//255) + chr(len(body) % 255)
+   page = ('OggS\x00' + struct.pack('<BqIII', kind, granule, 1, 0, 0) +
+           chr(len(lacing)) + lacing + body)
+   crc = struct.pack('<I', verify.ogg_crc(page))
+   return page[:22] + crc + page[26:]
+
+
+def _ogg( samples, rate=44100 ):
+   ident = '\x01vorbis' + struct.pack('<IBI', 0, 2, rate) + '\x00'*14
+   return (_page(0x02, 0, ident) + _page(0, 1000, 'x'*5000) +
+           _page(0x04, samples, 'y'*300))
+
+
+def _mp3( count ):
+   return _info_frame() + ''.join( _frame('a') for _ in range(count) )
+
+
+class TestDuration(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   def _file(self, name, data):
+      path = os.path.join(self.tmp, name)
+      with open(path, 'wb') as fh:
+         fh.write( data )
+      return path
+
+   def test_mp4(self):
+      "MP4 duration is read from the movie header."
+      eq_( verify.duration(self._file('a.m4a', _mp4(12.5))), 12.5 )
+
+   def test_mp4_truncated(self):
+      "Truncated MP4 atoms are detected."
+      path = self._file('a.m4a', _mp4(12.5)[:-1])
+      assert_raises( ValueError, verify.duration, path )
+
+   def test_ogg(self):
+      "Ogg duration is read from the granule of the last page."
+      eq_( verify.duration(self._file('a.ogg', _ogg(441000))), 10.0 )
+
+   def test_ogg_crc(self):
+      "Ogg checksum matches the bitwise definition."
+      crc = 0
+      for c in 'OggS page data':
+         crc ^= ord(c) << 24
+         for _ in range(8):
+            crc = ((crc << 1) ^ (0x04c11db7 if crc & (1<<31) else 0))
+            crc &= 0xffffffff
+      eq_( verify.ogg_crc('OggS page data'), crc )
+
+   def test_ogg_truncated(self):
+      "Ogg files without the final page, or a damaged page, are detected."
+      data = _ogg(441000)
+      path = self._file('a.ogg', data[:-1])
+      assert_raises( ValueError, verify.duration, path )
+      path = self._file('b.ogg', data[:-360])
+      assert_raises( ValueError, verify.duration, path )
+      path = self._file('c.ogg', data[:-2] + 'z' + data[-1])
+      assert_raises( ValueError, verify.duration, path )
+
+   def test_mp3(self):
+      "MP3 duration is read from the LAME info frame."
+      data = _mp3( 6 )
+      t = 4 + 32
+      data = (data[:t+4] + struct.pack('>III', 0xf, 6, len(data)) +
+              data[t+16:])
+      path = self._file('a.mp3', data)
+      eq_( verify.duration(path), (6*1152 - 576) / 44100.0 )
+      path = self._file('b.mp3', data[:-SIZE])
+      assert_raises( ValueError, verify.duration, path )
+
+   def test_mp3_walk(self):
+      "MP3 streams without frame counts are walked frame by frame."
+      path = self._file('a.mp3', _mp3(6) + 'TAG' + '\x00'*125)
+      eq_( verify.duration(path), 6*1152 / 44100.0 )
+      path = self._file('b.mp3', _mp3(6)[:-1])
+      assert_raises( ValueError, verify.duration, path )
+
+
+class TestCheck(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+      self.enc = Mock(track=None, flac='a.flac',
+                      dst=os.path.join(self.tmp, 'a.m4a'))
+      with open(self.enc.dst, 'wb') as fh:
+         fh.write( _mp4(10.0) )
+
+   def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+   @patch('flacsync.decoder.FlacDecoder')
+   def test_check(self, mock_dec):
+      "Output duration is compared to the source length."
+      mock_dec.return_value.info = Mock(samples=441000, rate=44100)
+      eq_( verify.check(self.enc), None )
+      mock_dec.return_value.info = Mock(samples=882000, rate=44100)
+      eq_( verify.check(self.enc), "duration is 10.0s, expected 20.0s" )
+
+   @patch('flacsync.decoder.FlacDecoder')
+   def test_track(self, mock_dec):
+      "Output of an image track is compared to the track length."
+      mock_dec.return_value.info = Mock(samples=882000, rate=44100)
+      self.enc.track = Mock(start=441000, end=None)
+      eq_( verify.check(self.enc), None )
+
+   @patch('flacsync.decoder.FlacDecoder')
+   def test_verify(self, mock_dec):
+      "Only damaged outputs are returned."
+      mock_dec.return_value.info = Mock(samples=441000, rate=44100)
+      bad = Mock(track=None, flac='b.flac',
+                 dst=os.path.join(self.tmp, 'b.m4a'))
+      with open(bad.dst, 'wb') as fh:
+         fh.write( _mp4(10.0)[:-10] )
+      other = Mock(dst='c.opus')
+      eq_( verify.verify([self.enc, bad, other], 2),
+           [(bad, "truncated MP4 'mdat' atom")] )
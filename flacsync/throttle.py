@@ -0,0 +1,247 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.throttle
+   ~~~~~~~~~~~~~~~~~
+
+   Define a background mode, for running flacsync next to other services.
+
+   The process (and all encoder child processes) run at idle CPU and I/O
+   priority. A monitor thread samples the system load average, the Linux
+   pressure stall information (PSI) of CPU and I/O, and the free memory,
+   and adjusts the number of worker slots allowed to start a new job.
+
+   The load of the running jobs is not counted against the load limit:
+   each job is a pipeline of child processes (i.e. ``flac -d | lame``), so
+   the child processes of flacsync, and its worker threads, are subtracted
+   from the load average.
+
+   .. note::
+
+      PSI requires Linux 4.20 or newer; on other systems only the load
+      average and free memory (Linux only) are used.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+import time
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Delay (in seconds) between samples of the system state.
+INTERVAL = 5.0
+
+#: Child processes of a job (the decoder and the encoder), when the child
+#: processes can not be counted.
+JOB_PROCESSES = 2
+
+# ioprio_set(2) syscall numbers, and arguments for the idle class
+_IOPRIO_SET = {'x86_64':251, 'i386':289, 'i686':289, 'aarch64':30,
+               'armv7l':314}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_IDLE = 3 << 13
+
+
+def set_idle_priority():
+   """
+   Lower the CPU and I/O priority of the current process to idle. Child
+   processes, and threads created later, inherit the priority.
+
+   :returns: :data:`True` if the I/O priority was changed.
+   """
+   os.nice( 19 - os.nice(0) )
+   nr = _IOPRIO_SET.get( platform.machine() )
+   if nr is None or not ctypes.util.find_library('c'):
+      return False
+   libc = ctypes.CDLL( ctypes.util.find_library('c'), use_errno=True )
+   return libc.syscall( nr, _IOPRIO_WHO_PROCESS, 0, _IOPRIO_IDLE ) == 0
+
+
+def read_pressure( name ):
+   """
+   :returns: PSI 'some' 10 second average (percent) of a resource ('cpu',
+             'io' or 'memory'), or :data:`None` if not available.
+   """
+   try:
+      with open('/proc/pressure/' + name) as fh:
+         for line in fh:
+            fields = line.split()
+            if fields and fields[0] == 'some':
+               return float( dict(f.split('=') for f in fields[1:])['avg10'] )
+   except (IOError, ValueError, KeyError):
+      pass
+   return None
+
+
+def read_free_mem():
+   """
+   :returns: Available memory in MB, or :data:`None` if not available.
+   """
+   try:
+      with open('/proc/meminfo') as fh:
+         for line in fh:
+            if line.startswith('MemAvailable:'):
+               return int(line.split()[1]) // 1024
+   except (IOError, ValueError):
+      pass
+   return None
+
+
+def read_child_count( pid=None ):
+   """
+   :returns: Number of descendant processes of a process (default: the
+             current process), or :data:`None` if not available.
+   """
+   pid = pid or os.getpid()
+   try:
+      pids = [p for p in os.listdir('/proc') if p.isdigit()]
+   except OSError:
+      return None
+   children = {}
+   for p in pids:
+      try:
+         with open('/proc/%s/stat' % (p,)) as fh:
+            data = fh.read()
+         # the fields after the command name, which may contain spaces
+         ppid = int( data[data.rindex(')')+2:].split()[1] )
+      except (IOError, ValueError, IndexError):
+         continue   # i.e. the process exited
+      children.setdefault( ppid, [] ).append( int(p) )
+   count = 0
+   stack = [pid]
+   while stack:
+      found = children.get( stack.pop(), [] )
+      count += len(found)
+      stack.extend( found )
+   return count
+
+
+def sample():
+   """
+   :returns: Dictionary of the current system state, with keys ``load``,
+             ``cpu``, ``io``, ``free`` and ``children`` (see
+             :func:`read_child_count`). Values that are not available are
+             :data:`None`.
+   """
+   return {'load':os.getloadavg()[0], 'cpu':read_pressure('cpu'),
+           'io':read_pressure('io'), 'free':read_free_mem(),
+           'children':read_child_count()}
+
+
+#############################################################################
+class Throttle( object ):
+   """
+   Gate of the worker slots allowed to run a job, adjusted to the system
+   state by a monitor thread.
+   """
+   def __init__( self, slots, max_load, max_pressure, min_free,
+                 interval=INTERVAL, sampler=sample ):
+      """
+      :param slots:  Number of worker slots (threads).
+      :type  slots:  int
+
+      :param max_load: Max load average, not counting the running jobs
+                       (their child processes and worker threads).
+      :type  max_load: float
+
+      :param max_pressure: Max CPU and I/O pressure, in percent.
+      :type  max_pressure: float
+
+      :param min_free: Min available memory, in MB.
+      :type  min_free: int
+
+      :param interval: Delay between samples, in seconds.
+      :type  interval: float
+
+      :param sampler: Function returning the system state, see
+                      :func:`sample`.
+      :type  sampler: function
+      """
+      self.slots = slots
+      self.max_load = max_load
+      self.max_pressure = max_pressure
+      self.min_free = min_free
+      self.interval = interval
+      #: Number of slots currently allowed to run jobs.
+      self.allowed = slots
+      #: Total time (in seconds) jobs waited for a slot.
+      self.throttled = 0.0
+      self._sampler = sampler
+      self._running = 0
+      self._cond = threading.Condition()
+      self._stop = threading.Event()
+      self._thread = None
+
+   def start( self ):
+      """Start the monitor thread."""
+      self._thread = threading.Thread( target=self._monitor )
+      self._thread.daemon = True
+      self._thread.start()
+
+   def stop( self ):
+      """Stop the monitor thread, and release all waiting jobs."""
+      self._stop.set()
+      if self._thread:
+         self._thread.join()
+      with self._cond:
+         self.allowed = self.slots
+         self._cond.notify_all()
+
+   def acquire( self ):
+      """Wait for a slot to run a job."""
+      with self._cond:
+         start = time.time()
+         waited = False
+         while self._running >= self.allowed:
+            waited = True
+            self._cond.wait()
+         if waited:
+            self.throttled += time.time() - start
+         self._running += 1
+
+   def release( self ):
+      """Release the slot of a completed job."""
+      with self._cond:
+         self._running -= 1
+         self._cond.notify_all()
+
+   def update( self, state ):
+      """
+      Adjust the allowed slots to a system state. One slot is removed while
+      a limit is exceeded, and one slot is added while all values are within
+      limits.
+
+      :param state: System state, see :func:`sample`.
+      :type  state: dict
+      """
+      with self._cond:
+         children = state.get( 'children' )
+         if children is None:
+            children = self._running * JOB_PROCESSES
+         own = children + self._running
+         over = (state['load'] - own > self.max_load or
+                 (state['cpu'] or 0) > self.max_pressure or
+                 (state['io'] or 0) > self.max_pressure or
+                 (state['free'] is not None and state['free'] < self.min_free))
+         if over:
+            self.allowed = max( 0, min(self.allowed, self._running) - 1 )
+         elif self.allowed < self.slots:
+            self.allowed += 1
+            self._cond.notify_all()
+
+   def report( self ):
+      """:returns: Summary string of the throttle statistics."""
+      return 'background: %.1fs throttled' % (self.throttled,)
+
+   def _monitor( self ):
+      while not self._stop.wait( self.interval ):
+         self.update( self._sampler() )
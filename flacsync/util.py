@@ -11,11 +11,22 @@
    Define shared utility functions.
 """
 
+import fcntl
+import importlib
+import json
 import os
+import struct
+import thread
 
 __author__ = 'Patrick C. McGinty'
 __email__ = 'flacsync@tuxcoder.com'
 
+#: Name of the flacsync state directory, located in the destination root.
+STATE_DIR = '.flacsync'
+
+# Linux ioctl to map the extents of a file, _IOWR('f', 11, struct fiemap)
+_FIEMAP = 0xc020660b
+
 
 def fname( file_, base=None, new_base=None, new_ext=None ):
    """
@@ -52,3 +63,110 @@ def newer( f1, f2 ):
    return (not os.path.exists(f2) or
          os.path.getmtime(f1) > os.path.getmtime(f2))
 
+
+
+def disk_location( path ):
+   """
+   :returns: Sort key of the physical location of a file: a tuple of the
+             device, and the disk offset of the first extent (from the Linux
+             FIEMAP ioctl) or the inode number, if the extents are unknown.
+   """
+   st = os.stat( path )
+   # struct fiemap of one extent (header 32 bytes, extent 56 bytes)
+   request = struct.pack('=QQIIII', 0, 2**64-1, 0, 0, 1, 0) + '\0'*56
+   try:
+      fd = os.open( path, os.O_RDONLY )
+      try:
+         result = fcntl.ioctl( fd, _FIEMAP, request )
+      finally:
+         os.close( fd )
+      mapped, = struct.unpack('=I', result[20:24])
+      if mapped:
+         physical, = struct.unpack('=Q', result[40:48])
+         return (st.st_dev, 0, physical)
+   except (IOError, OSError):
+      pass  # not supported by the file system
+   return (st.st_dev, 1, st.st_ino)
+
+
+def save_json( path, data, **kwargs ):
+   """
+   Write a JSON file, creating its directory if missing. The data is written
+   to a temporary file (unique to the process and thread), that is renamed
+   over :data:`path`, so readers never see a partial file.
+
+   :param kwargs: Keyword arguments of :func:`json.dump`.
+   """
+   try:
+      os.makedirs( os.path.dirname(path) )
+   except OSError: pass  # ignore if dir already exists
+   tmp = '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+   try:
+      with open(tmp, 'w') as fh:
+         json.dump( data, fh, **kwargs )
+      os.rename( tmp, path )
+   finally:
+      if os.path.exists( tmp ):
+         os.remove( tmp )
+
+
+def merge( entries, changes ):
+   """
+   Apply the changes of a run to a dictionary of entries, i.e. read from
+   a state file that is shared by several instances. A change of
+   :data:`None` removes the entry.
+
+   :returns: The updated :data:`entries`.
+   """
+   for key,entry in changes.items():
+      if entry is None:
+         entries.pop( key, None )
+      else:
+         entries[key] = entry
+   return entries
+
+
+#############################################################################
+class LazyModule( object ):
+   """
+   Proxy of an optional (or slow to import) module, that is imported on the
+   first attribute access. Keeps heavy dependencies out of the start-up
+   time, when they are not used by a run.
+
+   :raises: :exc:`ImportError` on attribute access, if no module name can be
+            imported.
+   """
+   def __init__( self, *names ):
+      """
+      :param names: Module names to try, in preferential order.
+      :type  names: str
+      """
+      self._lazy_names = names
+      self._lazy_module = None
+
+   def _lazy_load( self ):
+      if self._lazy_module is None:
+         for name in self._lazy_names:
+            try:
+               self._lazy_module = importlib.import_module( name )
+               break
+            except ImportError:
+               pass
+         else:
+            raise ImportError( "No module named %s" % (self._lazy_names[0],) )
+      return self._lazy_module
+
+   def __getattr__( self, attr ):
+      return getattr( self._lazy_load(), attr )
+
+
+def importable( module ):
+   """
+   :returns: :data:`True` if a :class:`LazyModule` (or module) can be used.
+   """
+   if isinstance( module, LazyModule ):
+      try:
+         module._lazy_load()
+      except ImportError:
+         return False
+   return module is not None
@@ -0,0 +1,288 @@
+#  Copyright (c) 2011, Patrick C. McGinty
+#
+#  This program is free software: you can redistribute it and/or modify it
+#  under the terms of the Simplified BSD License.
+#
+#  See LICENSE text for more details.
+"""
+   flacsync.verify
+   ~~~~~~~~~~~~~~~
+
+   Define a structural check of the output files, to find files that were
+   truncated or damaged by a failed or interrupted run, without decoding
+   the audio.
+
+   Only the container structure is read:
+
+   * MP4 (``.m4a``): the top-level atoms must fill the file, and the duration
+     is read from the ``mvhd`` atom.
+   * Ogg (``.ogg``): the first and last pages must have a valid CRC, the
+     last page must end the stream, and the duration is read from its
+     granule position.
+   * MP3 (``.mp3``): the duration and stream size are read from the
+     Xing/LAME info frame; a stream without one is walked frame by frame.
+
+   The duration of the output is compared to the sample count of the source
+   STREAMINFO block. Outputs of other formats are not checked.
+"""
+
+import multiprocessing.dummy as mp
+import os
+import struct
+import zlib
+
+from . import decoder
+from . import mp3
+
+__author__ = 'Patrick C. McGinty'
+__email__ = 'flacsync@tuxcoder.com'
+
+
+#: Max difference of the output and source duration, in seconds.
+TOLERANCE = 0.5
+
+# bytes read from the start and end of a file, enough for the first and
+# last Ogg page (max 65307 bytes)
+_CHUNK = 1 << 16
+
+# reverse the bit order of each byte, for the Ogg CRC
+_REVERSE = ''.join( chr(int('{0:08b}'.format(i)[::-1], 2))
+                    for i in range(256) )
+
+
+def check( encoder, tolerance=TOLERANCE ):
+   """
+   Check the output file of an encoder object.
+
+   :param encoder:   Encoder object, with an existing output file.
+   :type  encoder:   :class:`~flacsync.encoder._Encoder`
+
+   :param tolerance: Max difference of the output and source duration.
+   :type  tolerance: float
+
+   :returns: Description of the problem, or :data:`None` if the output is
+             valid (or its format is not supported).
+   """
+   ext = os.path.splitext( encoder.dst )[1].lower()
+   if ext not in DURATIONS:
+      return None
+   try:
+      actual = duration( encoder.dst )
+   except ValueError as exc:
+      return str(exc)
+   except (IOError, OSError) as exc:
+      return "not readable: %s" % (exc,)
+   try:
+      info = decoder.FlacDecoder( encoder.flac ).info
+   except (IOError, ValueError):
+      return None   # source problems are reported by the encoder
+   samples = info.samples
+   track = encoder.track
+   if track:
+      samples = (track.end or samples) - track.start
+   if not (samples and info.rate):
+      return None   # unknown length
+   expected = float(samples) / info.rate
+   if abs(actual - expected) > tolerance:
+      return "duration is %.1fs, expected %.1fs" % (actual, expected)
+   return None
+
+
+def verify( encoders, threads=1, tolerance=TOLERANCE ):
+   """
+   Check the output files of encoder objects in parallel, see :func:`check`.
+
+   :param encoders:  Encoder objects, with existing output files.
+   :type  encoders:  list
+
+   :param threads:   Number of threads reading files.
+   :type  threads:   int
+
+   :returns: List of (encoder, problem) tuples of the invalid outputs.
+   """
+   pool = mp.Pool( processes=threads )
+   try:
+      results = pool.imap( lambda e: check(e, tolerance), encoders, 16 )
+      return [(e,r) for e,r in zip(encoders, results) if r]
+   finally:
+      pool.close()
+      pool.join()
+
+
+def duration( path ):
+   """
+   :returns: Duration of an output file in seconds, read from the container.
+   :raises: :exc:`ValueError` if the file is damaged, or the format is not
+            supported.
+   """
+   ext = os.path.splitext( path )[1].lower()
+   if ext not in DURATIONS:
+      raise ValueError( "unsupported format '%s'" % (ext,) )
+   with open(path, 'rb') as fh:
+      return DURATIONS[ext]( fh, os.fstat(fh.fileno()).st_size )
+
+
+def mp4_duration( fh, size ):
+   """
+   :returns: Duration of an MP4 file in seconds.
+   :raises: :exc:`ValueError` if an atom is truncated, or the ``moov`` or
+            ``mdat`` atom is missing.
+   """
+   atoms = dict( _atoms(fh, 0, size) )
+   if 'mdat' not in atoms:
+      raise ValueError( "no 'mdat' atom" )
+   if 'moov' not in atoms:
+      raise ValueError( "no 'moov' atom" )
+   start,end = atoms['moov']
+   children = dict( _atoms(fh, start, end) )
+   if 'mvhd' not in children:
+      raise ValueError( "no 'mvhd' atom" )
+   start,end = children['mvhd']
+   fh.seek( start )
+   data = fh.read( min(end-start, 32) )
+   if data[:1] == '\x01':
+      scale,length = struct.unpack('>IQ', data[20:32])
+   else:
+      scale,length = struct.unpack('>II', data[12:20])
+   if not scale:
+      raise ValueError( "invalid 'mvhd' time scale" )
+   return float(length) / scale
+
+
+def _atoms( fh, pos, end ):
+   # generate the (type, (start, end)) of the atoms in a byte range, where
+   # start is the position after the atom header
+   while pos < end:
+      fh.seek( pos )
+      header = fh.read( 8 )
+      if len(header) < 8 or pos + 8 > end:
+         raise ValueError( "truncated MP4 atom header at %d" % (pos,) )
+      length,kind = struct.unpack('>I4s', header)
+      start = pos + 8
+      if length == 1:
+         ext = fh.read( 8 )
+         if len(ext) < 8:
+            raise ValueError( "truncated MP4 atom header at %d" % (pos,) )
+         length, = struct.unpack('>Q', ext)
+         start += 8
+      elif length == 0:
+         length = end - pos   # atom extends to the end of the file
+      if length < start - pos or pos + length > end:
+         raise ValueError( "truncated MP4 '%s' atom" % (kind,) )
+      yield kind, (start, pos + length)
+      pos += length
+
+
+def ogg_duration( fh, size ):
+   """
+   :returns: Duration of an Ogg Vorbis file in seconds.
+   :raises: :exc:`ValueError` if the first or last page is damaged, or the
+            stream has no end.
+   """
+   head = fh.read( _CHUNK )
+   kind,_,_,body = _ogg_page( head, 0 )
+   packet = head[body:body+16]
+   if packet[:7] != '\x01vorbis' or len(packet) < 16:
+      raise ValueError( "not an Ogg Vorbis stream" )
+   rate, = struct.unpack('<I', packet[12:16])
+   start = max( 0, size - _CHUNK )
+   fh.seek( start )
+   tail = fh.read()
+   pos = tail.rfind( 'OggS' )
+   while pos >= 0:
+      try:
+         kind,granule,end,_ = _ogg_page( tail, pos )
+      except ValueError:
+         pos = tail.rfind( 'OggS', 0, pos )
+         continue   # 'OggS' within the page data
+      if end != len(tail):
+         raise ValueError( "truncated Ogg page at %d" % (start + end,) )
+      if not kind & 0x04:
+         raise ValueError( "no Ogg end of stream page" )
+      if not rate:
+         raise ValueError( "invalid Vorbis sample rate" )
+      return float(granule) / rate
+   raise ValueError( "no valid Ogg page at the end of the file" )
+
+
+def _ogg_page( data, pos ):
+   # :returns: tuple of (header type, granule position, end, body start)
+   header = data[pos:pos+27]
+   if len(header) < 27 or header[:5] != 'OggS\x00':
+      raise ValueError( "invalid Ogg page at %d" % (pos,) )
+   kind,granule,crc,count = struct.unpack('<BqxxxxxxxxIB', header[5:27])
+   lacing = data[pos+27:pos+27+count]
+   body = pos + 27 + count
+   end = body + sum( ord(c) for c in lacing )
+   if len(lacing) < count or end > len(data):
+      raise ValueError( "truncated Ogg page at %d" % (pos,) )
+   page = data[pos:pos+22] + '\x00'*4 + data[pos+26:end]
+   if ogg_crc( page ) != crc:
+      raise ValueError( "Ogg page CRC mismatch at %d" % (pos,) )
+   return kind, granule, end, body
+
+
+def ogg_crc( data ):
+   """
+   :returns: Ogg page checksum (CRC-32, polynomial 0x04c11db7, not
+             reflected) of the data, with the checksum field set to zero.
+   """
+   # zlib computes the reflected CRC, so reflect the input and the output
+   crc = ~zlib.crc32( data.translate(_REVERSE), 0xffffffff ) & 0xffffffff
+   return int( '{0:032b}'.format(crc)[::-1], 2 )
+
+
+def mp3_duration( fh, size ):
+   """
+   :returns: Duration of an MP3 file in seconds.
+   :raises: :exc:`ValueError` if the stream is shorter than recorded by the
+            info frame, or has no valid frames.
+   """
+   head = fh.read( _CHUNK )
+   offset = mp3.id3v2_size( head )
+   if offset + 4 > len(head):
+      fh.seek( offset )
+      head = fh.read( _CHUNK )
+      offset = 0
+   base = fh.tell() - len(head)
+   try:
+      frame = mp3.Frame( head[offset:offset+4] )
+   except ValueError:
+      raise ValueError( "no MP3 frame at %d" % (base + offset,) )
+   tag = mp3.info_tag( head, offset, frame )
+   if tag is not None and len(head) >= tag + 16:
+      flags,count,length = struct.unpack('>III', head[tag+4:tag+16])
+      if flags & 0x3 == 0x3 and count:
+         if base + offset + length > size:
+            raise ValueError( "MP3 stream is %d bytes short" % (
+                  base + offset + length - size,) )
+         samples = count * frame.samples
+         if head[tag+120:tag+124] == 'LAME' and len(head) >= tag + 144:
+            # gapless playback values, see mp3.join
+            delay = (ord(head[tag+141]) << 4) | (ord(head[tag+142]) >> 4)
+            padding = ((ord(head[tag+142]) & 0xf) << 8) | ord(head[tag+143])
+            samples -= delay + padding
+         return float(samples) / frame.rate
+   # no info frame, count all frames of the stream
+   fh.seek( base + offset )
+   data = fh.read()
+   count = 0
+   end = 0
+   for pos,frame in mp3.frames( data ):
+      count += 1
+      end = pos + frame.size
+   if count and tag is not None:
+      count -= 1   # the info frame has no audio
+   rest = data[end:]
+   if rest and not (rest[:3] == 'TAG' or rest[:8] == 'APETAGEX'):
+      raise ValueError( "truncated MP3 frame at %d" % (base + offset + end,) )
+   return float(count * frame.samples) / frame.rate
+
+
+#: Function reading the duration of a file, by file extension.
+DURATIONS = {
+   '.m4a':mp4_duration,
+   '.mp4':mp4_duration,
+   '.ogg':ogg_duration,
+   '.mp3':mp3_duration,
+   }